@@ -0,0 +1,183 @@
+import mmap
+import tempfile
+import zlib
+from typing import List, Optional, Tuple, Union
+from config import config
+
+class MappedBody(mmap.mmap):
+    """
+    Тело, ушедшее на диск. mmap уже работает как bytes для срезов, len, re и
+    sqlite; здесь добавлено то, чем правила пользуются чаще всего.
+    """
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, int):
+            return super().__contains__(item)
+        # у mmap `in` сравнивает по одному байту
+        return self.find(item) >= 0
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (bytes, bytearray, memoryview)):
+            return len(self) == len(other) and self[:] == other
+        return self is other
+
+    __hash__ = mmap.mmap.__hash__
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return self[:].decode(encoding, errors)
+
+    def startswith(self, prefix) -> bool:
+        return self[:len(prefix)] == prefix
+
+    def endswith(self, suffix) -> bool:
+        return len(self) >= len(suffix) and self[len(self) - len(suffix):] == suffix
+
+    def __reduce__(self):
+        # в пул процессов уходит копией
+        return bytes, (self[:],)
+
+Body = Union[bytes, MappedBody]
+
+class BodyBuffer:
+    """
+    Накопление тела сообщения. Куски копятся списком и склеиваются один раз;
+    сверх memory_limit тело переезжает во временный файл и отдаётся через mmap,
+    сверх max_size дальше не сохраняется (truncated). 0 - без ограничения.
+    """
+
+    __slots__ = ("memory_limit", "max_size", "size", "truncated", "_chunks", "_file", "_value")
+
+    def __init__(self, memory_limit: int = config.BODY_MEMORY_LIMIT, max_size: int = config.BODY_MAX_SIZE):
+        self.memory_limit = memory_limit
+        self.max_size = max_size
+        self.size = 0
+        self.truncated = False
+        self._chunks: List[bytes] = []
+        self._file = None
+        self._value: Optional[Body] = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def append(self, chunk: bytes):
+        if self.max_size and self.size + len(chunk) > self.max_size:
+            chunk = chunk[:self.max_size - self.size]
+            self.truncated = True
+        if not chunk:
+            return
+
+        self.size += len(chunk)
+        self._value = None
+        if self._file is not None:
+            self._file.write(chunk)
+            return
+
+        self._chunks.append(bytes(chunk))
+        if self.memory_limit and self.size > self.memory_limit:
+            self._spill()
+
+    def _spill(self):
+        # файл удаляется сразу после создания, место освобождается вместе с объектом
+        self._file = tempfile.TemporaryFile(prefix="body-")
+        self._file.writelines(self._chunks)
+        self._chunks = []
+
+    def getvalue(self) -> Body:
+        if self._value is not None:
+            return self._value
+
+        if self._file is not None:
+            self._file.flush()
+            self._value = MappedBody(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        elif len(self._chunks) == 1:
+            self._value = self._chunks[0]
+        else:
+            self._value = b"".join(self._chunks)
+            self._chunks = [self._value] if self._value else []
+        return self._value
+
+# Content-Encoding -> wbits для zlib; deflate уточняется по заголовку потока
+_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "x-gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+# входные данные подаются кусками, выход забирается шагами - лимиты проверяются по ходу
+_INPUT_STEP = 64 * 1024
+_OUTPUT_STEP = 256 * 1024
+# до этого размера степень сжатия не проверяется: мелкие однородные тела жмутся сильно
+_RATIO_GRACE = 1024 * 1024
+# gzip из многих пустых членов распаковывается долго, а лимиты размера не срабатывают
+_MAX_MEMBERS = 1024
+_GZIP_MAGIC = b"\x1f\x8b"
+
+def _inflate(data: bytes, wbits: int, max_size: int, max_ratio: float) -> Tuple[bytes, str]:
+    view = memoryview(data)
+    try:
+        return _inflate_view(view, wbits, max_size, max_ratio)
+    finally:
+        view.release()
+
+def _inflate_view(data: memoryview, wbits: int, max_size: int, max_ratio: float) -> Tuple[bytes, str]:
+    # вход читается по смещению, без копий: члены gzip идут один за другим
+    out = []
+    size = 0
+    pos = 0
+    members = 1
+    decompressor = zlib.decompressobj(wbits)
+
+    while pos < len(data):
+        piece = data[pos:pos + _INPUT_STEP]
+        pos += len(piece)
+        while piece:
+            try:
+                chunk = decompressor.decompress(piece, _OUTPUT_STEP)
+            except zlib.error as e:
+                return b"".join(out), f"invalid: {e}"
+            piece = decompressor.unconsumed_tail
+            out.append(chunk)
+            size += len(chunk)
+
+            if max_size and size > max_size:
+                return b"".join(out)[:max_size], "size limit"
+            consumed = pos - len(piece) - len(decompressor.unused_data)
+            if max_ratio and size > _RATIO_GRACE and size > consumed * max_ratio:
+                return b"".join(out), "ratio limit"
+
+            if decompressor.eof:
+                # gzip из нескольких членов - следующий начинается сразу за концом
+                if wbits != _WBITS["gzip"] or consumed >= len(data):
+                    return b"".join(out), ""
+                if data[consumed:consumed + 2] != _GZIP_MAGIC and not bytes(data[consumed:]).strip(b"\0"):
+                    return b"".join(out), ""
+                members += 1
+                if members > _MAX_MEMBERS:
+                    return b"".join(out), "member limit"
+                pos, piece = consumed, b""
+                decompressor = zlib.decompressobj(wbits)
+
+    return b"".join(out), "" if decompressor.eof else "incomplete"
+
+def decode_content(body: Body, encodings: List[str], max_size: int, max_ratio: float) -> Tuple[Body, str]:
+    """
+    Распаковка тела по Content-Encoding (слои снимаются в обратном порядке).
+    Возвращает тело и ошибку: "" - всё распаковано, иначе распакованное до
+    ошибки или лимита ("size limit", "ratio limit" - похоже на бомбу,
+    "member limit" - слишком много членов gzip).
+    """
+    for encoding in reversed(encodings):
+        if encoding in ("", "identity"):
+            continue
+        wbits = _WBITS.get(encoding)
+        if wbits is None:
+            return body, f"unsupported encoding: {encoding}"
+
+        data = body[:]
+        if encoding == "deflate" and len(data) >= 2 and ((data[0] & 0x0f) != 8 or (data[0] << 8 | data[1]) % 31):
+            # вместо zlib-потока часто шлют голый deflate
+            wbits = -zlib.MAX_WBITS
+
+        body, error = _inflate(data, wbits, max_size, max_ratio)
+        if error:
+            return body, error
+    return body, ""
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional
+from app.core.rulestats import RuleStats
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# ответ со статистикой правил может быть большим
+_RESPONSE_LIMIT = 64 * 1024 * 1024
+
+# Канал управления прокси: Unix-сокет, по строке JSON на запрос и ответ.
+#   -> {"cmd": "reload"}
+#   <- {"ok": true, "result": 3}
+# Панель в отдельном процессе (PANEL_PROCESS или PROXY_WORKERS > 1) через него
+# перезагружает правила, меняет IP-списки и собирает статистику движка.
+
+def control_path(index: Optional[int] = None) -> str:
+    # у каждого воркера свой сокет
+    return config.CONTROL_SOCKET if index is None else f"{config.CONTROL_SOCKET}.{index}"
+
+class ControlServer:
+    def __init__(self, proxy, path: str):
+        self.proxy = proxy
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._commands = {
+            "reload": self._reload,
+            "ip": self._update_ip,
+            "block_ip": self._block_ip,
+            "stats": self._stats,
+            "reset_stats": self._reset_stats,
+            "release": self._release,
+        }
+
+    async def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # сокет от прошлого запуска мешает bind
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(json.dumps(await self._dispatch(line)).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, line: bytes) -> Dict[str, Any]:
+        try:
+            request = json.loads(line)
+            handler = self._commands.get(request.get("cmd"))
+            if handler is None:
+                return {"ok": False, "error": f"unknown command: {request.get('cmd')}"}
+            return {"ok": True, "result": await handler(request)}
+        except Exception as e:
+            logger.error(f"Control command failed: {e}")
+            return {"ok": False, "error": str(e)}
+
+    async def _reload(self, request: dict) -> int:
+        # IP-списки панель уже сохранила в файл
+        self.proxy.ip_list.reload()
+        return await self.proxy.rule_engine.reload_rules_async()
+
+    async def _update_ip(self, request: dict) -> List[str]:
+        # файл пишет панель, здесь только списки в памяти
+        ip_list = self.proxy.ip_list
+        update = ip_list.add if request["operation"] == "add" else ip_list.remove
+        changed, _ = update(request["list"], request["ips"], save=False)
+        return changed
+
+    async def _block_ip(self, request: dict) -> List[str]:
+        changed, _ = self.proxy.ip_list.add("block", [request["ip"]], save=False)
+        return changed
+
+    async def _stats(self, request: dict) -> Dict[str, Any]:
+        from app.database.writer import writer
+
+        engine = self.proxy.rule_engine
+        pool = self.proxy.upstream_pool
+        return {
+            "pid": os.getpid(),
+            "status": engine.status(),
+            "rules": engine.rule_stats(raw=True),
+            "quarantined": engine.quarantined(),
+            "pool": pool.stats() if pool is not None else None,
+            "writer": {"written": writer.written, "dropped": writer.dropped, "spilled": writer.spilled},
+        }
+
+    async def _reset_stats(self, request: dict) -> int:
+        return self.proxy.rule_engine.reset_stats(request.get("path"))
+
+    async def _release(self, request: dict) -> bool:
+        return await self.proxy.rule_engine.release(request["path"])
+
+class ControlError(Exception):
+    pass
+
+class ControlClient:
+    """Сторона панели: команда уходит всем процессам прокси сразу."""
+
+    def __init__(self, paths: List[str], timeout: float = config.CONTROL_TIMEOUT):
+        self.paths = paths
+        self.timeout = timeout
+
+    async def request(self, path: str, cmd: str, **args) -> Any:
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(path, limit=_RESPONSE_LIMIT), self.timeout)
+        try:
+            writer.write(json.dumps({"cmd": cmd, **args}).encode("utf-8") + b"\n")
+            await writer.drain()
+            line = await asyncio.wait_for(reader.readuntil(b"\n"), self.timeout)
+        finally:
+            writer.close()
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise ControlError(response.get("error", "unknown error"))
+        return response["result"]
+
+    async def broadcast(self, cmd: str, **args) -> List[Any]:
+        """Ответы всех воркеров; недоступные пропускаются. Если не ответил никто - ControlError."""
+        results = await asyncio.gather(*(self.request(path, cmd, **args) for path in self.paths),
+                                       return_exceptions=True)
+        answered = []
+        for path, result in zip(self.paths, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"Proxy control {path} failed on {cmd}: {result}")
+            else:
+                answered.append(result)
+        if not answered:
+            raise ControlError(f"no proxy process answered {cmd}")
+        return answered
+
+    async def stats(self) -> Dict[str, Any]:
+        return merge_stats(await self.broadcast("stats"))
+
+def merge_stats(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Статистика нескольких воркеров как одного движка: счётчики суммируются, перцентили - по общей гистограмме."""
+    status = dict(results[0]["status"])
+    # поколения у воркеров могут разойтись, пока идёт перезагрузка
+    status["generation"] = min(r["status"]["generation"] for r in results)
+    status["quarantined"] = len({q["path"] for r in results for q in r["quarantined"]})
+    status["budget_exceeded"] = sum(r["status"]["budget_exceeded"] for r in results)
+    status["workers"] = len(results)
+
+    rules: Dict[str, Dict[str, Any]] = {}
+    merged: Dict[str, RuleStats] = {}
+    for result in results:
+        for rule in result["rules"]:
+            path = rule["path"]
+            if path not in rules:
+                rules[path] = {k: v for k, v in rule.items() if k not in ("stats", "total_ms", "budget_violations")}
+                rules[path]["budget_violations"] = 0
+                merged[path] = RuleStats()
+            rules[path]["budget_violations"] += rule["budget_violations"]
+            merged[path].merge(rule["stats"])
+    rule_stats = []
+    for path, rule in rules.items():
+        rule.update(merged[path].to_dict())
+        rule_stats.append(rule)
+    rule_stats.sort(key=lambda d: -d["total_ms"])
+
+    quarantined: Dict[str, Dict[str, Any]] = {}
+    for result in results:
+        for item in result["quarantined"]:
+            entry = quarantined.setdefault(item["path"], {"path": item["path"], "violations": 0})
+            entry["violations"] += item["violations"]
+
+    pools = [r["pool"] for r in results if r["pool"] is not None]
+    pool = {"enabled": False}
+    if pools:
+        pool = {key: sum(p[key] for p in pools) for key in pools[0] if key != "enabled"}
+        pool["enabled"] = True
+
+    return {
+        "status": status,
+        "rules": rule_stats,
+        "quarantined": sorted(quarantined.values(), key=lambda q: q["path"]),
+        "pool": pool,
+        "writer": {key: sum(r["writer"][key] for r in results) for key in results[0]["writer"]},
+        "workers": [r["pid"] for r in results],
+    }
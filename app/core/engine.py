@@ -1,9 +1,22 @@
 from enum import Enum
-from typing import Optional, Dict, Any, List
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Callable, Tuple, Iterable
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+import asyncio
+import ast
+import dataclasses
+import hashlib
 import logging
+import multiprocessing
 import os
+import threading
+import time
 import re # для правил
+from app.core.body import MappedBody
 from app.core.parser import HttpRequest
+from app.core.signatures import SignatureSet, parse_signatures
+from app.core.rulestats import RuleStats
+from config import config
 
 logger = logging.getLogger(__name__)
 
@@ -40,52 +53,507 @@ class Action:
 
         return Action(ActionType.MARK, new_tags)
 
+class RuleContext:
+    """Объект `action` внутри правила. Один на вызов evaluate, между правилами только сбрасывается."""
+    __slots__ = ('verdict', 'tags', 'rule_name')
+
+    def __init__(self, tags: List[str]):
+        self.verdict = None
+        self.tags = tags
+        self.rule_name = ""
+
+    def reset(self, rule_name: str):
+        self.verdict = None
+        self.rule_name = rule_name
+
+    def drop(self):
+        self.verdict = ActionType.DROP
+        #пометка автоматическая дроп
+        self.mark(self.rule_name)
+
+    def accept(self):
+        self.verdict = ActionType.ACCEPT
+
+    def mark(self, tag):
+        self.tags.append(tag)
+
+class RuleRequest:
+    """
+    Запрос, как его видят правила, если тело ушло на диск: request.body - настоящие
+    bytes (.lower(), +, isinstance), копия делается при первом обращении. Остальное,
+    в том числе разборы тела (data, json, form), берётся из самого запроса.
+    """
+    __slots__ = ("_request", "_body")
+
+    def __init__(self, request: HttpRequest):
+        object.__setattr__(self, "_request", request)
+        object.__setattr__(self, "_body", None)
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            object.__setattr__(self, "_body", self._request.body[:])
+        return self._body
+
+    @property
+    def decoded_body(self) -> bytes:
+        # без Content-Encoding распакованное тело - то же тело с диска
+        decoded = self._request.decoded_body
+        return self.body if decoded is self._request.body else decoded
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._request, name, value)
+
+    def __repr__(self):
+        return repr(self._request)
+
+# тег запроса, часть правил которого пропущена из-за REQUEST_TIME_BUDGET_MS
+BUDGET_EXCEEDED_TAG = "budget_exceeded"
+
+# тело .rule файла оборачивается в функцию, httprequest - старый алиас request
+_RULE_TEMPLATE = "def __rule__(request, action):\n    httprequest = request\n"
+
+def compile_rule(source: str, path: str) -> Callable[[HttpRequest, RuleContext], None]:
+    tree = ast.parse(source, path)
+    wrapper = ast.parse(_RULE_TEMPLATE, path)
+    func_def = wrapper.body[0]
+    func_def.body.extend(tree.body)
+
+    code = compile(wrapper, path, 'exec')
+    rule_globals = {'re': re}
+    exec(code, rule_globals)
+    return rule_globals['__rule__']
+
+def is_tag_only(source: str) -> bool:
+    """Правило только ставит теги: action в нём встречается лишь как action.mark."""
+    tree = ast.parse(source)
+    marks = {id(node.value) for node in ast.walk(tree)
+             if isinstance(node, ast.Attribute) and node.attr == "mark"}
+    return not any(isinstance(node, ast.Name) and node.id == "action" and id(node) not in marks
+                   for node in ast.walk(tree))
+
+# фазы правил: по заголовкам (до чтения тела), по кускам тела, по сообщению целиком
+PHASES = ("headers", "stream", "body")
+
+# метаданные в начале файла правила, например "# @priority: 10"
+_META_RE = re.compile(r'^#\s*@(\w+)\s*:?\s*(.*?)\s*$')
+
+def parse_rule_meta(source: str) -> Dict[str, str]:
+    meta = {}
+    for line in source.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith('#'):
+            break
+        m = _META_RE.match(line)
+        if m:
+            meta[m.group(1).lower()] = m.group(2)
+    return meta
+
+@dataclass
+class CompiledRule:
+    name: str
+    path: str
+    service_port: Optional[int]
+    func: Callable[[HttpRequest, RuleContext], None]
+    priority: int = 0 # больше - раньше
+    digest: str = ""
+    # "# @heavy": правило выполняется в отдельном процессе с дедлайном
+    heavy: bool = False
+    timeout: Optional[float] = None # секунды, для heavy; None - из конфига
+    source: str = "" # только у heavy, воркер компилирует его сам
+    # "# @phase: headers|stream|body", по умолчанию правило видит запрос целиком
+    phase: str = "body"
+    # не вызывает action.drop/accept: с short_circuit выполняется и после вердикта
+    tag_only: bool = False
+    # живёт вместе с объектом правила, т.е. переживает reload неизменённого файла
+    stats: RuleStats = field(default_factory=RuleStats, compare=False, repr=False)
+
+@dataclass(frozen=True)
+class RuleSet:
+    """Неизменяемый снимок загруженных правил. evaluate работает с тем снимком, с которого начал."""
+    generation: int
+    rules: Tuple[CompiledRule, ...]
+    global_rules: Tuple[CompiledRule, ...]
+    service_rules: Dict[int, Tuple[CompiledRule, ...]]
+    global_signatures: Optional[SignatureSet]
+    service_signatures: Dict[int, SignatureSet]
+    has_heavy_rules: bool = False
+    # ранние фазы: фаза -> (глобальные, по портам); global_rules/service_rules - фаза body
+    phases: Dict[str, Tuple[Tuple[CompiledRule, ...], Dict[int, Tuple[CompiledRule, ...]]]] = field(default_factory=dict)
+
+EMPTY_RULESET = RuleSet(0, (), (), {}, None, {})
+
+@dataclass
+class _CachedFile:
+    mtime_ns: int
+    size: int
+    digest: str
+    # CompiledRule для .rule, список Signature для .sig; None если файл не скомпилировался
+    compiled: Any
+
+def _combine(a: Optional[ActionType], b: Optional[ActionType]) -> Optional[ActionType]:
+    if ActionType.ACCEPT in (a, b):
+        return ActionType.ACCEPT
+    if ActionType.DROP in (a, b):
+        return ActionType.DROP
+    return None
+
+# кеш правил в процессе-воркере: (путь, хеш) -> функция
+_isolated_rules: Dict[Tuple[str, str], Callable] = {}
+
+def run_rule_isolated(path: str, name: str, digest: str, source: str,
+                      request: HttpRequest) -> Tuple[Optional[ActionType], List[str]]:
+    """Выполняется в пуле процессов для heavy-правил."""
+    func = _isolated_rules.get((path, digest))
+    if func is None:
+        func = compile_rule(source, path)
+        _isolated_rules[(path, digest)] = func
+
+    tags = []
+    ctx = RuleContext(tags)
+    ctx.reset(name)
+    func(request, ctx)
+    return ctx.verdict, tags
+
 class RuleEngine:
-    def __init__(self, rules_dir: str = "rules"):
+    def __init__(self, rules_dir: str = "rules", short_circuit: Optional[bool] = None,
+                 rule_budget_ms: float = config.RULE_TIME_BUDGET_MS,
+                 request_budget_ms: float = config.REQUEST_TIME_BUDGET_MS,
+                 request_budget_fallback: str = config.REQUEST_BUDGET_FALLBACK,
+                 quarantine_after: int = config.RULE_QUARANTINE_AFTER,
+                 heavy_timeout_ms: float = config.HEAVY_RULE_TIMEOUT_MS,
+                 heavy_workers: int = config.HEAVY_RULE_WORKERS,
+                 heavy_fallback: str = config.HEAVY_RULE_FALLBACK,
+                 stream_lookbehind: int = config.STREAM_LOOKBEHIND):
         self.rules_dir = rules_dir
-        self.rules = []
+        self.short_circuit = config.RULES_SHORT_CIRCUIT if short_circuit is None else short_circuit
+
+        # 0 - без ограничений
+        self.rule_budget = rule_budget_ms / 1000
+        self.request_budget = request_budget_ms / 1000
+        # вердикт, если часть правил пропущена из-за бюджета запроса
+        self.request_budget_fallback = ActionType(request_budget_fallback.upper())
+        self.quarantine_after = quarantine_after
+        self.heavy_timeout = heavy_timeout_ms / 1000
+        self.heavy_workers = heavy_workers
+        self.heavy_fallback = ActionType(heavy_fallback.upper())
+        # сколько байт предыдущих кусков тела видит stream-правило
+        self.stream_lookbehind = stream_lookbehind
+
+        self._snapshot: RuleSet = EMPTY_RULESET
+        self._file_cache: Dict[str, _CachedFile] = {}
+        # ключ - набор (путь, хеш) .sig файлов уровня, автомат пересобирается только при их изменении
+        self._signature_cache: Dict[tuple, SignatureSet] = {}
+        self._reload_lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+
+        # путь -> число превышений бюджета; карантин: путь -> хеш содержимого
+        self._violations: Dict[str, int] = {}
+        self._quarantined: Dict[str, str] = {}
+        self.budget_exceeded = 0
+        self._heavy_pool: Optional[ProcessPoolExecutor] = None
+        # пул -> число наших заданий в нём; списанный пул закрывается, когда их не останется
+        self._heavy_inflight: Dict[ProcessPoolExecutor, int] = {}
+        self._retired_pools: List[ProcessPoolExecutor] = []
+
         self._load_rules()
 
-    def _load_rules(self):
-        self.rules = []
+    @property
+    def snapshot(self) -> RuleSet:
+        return self._snapshot
+
+    @property
+    def generation(self) -> int:
+        return self._snapshot.generation
+
+    @property
+    def rules(self) -> Tuple[CompiledRule, ...]:
+        return self._snapshot.rules
+
+    @property
+    def global_rules(self) -> Tuple[CompiledRule, ...]:
+        return self._snapshot.global_rules
+
+    @property
+    def service_rules(self) -> Dict[int, Tuple[CompiledRule, ...]]:
+        return self._snapshot.service_rules
+
+    @property
+    def global_signatures(self) -> Optional[SignatureSet]:
+        return self._snapshot.global_signatures
+
+    @property
+    def service_signatures(self) -> Dict[int, SignatureSet]:
+        return self._snapshot.service_signatures
+
+    def _service_port(self, root: str) -> Optional[int]:
+        rel_dir = os.path.relpath(root, self.rules_dir)
+        service_port = None
+
+        if rel_dir.startswith("services"):
+            try:
+                parts = rel_dir.split(os.sep)
+                if len(parts) >= 2:
+                    service_port = int(parts[1])
+            except:
+                pass
+        return service_port
+
+    def _compile_file(self, path: str, file: str, root: str, source: str, digest: str) -> Any:
+        name = os.path.splitext(file)[0]
+
+        if file.endswith(".sig"):
+            return parse_signatures(source, path, name)
+
+        func = compile_rule(source, path)
+        meta = parse_rule_meta(source)
+
+        priority = 0
+        if 'priority' in meta:
+            try:
+                priority = int(meta['priority'])
+            except ValueError:
+                logger.warning(f"Bad priority in {path}: {meta['priority']}")
+
+        heavy = 'heavy' in meta and meta['heavy'].lower() not in ("0", "false", "no")
+        timeout = None
+        if 'timeout_ms' in meta:
+            try:
+                timeout = float(meta['timeout_ms']) / 1000
+            except ValueError:
+                logger.warning(f"Bad timeout_ms in {path}: {meta['timeout_ms']}")
+
+        phase = meta.get('phase', 'body').lower() or 'body'
+        if phase not in PHASES:
+            logger.warning(f"Bad phase in {path}: {meta['phase']}")
+            phase = 'body'
+        if heavy and phase != 'body':
+            # ранние фазы выполняются синхронно в разборе потока, пулу там не место
+            logger.warning(f"Heavy rule {path} can only run in the body phase")
+            phase = 'body'
+
+        return CompiledRule(
+            name=name,
+            path=path,
+            service_port=self._service_port(root),
+            func=func,
+            priority=priority,
+            digest=digest,
+            heavy=heavy,
+            timeout=timeout,
+            source=source if heavy else "",
+            phase=phase,
+            tag_only=is_tag_only(source)
+        )
+
+    def _load_file(self, path: str, file: str, root: str) -> Optional[_CachedFile]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        cached = self._file_cache.get(path)
+        if cached is not None and cached.mtime_ns == st.st_mtime_ns and cached.size == st.st_size:
+            return cached
+
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except OSError as e:
+            logger.error(f"Failed to read rule {path}: {e}")
+            return None
+
+        digest = hashlib.sha1(raw).hexdigest()
+        if cached is not None and cached.digest == digest:
+            # файл тронули, но содержимое то же
+            cached.mtime_ns, cached.size = st.st_mtime_ns, st.st_size
+            return cached
+
+        # новое содержимое - старые превышения бюджета не в счёт
+        self._violations.pop(path, None)
+
+        compiled = None
+        try:
+            compiled = self._compile_file(path, file, root, raw.decode('utf-8'), digest)
+        except Exception as e:
+            logger.error(f"Failed to load rule {path}: {e}")
+
+        return _CachedFile(st.st_mtime_ns, st.st_size, digest, compiled)
+
+    def _build_snapshot(self) -> Tuple[List[CompiledRule], Dict[Optional[int], SignatureSet]]:
         if not os.path.exists(self.rules_dir):
             os.makedirs(self.rules_dir, exist_ok=True)
 
         os.makedirs(os.path.join(self.rules_dir, "dynamic"), exist_ok=True)
 
-
+        rules = []
+        # порт -> [(путь, хеш, сигнатуры)]
+        signature_files: Dict[Optional[int], list] = {}
+        file_cache = {}
 
         for root, _, files in os.walk(self.rules_dir):
             for file in files:
+                if not file.endswith((".rule", ".sig")):
+                    continue
+                path = os.path.join(root, file)
+                entry = self._load_file(path, file, root)
+                if entry is None:
+                    continue
+                file_cache[path] = entry
+                if entry.compiled is None:
+                    continue
+
                 if file.endswith(".rule"):
-                    path = os.path.join(root, file)
-                    try:
-                        with open(path, 'r') as f:
-                            code_str = f.read()
-                            code = compile(code_str, path, 'exec')
-
-                            rel_dir = os.path.relpath(root, self.rules_dir)
-                            service_port = None
-
-                            if rel_dir.startswith("services"):
-                                try:
-                                    parts = rel_dir.split(os.sep)
-                                    if len(parts) >= 2:
-                                        service_port = int(parts[1])
-                                except:
-                                    pass
-
-                            self.rules.append({
-                                'code': code,
-                                'path': path,
-                                'service_port': service_port
-                            })
-                    except Exception as e:
-                        logger.error(f"Failed to load rule {path}: {e}")
-
-    def reload_rules(self):
+                    rules.append(entry.compiled)
+                else:
+                    signature_files.setdefault(self._service_port(root), []).append((path, entry.digest, entry.compiled))
+
+        signature_cache = {}
+        signature_sets = {}
+        for port, entries in signature_files.items():
+            entries.sort(key=lambda e: e[0])
+            key = tuple((path, digest) for path, digest, _ in entries)
+            sigset = self._signature_cache.get(key)
+            if sigset is None:
+                sigs = []
+                for _, _, file_sigs in entries:
+                    # id сигнатур уникальны в пределах уровня
+                    sigs.extend(dataclasses.replace(sig, id=len(sigs) + i) for i, sig in enumerate(file_sigs))
+                sigset = SignatureSet(sigs)
+            signature_cache[key] = sigset
+            signature_sets[port] = sigset
+
+        self._file_cache = file_cache
+        self._signature_cache = signature_cache
+        return rules, signature_sets
+
+    def _publish(self, rules: Iterable[CompiledRule], signature_sets: Dict[Optional[int], SignatureSet]) -> int:
+        with self._publish_lock:
+            return self._publish_locked(rules, signature_sets)
+
+    def _publish_locked(self, rules: Iterable[CompiledRule], signature_sets: Dict[Optional[int], SignatureSet]) -> int:
+        quarantined = self._quarantined
+        rules = [r for r in rules if quarantined.get(r.path) != r.digest]
+
+        # индекс по фазам и портам: глобальные отдельно, сервисные по своему порту
+        rules.sort(key=lambda r: (-r.priority, r.path))
+        index = {}
+        for rule in rules:
+            global_rules, service_rules = index.setdefault(rule.phase, ([], {}))
+            if rule.service_port is None:
+                global_rules.append(rule)
+            else:
+                service_rules.setdefault(rule.service_port, []).append(rule)
+
+        phases = {
+            phase: (tuple(global_rules), {port: tuple(bucket) for port, bucket in service_rules.items()})
+            for phase, (global_rules, service_rules) in index.items()
+        }
+        global_rules, service_rules = phases.pop("body", ((), {}))
+
+        signature_sets = dict(signature_sets)
+        snapshot = RuleSet(
+            generation=self._snapshot.generation + 1,
+            rules=tuple(rules),
+            global_rules=global_rules,
+            service_rules=service_rules,
+            global_signatures=signature_sets.pop(None, None),
+            service_signatures=signature_sets,
+            has_heavy_rules=any(r.heavy for r in rules),
+            phases=phases
+        )
+        # одна замена ссылки, текущие evaluate дорабатывают со старым снимком
+        self._snapshot = snapshot
+        return snapshot.generation
+
+    def _load_rules(self) -> int:
+        with self._reload_lock:
+            rules, signature_sets = self._build_snapshot()
+            return self._publish(rules, signature_sets)
+
+    def reload_rules(self) -> int:
         logger.info("Reload rules...")
-        self._load_rules()
+        return self._load_rules()
+
+    async def reload_rules_async(self) -> int:
+        # чтение и компиляция в отдельном потоке, event loop прокси не блокируется
+        logger.info("Reload rules...")
+        return await asyncio.to_thread(self._load_rules)
+
+    def _rel_path(self, path: str) -> str:
+        return os.path.relpath(path, self.rules_dir)
+
+    def quarantine(self, rule: CompiledRule):
+        logger.error(f"Rule {rule.path} quarantined after {self._violations.get(rule.path, 0)} budget violations")
+        # снимок перечитывается под тем же замком, что и публикация: параллельная
+        # перезагрузка либо уже опубликована и видна здесь, либо увидит карантин сама
+        with self._publish_lock:
+            self._quarantined[rule.path] = rule.digest
+            snapshot = self._snapshot
+            signature_sets = dict(snapshot.service_signatures)
+            signature_sets[None] = snapshot.global_signatures
+            if signature_sets[None] is None:
+                del signature_sets[None]
+            self._publish_locked(snapshot.rules, signature_sets)
+
+    async def release(self, rel_path: str) -> bool:
+        path = os.path.join(self.rules_dir, rel_path)
+        with self._publish_lock:
+            released = self._quarantined.pop(path, None) is not None
+        self._violations.pop(path, None)
+        if released:
+            await self.reload_rules_async()
+        return released
+
+    def quarantined(self) -> List[Dict[str, Any]]:
+        return [
+            {"path": self._rel_path(path), "violations": self._violations.get(path, 0)}
+            for path in sorted(self._quarantined)
+        ]
+
+    def status(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        signatures = len(snapshot.global_signatures or ()) + sum(len(s) for s in snapshot.service_signatures.values())
+        return {
+            "generation": snapshot.generation,
+            "rules": len(snapshot.rules),
+            "signatures": signatures,
+            "services": sorted(set(snapshot.service_rules) | set(snapshot.service_signatures)),
+            "heavy_rules": sum(1 for r in snapshot.rules if r.heavy),
+            "phases": {phase: sum(1 for r in snapshot.rules if r.phase == phase) for phase in PHASES},
+            "quarantined": len(self._quarantined),
+            "budget_exceeded": self.budget_exceeded
+        }
+
+    def rule_stats(self, raw: bool = False) -> List[Dict[str, Any]]:
+        # raw - сырые счётчики в "stats", чтобы панель могла сложить воркеров
+        result = []
+        for rule in self._snapshot.rules:
+            data = {"stats": rule.stats.dump(), "total_ms": rule.stats.total_time * 1000} if raw else rule.stats.to_dict()
+            data["path"] = self._rel_path(rule.path)
+            data["name"] = rule.name
+            data["service_port"] = rule.service_port
+            data["heavy"] = rule.heavy
+            data["phase"] = rule.phase
+            data["budget_violations"] = self._violations.get(rule.path, 0)
+            result.append(data)
+        # самые дорогие сверху
+        result.sort(key=lambda d: -d["total_ms"])
+        return result
+
+    def reset_stats(self, rel_path: Optional[str] = None) -> int:
+        path = os.path.join(self.rules_dir, rel_path) if rel_path else None
+        count = 0
+        for rule in self._snapshot.rules:
+            if path is None or rule.path == path:
+                rule.stats.reset()
+                count += 1
+        return count
 
     def add_rule(self, name: str, content: str):
         path = os.path.join(self.rules_dir, "dynamic", f"{name}.rule")
@@ -98,68 +566,130 @@ class RuleEngine:
             logger.error(f"Failed to add rule {name}: {e}")
             return False
 
-    def evaluate(self, request: HttpRequest) -> Action:
-        final_action = Action(ActionType.MARK)
-
-        class ActionContext:
-            def __init__(self, rule_name: str):
-                self.verdict = None
-                self.tags = []
-                self.rule_name = rule_name
-
-            def drop(self):
-                self.verdict = ActionType.DROP
-                #пометка автоматическая дроп
-                self.mark(self.rule_name) 
-
-            def accept(self):
-                self.verdict = ActionType.ACCEPT
-
-            def mark(self, tag):
-                self.tags.append(tag)
-
-        global_verdict = None
-        service_verdict = None
-        all_tags = []
-
-        for rule in self.rules:
-            if rule['service_port'] is not None:
-                if rule['service_port'] != request.destination_port:
-                    continue 
-
-            rule_name = os.path.splitext(os.path.basename(rule['path']))[0]
-            ctx = ActionContext(rule_name)
-
-            local_scope = {
-                'request': request,
-                'httprequest': request,
-                'action': ctx,
-                're': re
-            }
-
-            try:
-                exec(rule['code'], {}, local_scope)
-
-                if ctx.tags:
-                    all_tags.extend(ctx.tags)
-
-                if rule['service_port'] is not None:
-                    if ctx.verdict == ActionType.ACCEPT:
-                        service_verdict = ActionType.ACCEPT
-                    elif ctx.verdict == ActionType.DROP:
-                        if service_verdict != ActionType.ACCEPT:
-                            service_verdict = ActionType.DROP
+    def _rule_over_budget(self, rule: CompiledRule, elapsed: float):
+        count = self._violations.get(rule.path, 0) + 1
+        self._violations[rule.path] = count
+        logger.warning(f"Rule {rule.path} took {elapsed * 1000:.1f} ms, budget exceeded {count} times")
+
+        if self.quarantine_after and count >= self.quarantine_after and rule.path not in self._quarantined:
+            self.quarantine(rule)
+
+    def _run_bucket(self, rules: Iterable[CompiledRule], signatures: Optional[SignatureSet],
+                    request: HttpRequest, ctx: RuleContext, deadline: float,
+                    deferred: Optional[List[CompiledRule]] = None, tags_only: bool = False) -> Optional[ActionType]:
+        # tags_only - вердикт уже решён выше: выполняются только сигнатуры и правила с tag_only
+        verdict = None
+        all_tags = ctx.tags
+
+        # сначала сигнатуры: один проход по каждому полю на весь набор
+        if signatures is not None:
+            for sig in signatures.scan(request):
+                if sig.action == "ACCEPT":
+                    verdict = ActionType.ACCEPT
+                elif sig.action == "DROP":
+                    all_tags.append(sig.name)
+                    if verdict != ActionType.ACCEPT:
+                        verdict = ActionType.DROP
                 else:
-                    if ctx.verdict == ActionType.ACCEPT:
-                        global_verdict = ActionType.ACCEPT
-                    elif ctx.verdict == ActionType.DROP:
-                        if global_verdict != ActionType.ACCEPT:
-                            global_verdict = ActionType.DROP
+                    all_tags.append(sig.tag)
+
+            # ACCEPT уровня не перебить: дальше нужны только теги
+            if verdict == ActionType.ACCEPT and self.short_circuit:
+                tags_only = True
+
+        rule_budget = self.rule_budget
+        now = time.perf_counter()
+
+        for rule in rules:
+            if tags_only and not rule.tag_only:
+                continue
+            if rule.heavy and deferred is not None:
+                deferred.append(rule)
+                continue
+
+            if deadline and time.thread_time() > deadline:
+                # бюджет запроса исчерпан, оставшиеся правила не выполняем: среди них мог
+                # быть DROP, поэтому вердикт - request_budget_fallback (ACCEPT уровня не перебивает)
+                all_tags.append(BUDGET_EXCEEDED_TAG)
+                if self.request_budget_fallback == ActionType.DROP and verdict != ActionType.ACCEPT:
+                    verdict = ActionType.DROP
+                break
+
+            ctx.reset(rule.name)
+            tags_before = len(all_tags)
+            failed = False
 
+            try:
+                rule.func(request, ctx)
             except Exception as e:
-                logger.error(f"Error executing rule {rule['path']}: {e}")
+                # теги упавшего правила не учитываем
+                del all_tags[tags_before:]
+                failed = True
+                logger.error(f"Error executing rule {rule.path}: {e}")
+
+            started, now = now, time.perf_counter()
+            elapsed = now - started
+            rule.stats.record(elapsed, ctx.verdict and ctx.verdict.value, len(all_tags) > tags_before, failed)
+            if rule_budget and elapsed > rule_budget:
+                self._rule_over_budget(rule, elapsed)
+
+            if failed:
+                continue
+
+            if ctx.verdict == ActionType.ACCEPT:
+                verdict = ActionType.ACCEPT
+                # ACCEPT внутри уровня перебить нельзя, остальные правила нужны только ради тегов
+                if self.short_circuit:
+                    tags_only = True
+            elif ctx.verdict == ActionType.DROP:
+                if verdict != ActionType.ACCEPT:
+                    verdict = ActionType.DROP
+
+        return verdict
+
+    def _evaluate(self, snapshot: RuleSet, request: HttpRequest, all_tags: List[str],
+                  deferred: Optional[Dict[bool, List[CompiledRule]]] = None, phase: str = "body"):
+        ctx = RuleContext(all_tags)
+        if isinstance(request.body, MappedBody):
+            request = RuleRequest(request)
+        # бюджет - процессорное время потока: ожидание GIL и переключения
+        # event loop'а в него не входят
+        deadline = time.thread_time() + self.request_budget if self.request_budget else 0.0
+        tags_before = len(all_tags)
 
+        service_verdict = None
+        global_verdict = None
 
+        port = request.destination_port
+        if phase == "body":
+            global_rules, service_rules = snapshot.global_rules, snapshot.service_rules.get(port, ())
+            global_signatures, service_signatures = snapshot.global_signatures, snapshot.service_signatures.get(port)
+        else:
+            # сигнатуры смотрят и на тело, поэтому только в фазе body
+            global_rules, by_port = snapshot.phases.get(phase, ((), {}))
+            service_rules = by_port.get(port, ())
+            global_signatures = service_signatures = None
+
+        if service_rules or service_signatures is not None:
+            service_verdict = self._run_bucket(service_rules, service_signatures, request, ctx, deadline,
+                                               deferred[True] if deferred is not None else None)
+
+        # вердикт сервиса важнее глобального, глобальные правила тогда дают только теги -
+        # с short_circuit выполняются лишь сигнатуры и правила с tag_only (RULES_SHORT_CIRCUIT в config)
+        global_verdict = self._run_bucket(global_rules, global_signatures, request, ctx, deadline,
+                                          deferred[False] if deferred is not None else None,
+                                          tags_only=service_verdict is not None and self.short_circuit)
+
+        if BUDGET_EXCEEDED_TAG in all_tags[tags_before:]:
+            # один раз на запрос, сколько бы уровней правил ни было пропущено
+            self.budget_exceeded += 1
+            logger.warning(f"Request time budget exceeded on {request.method} {request.path}, remaining rules "
+                           f"skipped, falling back to {self.request_budget_fallback.value}")
+
+        return service_verdict, global_verdict
+
+    @staticmethod
+    def _final(service_verdict: Optional[ActionType], global_verdict: Optional[ActionType], all_tags: List[str]) -> Action:
         if service_verdict == ActionType.ACCEPT:
             return Action(ActionType.ACCEPT, list(set(all_tags)))
 
@@ -170,3 +700,158 @@ class RuleEngine:
             return Action(ActionType.DROP, list(set(all_tags)))
 
         return Action(ActionType.ACCEPT, list(set(all_tags)))
+
+    def _evaluate_phase(self, request: HttpRequest, phase: str) -> bool:
+        snapshot = self._snapshot
+        if phase not in snapshot.phases or request.dropped_phase:
+            return bool(request.dropped_phase)
+
+        # ACCEPT ранней фазы не отменяет следующих, в итог идут только DROP и теги
+        service_verdict, global_verdict = self._evaluate(snapshot, request, request.phase_tags, phase=phase)
+        if self._final(service_verdict, global_verdict, request.phase_tags).type == ActionType.DROP:
+            request.dropped_phase = phase
+            return True
+        return False
+
+    def evaluate_headers(self, request: HttpRequest) -> bool:
+        """Правила "# @phase: headers", тело ещё не прочитано. True - запрос отклонён."""
+        return self._evaluate_phase(request, "headers")
+
+    def evaluate_chunk(self, request: HttpRequest, chunk: bytes) -> bool:
+        """Правила "# @phase: stream" на очередной кусок тела. True - запрос отклонён."""
+        if "stream" not in self._snapshot.phases or request.dropped_phase:
+            return bool(request.dropped_phase)
+
+        # хвост предыдущих кусков, чтобы совпадение на стыке не потерялось
+        tail = request.window[-self.stream_lookbehind:] if self.stream_lookbehind else b""
+        request.window_start += len(request.window) - len(tail)
+        request.window = tail + bytes(chunk)
+        return self._evaluate_phase(request, "stream")
+
+    def evaluate(self, request: HttpRequest) -> Action:
+        # синхронно, heavy-правила выполняются прямо здесь
+        if request.dropped_phase:
+            return Action(ActionType.DROP, list(set(request.phase_tags)))
+        all_tags = list(request.phase_tags)
+        service_verdict, global_verdict = self._evaluate(self._snapshot, request, all_tags)
+        return self._final(service_verdict, global_verdict, all_tags)
+
+    async def evaluate_async(self, request: HttpRequest) -> Action:
+        if request.dropped_phase:
+            return Action(ActionType.DROP, list(set(request.phase_tags)))
+        snapshot = self._snapshot
+        all_tags = list(request.phase_tags)
+
+        if not snapshot.has_heavy_rules:
+            service_verdict, global_verdict = self._evaluate(snapshot, request, all_tags)
+            return self._final(service_verdict, global_verdict, all_tags)
+
+        # True - сервисные, False - глобальные
+        deferred = {True: [], False: []}
+        service_verdict, global_verdict = self._evaluate(snapshot, request, all_tags, deferred)
+
+        if self.short_circuit:
+            # вердикт решён - из тяжёлых правил нужны только теги
+            if service_verdict == ActionType.ACCEPT:
+                deferred[True] = [rule for rule in deferred[True] if rule.tag_only]
+            if service_verdict is not None or global_verdict == ActionType.ACCEPT:
+                deferred[False] = [rule for rule in deferred[False] if rule.tag_only]
+
+        jobs = [(is_service, rule) for is_service, bucket in deferred.items() for rule in bucket]
+        if not jobs:
+            return self._final(service_verdict, global_verdict, all_tags)
+
+        results = await asyncio.gather(*(self._run_heavy(rule, request) for _, rule in jobs))
+        for (is_service, _), (verdict, tags) in zip(jobs, results):
+            all_tags.extend(tags)
+            if is_service:
+                service_verdict = _combine(service_verdict, verdict)
+            else:
+                global_verdict = _combine(global_verdict, verdict)
+
+        return self._final(service_verdict, global_verdict, all_tags)
+
+    def _get_heavy_pool(self) -> ProcessPoolExecutor:
+        if self._heavy_pool is None:
+            self._heavy_pool = ProcessPoolExecutor(
+                max_workers=self.heavy_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._heavy_pool
+
+    def _reset_heavy_pool(self, pool: ProcessPoolExecutor):
+        # зависшее правило не прервать изнутри, убиваем процессы пула целиком
+        if self._heavy_pool is pool:
+            self._heavy_pool = None
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _retire_heavy_pool(self, pool: ProcessPoolExecutor):
+        # новые задания идут в новый пул; старый убиваем, только когда остальные
+        # задания в нём дождались результата или своего дедлайна
+        if self._heavy_pool is pool:
+            self._heavy_pool = None
+        if pool not in self._retired_pools:
+            self._retired_pools.append(pool)
+
+    def _heavy_done(self, pool: ProcessPoolExecutor):
+        left = self._heavy_inflight.pop(pool) - 1
+        if left:
+            self._heavy_inflight[pool] = left
+        elif pool in self._retired_pools:
+            self._retired_pools.remove(pool)
+            self._reset_heavy_pool(pool)
+
+    def _heavy_fallback(self, rule: CompiledRule) -> Tuple[Optional[ActionType], List[str]]:
+        if self.heavy_fallback == ActionType.DROP:
+            return ActionType.DROP, [rule.name]
+        return None, []
+
+    async def _run_heavy(self, rule: CompiledRule, request: HttpRequest) -> Tuple[Optional[ActionType], List[str]]:
+        timeout = rule.timeout or self.heavy_timeout
+        loop = asyncio.get_running_loop()
+        pool = self._get_heavy_pool()
+        self._heavy_inflight[pool] = self._heavy_inflight.get(pool, 0) + 1
+        started = time.perf_counter()
+
+        try:
+            future = loop.run_in_executor(pool, run_rule_isolated, rule.path, rule.name, rule.digest, rule.source, request)
+            verdict, tags = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            elapsed = time.perf_counter() - started
+            logger.warning(f"Heavy rule {rule.path} missed its {timeout * 1000:.0f} ms deadline, "
+                           f"falling back to {self.heavy_fallback.value}")
+            self._retire_heavy_pool(pool)
+            rule.stats.record(elapsed, failed=True)
+            self._rule_over_budget(rule, elapsed)
+            return self._heavy_fallback(rule)
+        except (BrokenExecutor, asyncio.CancelledError) as e:
+            task = asyncio.current_task()
+            if isinstance(e, asyncio.CancelledError) and task is not None and task.cancelling():
+                # отменили сам запрос, а не задание в пуле
+                raise
+            # пул сломан (процесс умер) или закрыт - правило не выполнилось
+            logger.error(f"Heavy rule pool failed on {rule.path}: {e!r}, falling back to {self.heavy_fallback.value}")
+            self._retire_heavy_pool(pool)
+            rule.stats.record(time.perf_counter() - started, failed=True)
+            return self._heavy_fallback(rule)
+        except Exception as e:
+            # ошибка в самом правиле - как у обычных правил, вердикт и теги не учитываются
+            rule.stats.record(time.perf_counter() - started, failed=True)
+            logger.error(f"Error executing rule {rule.path}: {e}")
+            return None, []
+        finally:
+            self._heavy_done(pool)
+
+        # для heavy время включает пересылку запроса в пул
+        rule.stats.record(time.perf_counter() - started, verdict and verdict.value, bool(tags))
+        return verdict, tags
+
+    def close(self):
+        if self._heavy_pool is not None:
+            self._reset_heavy_pool(self._heavy_pool)
+        for pool in self._retired_pools:
+            self._reset_heavy_pool(pool)
+        self._retired_pools = []
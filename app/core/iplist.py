@@ -0,0 +1,201 @@
+import ipaddress
+import json
+import logging
+import os
+import re
+from typing import Dict, Iterable, List, Set, Tuple, Union
+from config import config
+
+logger = logging.getLogger(__name__)
+
+LIST_NAMES = ("block", "allow")
+
+# так выглядели правила, которые генерировал /api/rules/block_ip
+_LEGACY_BLOCK_RULE_RE = re.compile(r"^\s*if request\.client_ip == '([^']+)': action\.drop\(\)\s*$")
+
+IpNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+def parse_entry(entry: str) -> IpNetwork:
+    # одиночный адрес превращается в /32 (/128)
+    network = ipaddress.ip_network(entry.strip(), strict=False)
+    if network.version == 6 and network.prefixlen == 128 and network.network_address.ipv4_mapped:
+        network = ipaddress.ip_network(network.network_address.ipv4_mapped)
+    return network
+
+class IpSet:
+    """
+    Набор адресов и подсетей. Одиночные адреса лежат в обычном set, подсети -
+    в таблицах по длине префикса: проверка адреса = по одному хешу на каждую
+    встречающуюся длину префикса, а не перебор всех подсетей.
+    """
+
+    def __init__(self):
+        self._hosts: Set[Tuple[int, int]] = set()
+        # (версия, длина префикса) -> адреса сетей
+        self._prefixes: Dict[Tuple[int, int], Set[int]] = {}
+        self._entries: Dict[str, IpNetwork] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ip: str) -> bool:
+        return self.contains(ip)
+
+    def entries(self) -> List[str]:
+        return sorted(self._entries)
+
+    def add(self, network: IpNetwork) -> bool:
+        key = str(network)
+        if key in self._entries:
+            return False
+        self._entries[key] = network
+        if network.prefixlen == network.max_prefixlen:
+            self._hosts.add((network.version, int(network.network_address)))
+        else:
+            self._prefixes.setdefault((network.version, network.prefixlen), set()).add(int(network.network_address))
+        return True
+
+    def remove(self, network: IpNetwork) -> bool:
+        key = str(network)
+        if self._entries.pop(key, None) is None:
+            return False
+        if network.prefixlen == network.max_prefixlen:
+            self._hosts.discard((network.version, int(network.network_address)))
+        else:
+            bucket = self._prefixes.get((network.version, network.prefixlen))
+            if bucket is not None:
+                bucket.discard(int(network.network_address))
+                if not bucket:
+                    del self._prefixes[(network.version, network.prefixlen)]
+        return True
+
+    def contains(self, ip: str) -> bool:
+        if not self._entries:
+            return False
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+
+        value = int(addr)
+        version = addr.version
+        if (version, value) in self._hosts:
+            return True
+
+        max_len = addr.max_prefixlen
+        for (net_version, prefixlen), networks in self._prefixes.items():
+            if net_version != version:
+                continue
+            shift = max_len - prefixlen
+            if (value >> shift) << shift in networks:
+                return True
+        return False
+
+class IpAccessList:
+    """Блок/белый список адресов, проверяется прокси до подключения к сервису."""
+
+    def __init__(self, path: str = config.IP_LISTS_PATH):
+        self.path = path
+        self.lists: Dict[str, IpSet] = {name: IpSet() for name in LIST_NAMES}
+        self.load()
+
+    def is_blocked(self, ip: str) -> bool:
+        # белый список важнее блок-листа
+        if ip in self.lists["allow"]:
+            return False
+        return ip in self.lists["block"]
+
+    def add(self, list_name: str, entries: Iterable[str], save: bool = True) -> Tuple[List[str], List[str]]:
+        return self._update(list_name, entries, add=True, save=save)
+
+    def remove(self, list_name: str, entries: Iterable[str], save: bool = True) -> Tuple[List[str], List[str]]:
+        return self._update(list_name, entries, add=False, save=save)
+
+    def _update(self, list_name: str, entries: Iterable[str], add: bool, save: bool) -> Tuple[List[str], List[str]]:
+        if list_name not in self.lists:
+            raise ValueError(f"Unknown ip list: {list_name}")
+
+        target = self.lists[list_name]
+        changed, invalid = [], []
+        for entry in entries:
+            try:
+                network = parse_entry(str(entry))
+            except ValueError:
+                invalid.append(str(entry))
+                continue
+            if (target.add(network) if add else target.remove(network)):
+                changed.append(str(network))
+
+        if changed and save:
+            self.save()
+        return changed, invalid
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        return {name: ip_set.entries() for name, ip_set in self.lists.items()}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load ip lists {self.path}: {e}")
+            return
+
+        for name in LIST_NAMES:
+            _, invalid = self.add(name, data.get(name, []), save=False)
+            if invalid:
+                logger.warning(f"Skipped invalid {name} entries in {self.path}: {invalid}")
+
+    def reload(self):
+        # файл мог поменять другой процесс: собираем списки заново и подменяем целиком
+        fresh = IpAccessList.__new__(IpAccessList)
+        fresh.path = self.path
+        fresh.lists = {name: IpSet() for name in LIST_NAMES}
+        fresh.load()
+        self.lists = fresh.lists
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def migrate_rules(self, rules_dir: str) -> int:
+        """Переносит старые rules/dynamic/block_*.rule в блок-лист и удаляет их."""
+        dynamic_dir = os.path.join(rules_dir, "dynamic")
+        if not os.path.isdir(dynamic_dir):
+            return 0
+
+        migrated = []
+        for file in os.listdir(dynamic_dir):
+            if not (file.startswith("block_") and file.endswith(".rule")):
+                continue
+            path = os.path.join(dynamic_dir, file)
+            try:
+                with open(path, "r") as f:
+                    m = _LEGACY_BLOCK_RULE_RE.match(f.read())
+            except OSError:
+                continue
+            # правило правили руками - не трогаем
+            if not m:
+                continue
+            try:
+                network = parse_entry(m.group(1))
+            except ValueError:
+                continue
+            self.lists["block"].add(network)
+            migrated.append(path)
+
+        if migrated:
+            self.save()
+            for path in migrated:
+                os.remove(path)
+            logger.info(f"Migrated {len(migrated)} block_*.rule files into {self.path}")
+        return len(migrated)
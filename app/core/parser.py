@@ -1,63 +1,330 @@
-from typing import Optional, Dict, List, Union
+from typing import Callable, Optional, Deque, Dict, List, Tuple, Union
+from collections import deque
+from urllib.parse import parse_qsl
 from dataclasses import dataclass, field
 from enum import Enum
 import httptools
+from app.core.body import Body, BodyBuffer
+from app.core.views import MessageViews, MultiDict, UrlParts, parse_url, parse_cookies, parse_set_cookies, parse_multipart
+from config import config
 
 class ParserMode(Enum):
     REQUEST = "REQUEST"
     RESPONSE = "RESPONSE"
 
 @dataclass
-class HttpRequest:
+class HttpRequest(MessageViews):
     method: str = ""
     path: str = ""
     version: str = ""
+    # повторяющиеся заголовки склеены через ", ", по отдельности - в header_list/header_map
     headers: Dict[str, str] = field(default_factory=dict)
+    header_list: List[Tuple[str, str]] = field(default_factory=list)
     raw_headers: str = ""
-    body: bytes = b""
+    # bytes, большое тело - MappedBody (файл через mmap); правилам оно отдаётся как bytes
+    body: Body = b""
+    # тело длиннее BODY_MAX_SIZE, сохранено только начало
+    body_truncated: bool = False
     client_ip: str = "" 
     destination_port: int = 0 
+    keep_alive: bool = True
+    # границы сообщения в потоке соединения: [stream_start, stream_end)
+    stream_start: int = 0
+    stream_end: int = 0
+    # фаза правил, в которой запрос отклонён ("headers", "stream"), и теги ранних фаз
+    dropped_phase: str = ""
+    phase_tags: List[str] = field(default_factory=list)
+    # для "# @phase: stream": последний кусок тела вместе с хвостом предыдущих,
+    # window_start - смещение window[0] в теле
+    window: bytes = b""
+    window_start: int = 0
 
     @property
-    def data(self) -> str:
-        return self.body.decode('utf-8', errors='ignore')
+    def url(self) -> UrlParts:
+        return self._view("url", self.path, parse_url)
+
+    @property
+    def query(self) -> MultiDict:
+        return self._view("query", self.url, lambda url: MultiDict(parse_qsl(url.query, keep_blank_values=True)))
+
+    @property
+    def cookies(self) -> MultiDict:
+        return self._view("cookies", self.header_map, lambda headers: parse_cookies(headers.getall("cookie")))
+
+    def _form(self):
+        def build(body):
+            mime, params = self.content_type
+            if mime == "application/x-www-form-urlencoded":
+                return MultiDict(parse_qsl(self.data, keep_blank_values=True)), MultiDict()
+            if mime == "multipart/form-data" and params.get("boundary"):
+                return parse_multipart(body[:], params["boundary"])
+            return MultiDict(), MultiDict()
+        return self._view("form", self.body, build)
+
+    @property
+    def form(self) -> MultiDict:
+        """Поля urlencoded или multipart формы."""
+        return self._form()[0]
+
+    @property
+    def files(self) -> MultiDict:
+        """Файлы multipart формы: имя поля -> FormFile."""
+        return self._form()[1]
+
+    @property
+    def window_data(self) -> str:
+        return self.window.decode('utf-8', errors='ignore')
 
     def __repr__(self):
         return f"<HttpRequest {self.method} {self.path}>"
 
 @dataclass
-class HttpResponse:
+class HttpResponse(MessageViews):
     status_code: int = 0
     version: str = ""
     headers: Dict[str, str] = field(default_factory=dict)
+    header_list: List[Tuple[str, str]] = field(default_factory=list)
     raw_headers: str = ""
-    body: bytes = b""
+    body: Body = b""
+    body_truncated: bool = False
+    keep_alive: bool = True
+    stream_start: int = 0
+    stream_end: int = 0
+
+    @property
+    def cookies(self) -> MultiDict:
+        return self._view("cookies", self.header_map, lambda headers: parse_set_cookies(headers.getall("set-cookie")))
 
     def __repr__(self):
         return f"<HttpResponse {self.status_code}>"
 
+class HttpStreamError(httptools.HttpParserError):
+    """Поток дальше не разобрать; messages - сообщения, завершённые до ошибки."""
+
+    def __init__(self, message: str, messages: List[Union[HttpRequest, HttpResponse]] = ()):
+        super().__init__(message)
+        self.messages = list(messages)
+
+class HttpFramer:
+    """
+    Ищет конец каждого сообщения в потоке: httptools не сообщает смещений.
+    Разбирает только то, что нужно для длины (стартовая строка, Content-Length,
+    Transfer-Encoding: chunked). Тело без длины у ответа тянется до закрытия.
+    Ответу на HEAD тело не положено: методы запросов приходят в request_methods.
+    """
+
+    HEAD, BODY, CHUNK_SIZE, CHUNK_DATA, TRAILERS, UNTIL_CLOSE = range(6)
+
+    def __init__(self, mode: ParserMode):
+        self.mode = mode
+        self._state = self.HEAD
+        self._line = bytearray()
+        self._remaining = 0
+        # методы отправленных запросов, по одному на финальный ответ
+        self.request_methods: Deque[str] = deque()
+        # последний ответ - на HEAD: заголовки с длиной, а тела нет
+        self.head_response = False
+
+    def scan(self, data: bytes, pos: int) -> Optional[int]:
+        """Индекс в data сразу за концом текущего сообщения, None - конец ещё не пришёл."""
+        size = len(data)
+        while pos < size:
+            state = self._state
+
+            if state == self.HEAD:
+                if not self._line:
+                    # пустые строки между сообщениями парсер пропускает
+                    while pos < size and data[pos] in (13, 10):
+                        pos += 1
+                    if pos == size:
+                        return None
+                prev = len(self._line)
+                self._line += data[pos:]
+                idx = self._line.find(b"\r\n\r\n", max(0, prev - 3))
+                if idx < 0:
+                    return None
+                end = idx + 4
+                pos += end - prev
+                head = bytes(self._line[:end])
+                self._line = bytearray()
+                if self._start_body(head):
+                    return pos
+
+            elif state == self.BODY or state == self.CHUNK_DATA:
+                n = min(self._remaining, size - pos)
+                pos += n
+                self._remaining -= n
+                if not self._remaining:
+                    if state == self.BODY:
+                        self._state = self.HEAD
+                        return pos
+                    self._state = self.CHUNK_SIZE
+
+            elif state == self.CHUNK_SIZE or state == self.TRAILERS:
+                idx = data.find(b"\n", pos)
+                if idx < 0:
+                    self._line += data[pos:]
+                    return None
+                self._line += data[pos:idx + 1]
+                pos = idx + 1
+                line = bytes(self._line).strip()
+                self._line = bytearray()
+
+                if state == self.TRAILERS:
+                    if not line:
+                        self._state = self.HEAD
+                        return pos
+                    continue
+
+                chunk_size = int(line.split(b";", 1)[0].strip(), 16)
+                if chunk_size:
+                    # данные чанка и CRLF за ними
+                    self._remaining = chunk_size + 2
+                    self._state = self.CHUNK_DATA
+                else:
+                    self._state = self.TRAILERS
+
+            else:
+                return None
+        return None
+
+    def _start_body(self, head: bytes) -> bool:
+        """True - у сообщения нет тела."""
+        lines = head.split(b"\r\n")
+        content_length = None
+        chunked = False
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                content_length = int(value.strip())
+            elif name == b"transfer-encoding":
+                chunked = value.strip().lower().endswith(b"chunked")
+
+        self.head_response = False
+        if self.mode == ParserMode.RESPONSE:
+            status = int(lines[0].split()[1])
+            if 100 <= status < 200:
+                return True
+            method = self.request_methods.popleft() if self.request_methods else ""
+            if method == "HEAD":
+                self.head_response = True
+                return True
+            if status in (204, 304):
+                return True
+
+        if chunked:
+            self._state = self.CHUNK_SIZE
+            return False
+        if content_length:
+            self._remaining = content_length
+            self._state = self.BODY
+            return False
+        if content_length is not None or self.mode == ParserMode.REQUEST:
+            return True
+        self._state = self.UNTIL_CLOSE
+        return False
+
 class HttpStreamParser:
-    def __init__(self, mode: ParserMode = ParserMode.REQUEST):
+    """
+    on_headers(msg) вызывается, как только заголовки дочитаны (тело ещё пустое),
+    on_body_chunk(msg, chunk) - на каждый кусок тела. Оба вызываются синхронно
+    из feed; тело запроса, отклонённого на этих фазах, не копится.
+    Тело копится в BodyBuffer: в памяти не больше BODY_MEMORY_LIMIT.
+    """
+
+    def __init__(self, mode: ParserMode = ParserMode.REQUEST,
+                 on_headers: Optional[Callable[[Union[HttpRequest, HttpResponse]], None]] = None,
+                 on_body_chunk: Optional[Callable[[Union[HttpRequest, HttpResponse], bytes], None]] = None,
+                 body_memory_limit: int = config.BODY_MEMORY_LIMIT, body_max_size: int = config.BODY_MAX_SIZE):
         self.mode = mode
+        self.body_memory_limit = body_memory_limit
+        self.body_max_size = body_max_size
         self.completed_messages: List[Union[HttpRequest, HttpResponse]] = []
+        self.on_headers = on_headers
+        self.on_body_chunk = on_body_chunk
+        # сообщение с дочитанными заголовками, тело которого ещё идёт
+        self.current: Optional[Union[HttpRequest, HttpResponse]] = None
 
 
         self._current_headers = {}
+        self._current_header_list = []
         self._current_raw_headers = []
-        self._current_body = b""
+        self._current_body = BodyBuffer(self.body_memory_limit, self.body_max_size)
         self._current_url = b"" 
         self._current_status_code = 0 
+        # между on_message_begin и on_message_complete
+        self.in_message = False
 
-        if mode == ParserMode.REQUEST:
-            self._parser = httptools.HttpRequestParser(self)
-        else:
-            self._parser = httptools.HttpResponseParser(self)
+        self._framer = HttpFramer(mode)
+        # сколько байт потока разобрано и где началось текущее сообщение
+        self._offset = 0
+        self._message_start = 0
+        # после ошибки поток дальше не разбирается
+        self.error: Optional[str] = None
+
+        self._parser = self._new_parser()
+
+    def _new_parser(self):
+        if self.mode == ParserMode.REQUEST:
+            return httptools.HttpRequestParser(self)
+        return httptools.HttpResponseParser(self)
+
+    def expect_response(self, method: str):
+        """Запрос с этим методом ушёл сервису: от метода зависит, есть ли у ответа тело."""
+        self._framer.request_methods.append(method)
 
     def feed(self, data: bytes) -> List[Union[HttpRequest, HttpResponse]]:
+        """
+        Сообщения, завершённые в data. При ошибке - HttpStreamError, в messages
+        которой сообщения, завершённые до неё: их границы точны, а поток после
+        последней границы не разобрать.
+        """
+        if self.error is not None:
+            raise HttpStreamError(self.error)
+        # данные режутся по концам сообщений, и каждый кусок должен завершить
+        # в httptools ровно одно сообщение - так у сообщений точные смещения
+        data = bytes(data)
+        view = memoryview(data)
+        pos = 0
+        finished = 0
         try:
-            self._parser.feed_data(data)
-        except httptools.HttpParserError:
-            raise
+            while pos < len(data):
+                try:
+                    end = self._framer.scan(data, pos)
+                except (ValueError, IndexError) as e:
+                    raise httptools.HttpParserError(f"Bad message framing: {e}")
+
+                stop = len(data) if end is None else end
+                completed = len(self.completed_messages)
+                self._parser.feed_data(view[pos:stop])
+                self._offset += stop - pos
+                pos = stop
+
+                done = len(self.completed_messages) - completed
+                if end is None:
+                    if done:
+                        raise httptools.HttpParserError("Message boundary mismatch")
+                    continue
+                if self._framer.head_response and not done and self.in_message:
+                    # httptools о HEAD не знает и ждёт тело по Content-Length:
+                    # сообщение завершается здесь, парсер начинает заново
+                    self.on_message_complete()
+                    self._parser = self._new_parser()
+                    done = 1
+                if done != 1 or self.in_message:
+                    raise httptools.HttpParserError("Message boundary mismatch")
+
+                msg = self.completed_messages[-1]
+                msg.stream_start = self._message_start
+                msg.stream_end = self._offset
+                self._message_start = self._offset
+                finished += 1
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+            results = self.completed_messages[:finished]
+            self.completed_messages = []
+            raise HttpStreamError(self.error, results) from e
 
         results = self.completed_messages
         self.completed_messages = []
@@ -65,11 +332,14 @@ class HttpStreamParser:
 
 
     def on_message_begin(self):
+        self.in_message = True
         self._current_headers = {}
+        self._current_header_list = []
         self._current_raw_headers = []
         self._current_url = b""
-        self._current_body = b""
+        self._current_body = BodyBuffer(self.body_memory_limit, self.body_max_size)
         self._current_status_code = 0
+        self.current = None
 
     def on_url(self, url: bytes):
         self._current_url += url
@@ -81,18 +351,17 @@ class HttpStreamParser:
     def on_header(self, name: bytes, value: bytes):
         key = name.decode('utf-8', errors='replace')
         val = value.decode('utf-8', errors='replace')
-        self._current_headers[key] = val
+        if key in self._current_headers:
+            # дубликат не затирает первое значение, а склеивается с ним
+            self._current_headers[key] += ", " + val
+        else:
+            self._current_headers[key] = val
+        self._current_header_list.append((key, val))
         self._current_raw_headers.append(f"{key}: {val}")
 
     def on_headers_complete(self):
-        #!!потом
-        pass
-
-    def on_body(self, body: bytes):
-        self._current_body += body
-
-    def on_message_complete(self):
         version = self._parser.get_http_version()
+        keep_alive = self._parser.should_keep_alive()
 
         if self.mode == ParserMode.REQUEST:
             msg = HttpRequest(
@@ -100,16 +369,39 @@ class HttpStreamParser:
                 path=self._current_url.decode('utf-8', errors='replace'),
                 version=version,
                 headers=self._current_headers,
+                header_list=self._current_header_list,
                 raw_headers="\r\n".join(self._current_raw_headers),
-                body=self._current_body
+                keep_alive=keep_alive
             )
         else:
             msg = HttpResponse(
                 status_code=self._parser.get_status_code(),
                 version=version,
                 headers=self._current_headers,
+                header_list=self._current_header_list,
                 raw_headers="\r\n".join(self._current_raw_headers),
-                body=self._current_body
+                keep_alive=keep_alive
             )
+        msg.stream_start = self._message_start
+        self.current = msg
+
+        if self.on_headers is not None:
+            self.on_headers(msg)
+
+    def on_body(self, body: bytes):
+        msg = self.current
+        if getattr(msg, "dropped_phase", ""):
+            # запрос уже отклонён, тело только пропускаем
+            return
+        self._current_body.append(body)
+        if self.on_body_chunk is not None:
+            self.on_body_chunk(msg, body)
+
+    def on_message_complete(self):
+        self.in_message = False
+        msg = self.current
+        self.current = None
+        msg.body = self._current_body.getvalue()
+        msg.body_truncated = self._current_body.truncated
 
         self.completed_messages.append(msg)
@@ -1,27 +1,96 @@
 import asyncio
+import http
 import logging
-from typing import Optional
+from collections import deque
+from typing import Deque, List, Optional, Tuple, Union
 from app.core.parser import HttpStreamParser, ParserMode, HttpRequest, HttpResponse
 from app.core.logger import format_http_message
 from app.core.session import SessionManager
 from app.core.engine import RuleEngine, ActionType
+from app.core.iplist import IpAccessList
+from app.core.upstream import UpstreamPool, UpstreamConnection
+from app.core.relay import RelayProtocol, HttpInspector, link
+from config import config
 
 logger = logging.getLogger(__name__)
 
 class TcpProxy:
-    def __init__(self, listen_host: str, listen_port: int, target_host: str, target_port: int):
+    def __init__(self, listen_host: str, listen_port: int, target_host: str, target_port: int,
+                 upstream_pool: Optional[bool] = None, reuse_port: bool = False):
         self.listen_host = listen_host
         self.listen_port = listen_port
         self.target_host = target_host
         self.target_port = target_port
         self.server = None
+        # несколько процессов-воркеров слушают один порт, ядро раздаёт им соединения
+        self.reuse_port = reuse_port
+        self.ip_list = IpAccessList()
+        # старые block_*.rule переезжают в блок-лист до загрузки правил
+        self.ip_list.migrate_rules("rules")
         self.rule_engine = RuleEngine() 
 
+        # HTTP-режим: соединения к сервису переиспользуются между клиентами
+        if config.UPSTREAM_POOL if upstream_pool is None else upstream_pool:
+            self.upstream_pool = UpstreamPool(
+                target_host, target_port,
+                max_size=config.UPSTREAM_POOL_SIZE,
+                idle_timeout=config.UPSTREAM_POOL_IDLE_TIMEOUT
+            )
+        else:
+            self.upstream_pool = None
+
+        self._drop_response = self._build_drop_response(config.DROP_RESPONSE_STATUS, config.DROP_RESPONSE_BODY)
+
+    @staticmethod
+    def _build_drop_response(status: int, body: str) -> Optional[Tuple[bytes, bytes]]:
+        if not status:
+            return None
+        try:
+            reason = http.HTTPStatus(status).phrase
+        except ValueError:
+            reason = "Blocked"
+        payload = body.encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+        ).encode("utf-8")
+        return head, payload
+
+    def drop_response(self, msg: HttpRequest) -> Optional[bytes]:
+        """Ответ клиенту на отклонённый запрос. None - по-старому закрыть соединение."""
+        if self._drop_response is None:
+            return None
+        head, payload = self._drop_response
+        if not msg.keep_alive:
+            head += b"Connection: close\r\n"
+        return head + b"\r\n" + payload
+
+    def request_parser(self, client_ip: str) -> HttpStreamParser:
+        """Парсер запросов клиента: правила ранних фаз срабатывают прямо при разборе."""
+        def on_headers(msg: HttpRequest):
+            msg.client_ip = client_ip
+            msg.destination_port = self.target_port
+            if self.rule_engine.evaluate_headers(msg):
+                logger.warning(f"[Client->Target] Rejected on headers: {msg.method} {msg.path}")
+
+        return HttpStreamParser(mode=ParserMode.REQUEST, on_headers=on_headers,
+                                on_body_chunk=self.rule_engine.evaluate_chunk)
+
     async def start(self):
-        self.server = await asyncio.start_server(
-            self.handle_client, self.listen_host, self.listen_port
-        )
+        if self.upstream_pool is not None:
+            self.server = await asyncio.start_server(
+                self.handle_client, self.listen_host, self.listen_port, reuse_port=self.reuse_port or None
+            )
+        else:
+            loop = asyncio.get_running_loop()
+            self.server = await loop.create_server(
+                lambda: RelayProtocol(on_connect=self.handle_relay), self.listen_host, self.listen_port,
+                reuse_port=self.reuse_port or None
+            )
         logger.info(f"Proxy listening on {self.listen_host}:{self.listen_port} -> {self.target_host}:{self.target_port}")
+        if self.upstream_pool is not None:
+            self.upstream_pool.start()
         async with self.server:
             await self.server.serve_forever()
 
@@ -31,53 +100,326 @@ class TcpProxy:
 
         client_ip, client_port = peer_name[0], peer_name[1]
 
-        target_reader, target_writer = await self.connect_to_target()
-        if not target_reader or not target_writer:
+        if self.ip_list.is_blocked(client_ip):
+            logger.warning(f"Connection from {client_ip} rejected by ip blocklist")
             client_writer.close()
             return
 
+        await self.handle_http_client(client_reader, client_writer, client_ip, client_port)
+        logger.info(f"Connection closed for {peer_name}")
+
+    async def handle_relay(self, client: RelayProtocol):
+        peer_name = client.transport.get_extra_info('peername')
+        logger.info(f"New connection from {peer_name}")
+
+        client_ip, client_port = peer_name[0], peer_name[1]
+
+        if self.ip_list.is_blocked(client_ip):
+            logger.warning(f"Connection from {client_ip} rejected by ip blocklist")
+            client.close()
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            _, target = await loop.create_connection(RelayProtocol, self.target_host, self.target_port)
+        except Exception as e:
+            logger.error(f"Failed to connect to target {self.target_host}:{self.target_port}: {e}")
+            client.close()
+            return
 
         stream_id = await SessionManager.start_stream(
             client_ip, client_port, self.target_host, self.target_port
         )
 
+        # очередь ответов клиенту в порядке запросов: None - ждём ответ сервиса,
+        # (байты, закрыть) - свой ответ на отклонённый запрос
+        replies: Deque[Optional[Tuple[bytes, bool]]] = deque()
+        # False - ответы идут passthrough и порядок уже не отследить
+        ordered = True
+
+        def send_reply(reply: bytes, close: bool):
+            client.write(reply)
+            if close:
+                client.close()
+                target.close()
+
+        async def check_request(msg: HttpRequest) -> bool:
+            if not await self.inspect_message(msg, "Client->Target", stream_id, client_ip):
+                if ordered:
+                    replies.append(None)
+                # у ответа на HEAD заголовки с длиной, но без тела
+                responses.parser.expect_response(msg.method)
+                return False
+
+            reply = self.drop_response(msg)
+            if reply is None:
+                client.close()
+                target.close()
+            elif replies:
+                # на конвейере ответ уйдёт после ответов на предыдущие запросы
+                replies.append((reply, not msg.keep_alive))
+            else:
+                send_reply(reply, not msg.keep_alive)
+            return True
+
+        async def check_response(msg: HttpResponse) -> bool:
+            return await self.inspect_message(msg, "Target->Client", stream_id)
+
+        def response_forwarded(msg: HttpResponse):
+            # 1xx - промежуточные, финальный ответ ещё впереди
+            if 100 <= msg.status_code < 200 or not replies:
+                return
+            replies.popleft()
+            while replies and replies[0] is not None:
+                send_reply(*replies.popleft())
+
+        def response_passthrough():
+            # границ ответов дальше не видно: ответы на отклонённые запросы
+            # отправляются сразу, иначе они ждали бы вечно
+            nonlocal ordered
+            ordered = False
+            while replies:
+                reply = replies.popleft()
+                if reply is not None:
+                    send_reply(*reply)
+
         #парсеры
-        req_parser = HttpStreamParser(mode=ParserMode.REQUEST)
-        res_parser = HttpStreamParser(mode=ParserMode.RESPONSE)
+        requests = HttpInspector(client, self.request_parser(client_ip), "Client->Target", check_request)
+        responses = HttpInspector(target, HttpStreamParser(mode=ParserMode.RESPONSE), "Target->Client", check_response,
+                                  on_forwarded=response_forwarded, on_passthrough=response_passthrough)
+        link(client, target)
+
+        try:
+            await asyncio.wait([client.closed, target.closed], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            requests.cancel()
+            responses.cancel()
+            await SessionManager.close_stream(stream_id)
+
+            logger.info(f"Connection closed for {peer_name}")
+            client.close()
+            target.close()
+
+    async def inspect_message(self, msg: Union[HttpRequest, HttpResponse], direction: str,
+                              stream_id: int, client_ip: str = "") -> bool:
+        """Правила и логирование разобранного сообщения. True - запрос заблокирован."""
+        # примененеи правил
+        verdict_tags = []
+
+        if isinstance(msg, HttpRequest):
+            msg.client_ip = client_ip
+            msg.destination_port = self.target_port
+            action = await self.rule_engine.evaluate_async(msg)
+            verdict_tags = action.tags
+
+            if action.type == ActionType.DROP:
+                logger.warning(f"[{direction}] BLOCKED by Rule. Tags: {verdict_tags}")
+                await SessionManager.log_request(stream_id, msg, verdict_tags)
+                await SessionManager.update_session_alert(stream_id, 2) #ставим отметку что блок
+                return True
+
+        formatted_log = format_http_message(msg)
+        logger.info(f"\n{'-'*40}\nHTTP CAPTURE [{direction}]:\n{formatted_log}\n{'-'*40}")
+
+        if isinstance(msg, HttpRequest):
+            await SessionManager.log_request(stream_id, msg, verdict_tags)
+        elif isinstance(msg, HttpResponse):
+            await SessionManager.log_response(stream_id, msg, verdict_tags)
+        return False
+
+    async def inspect_messages(self, messages: List[Union[HttpRequest, HttpResponse]], direction: str,
+                               stream_id: int, client_ip: str = "") -> bool:
+        for msg in messages:
+            if await self.inspect_message(msg, direction, stream_id, client_ip):
+                return True
+        return False
+
+    async def handle_http_client(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter,
+                                 client_ip: str, client_port: int):
+        """
+        HTTP-режим с пулом: запрос целиком проверяется правилами, затем уходит в
+        соединение из пула, ответ дочитывается до конца. Клиент держит одно
+        соединение к сервису, при отключении оно возвращается в пул, если
+        последний обмен завершился чисто и обе стороны за keep-alive.
+        Запросы на конвейере обрабатываются по одному. Отклонённый запрос
+        получает свой ответ, соединения остаются открытыми.
+        Всё, что не укладывается в эту схему (не HTTP, HEAD, upgrade),
+        досылается как обычный поток на закреплённом соединении.
+        """
+        stream_id = await SessionManager.start_stream(
+            client_ip, client_port, self.target_host, self.target_port
+        )
+        req_parser = self.request_parser(client_ip)
+        upstream: Optional[UpstreamConnection] = None
+        # соединение можно вернуть в пул
+        reusable = False
+        buffer = bytearray()
+        # смещение начала buffer в потоке клиента
+        base = 0
+
+        try:
+            while True:
+                data = await client_reader.read(4096)
+                if not data:
+                    break
+                buffer += data
+
+                try:
+                    requests = req_parser.feed(data)
+                except Exception:
+                    requests = None
+
+                # длинное тело копится до конца сообщения, но не больше MAX_BUFFER
+                if requests is None or (not requests and len(buffer) > 4096
+                                        and (req_parser.current is None or len(buffer) > HttpInspector.MAX_BUFFER)):
+                    # не HTTP или слишком длинное сообщение - дальше как простой поток
+                    if upstream is None:
+                        upstream = await self.upstream_pool.acquire()
+                        if upstream is None:
+                            return
+                    reusable = False
+                    upstream.writer.write(bytes(buffer))
+                    await upstream.writer.drain()
+                    await self._passthrough(client_reader, client_writer, upstream, stream_id, client_ip, None, None)
+                    return
+
+                for i, msg in enumerate(requests):
+                    raw = bytes(buffer[:msg.stream_end - base])
+                    del buffer[:msg.stream_end - base]
+                    base = msg.stream_end
+
+                    if await self.inspect_message(msg, "Client->Target", stream_id, client_ip):
+                        reply = self.drop_response(msg)
+                        if reply is None:
+                            return
+                        client_writer.write(reply)
+                        await client_writer.drain()
+                        if not msg.keep_alive:
+                            return
+                        continue
 
+                    if upstream is None:
+                        upstream = await self.upstream_pool.acquire()
+                        if upstream is None:
+                            return
+                    reusable = False
+
+                    if msg.method == "HEAD":
+                        # у ответа нет тела, а парсер ответов о методе не знает -
+                        # границ ответов не отследить, соединение закрепляется за клиентом
+                        if await self.inspect_messages(requests[i + 1:], "Client->Target", stream_id, client_ip):
+                            return
+                        upstream.writer.write(raw + bytes(buffer))
+                        await upstream.writer.drain()
+                        await self._passthrough(client_reader, client_writer, upstream, stream_id, client_ip,
+                                                req_parser, None)
+                        return
+
+                    res_parser = HttpStreamParser(mode=ParserMode.RESPONSE)
+                    result = await self._exchange(upstream, raw, 1, res_parser, client_writer, stream_id)
+                    if result == "stale":
+                        self.upstream_pool.discard_stale(upstream)
+                        upstream = await self.upstream_pool.connect()
+                        if upstream is None:
+                            return
+                        res_parser = HttpStreamParser(mode=ParserMode.RESPONSE)
+                        result = await self._exchange(upstream, raw, 1, res_parser, client_writer, stream_id)
+
+                    if result != "keep-alive" or not msg.keep_alive:
+                        return
+                    upstream.reused = False
+                    reusable = True
+
+                current = req_parser.current
+                if current is not None and current.dropped_phase:
+                    # отклонён по заголовкам, тело не нужно
+                    base += len(buffer)
+                    buffer.clear()
 
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error in http client loop: {e}")
+        finally:
+            await SessionManager.close_stream(stream_id)
+            client_writer.close()
+            if upstream is not None:
+                if reusable:
+                    self.upstream_pool.release(upstream)
+                else:
+                    upstream.close()
+
+    async def _exchange(self, upstream: UpstreamConnection, data: bytes, expected: int, parser: HttpStreamParser,
+                        client_writer: asyncio.StreamWriter, stream_id: int) -> str:
+        """
+        Отправляет запросы и пересылает клиенту ответы, пока не придут все expected.
+        "keep-alive" - соединение можно использовать дальше, "close" - нет,
+        "stale" - соединение из пула оказалось закрытым и ответа не было.
+        """
+        try:
+            upstream.writer.write(data)
+            await upstream.writer.drain()
+        except ConnectionError:
+            return "stale" if upstream.reused else "close"
+
+        received = 0
+        keep_alive = True
+        while expected > 0:
+            try:
+                chunk = await upstream.reader.read(65536)
+            except ConnectionError:
+                chunk = b""
+            if not chunk:
+                return "stale" if upstream.reused and received == 0 else "close"
+            received += len(chunk)
+
+            try:
+                responses = parser.feed(chunk)
+            except Exception:
+                # ответ не разобрать - переслать как есть и больше соединение не трогать
+                client_writer.write(chunk)
+                await client_writer.drain()
+                return "close"
+
+            client_writer.write(chunk)
+            await client_writer.drain()
+
+            for msg in responses:
+                # 1xx - промежуточные, финальный ответ ещё впереди
+                if 100 <= msg.status_code < 200:
+                    continue
+                expected -= 1
+                keep_alive = keep_alive and msg.keep_alive
+                formatted_log = format_http_message(msg)
+                logger.info(f"\n{'-'*40}\nHTTP CAPTURE [Target->Client]:\n{formatted_log}\n{'-'*40}")
+                await SessionManager.log_response(stream_id, msg, [])
+
+        if parser.in_message:
+            # после ответа пришло что-то лишнее
+            return "close"
+        return "keep-alive" if keep_alive else "close"
+
+    async def _passthrough(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter,
+                           upstream: UpstreamConnection, stream_id: int, client_ip: str,
+                           req_parser: Optional[HttpStreamParser], res_parser: Optional[HttpStreamParser]):
         client_to_target = asyncio.create_task(
-            self.pipe(client_reader, target_writer, "Client->Target", req_parser, stream_id, client_ip)
+            self.pipe(client_reader, upstream.writer, "Client->Target", req_parser, stream_id, client_ip)
         )
         target_to_client = asyncio.create_task(
-            self.pipe(target_reader, client_writer, "Target->Client", res_parser, stream_id)
+            self.pipe(upstream.reader, client_writer, "Target->Client", res_parser, stream_id)
         )
-
         done, pending = await asyncio.wait(
             [client_to_target, target_to_client],
             return_when=asyncio.FIRST_COMPLETED
         )
-
         for task in pending:
             task.cancel()
 
-        await SessionManager.close_stream(stream_id)
-
-        logger.info(f"Connection closed for {peer_name}")
-        client_writer.close()
-        target_writer.close()
-
-    async def connect_to_target(self) -> tuple[Optional[asyncio.StreamReader], Optional[asyncio.StreamWriter]]:
-        try:
-            reader, writer = await asyncio.open_connection(self.target_host, self.target_port)
-            return reader, writer
-        except Exception as e:
-            logger.error(f"Failed to connect to target {self.target_host}:{self.target_port}: {e}")
-            return None, None
-
     async def pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, direction: str, parser: Optional[HttpStreamParser] = None, stream_id: int = -1, client_ip: str = ""):
         try:
-            buffer = b""
+            buffer = bytearray()
             MAX_BUFFER = 10 * 1024 * 1024 # 10 мб на буфер для защиты от переполнения
             parser_failed = False
 
@@ -89,7 +431,7 @@ class TcpProxy:
                 if parser and not parser_failed:
 
                     # 1. в буфер всё
-                    buffer += data
+                    buffer.extend(data)
 
                     # 2. парсинг
                     try:
@@ -99,62 +441,32 @@ class TcpProxy:
                         parser_failed = True
                         writer.write(buffer)
                         await writer.drain()
-                        buffer = b""
+                        buffer = bytearray()
                         continue
 
                     # 3. проверяем паршенные сообщения
                     if messages:
-                        for msg in messages:
-                            # примененеи правил
-                            verdict_tags = []
-                            blocked = False
-
-                            if isinstance(msg, HttpRequest):
-                                msg.client_ip = client_ip
-                                msg.destination_port = self.target_port
-                                action = self.rule_engine.evaluate(msg)
-                                verdict_tags = action.tags
-
-                                if action.type == ActionType.DROP:
-                                    logger.warning(f"[{direction}] BLOCKED by Rule. Tags: {verdict_tags}")
-                                    await SessionManager.log_request(stream_id, msg, verdict_tags)
-                                    await SessionManager.update_session_alert(stream_id, 2) #ставим отметку что блок
-                                    return 
-
-                                blocked = False 
-
-                            
-                            formatted_log = format_http_message(msg)
-                            logger.info(f"\n{'-'*40}\nHTTP CAPTURE [{direction}]:\n{formatted_log}\n{'-'*40}")
-
-                            if isinstance(msg, HttpRequest):
-                                await SessionManager.log_request(stream_id, msg, verdict_tags)
-                            elif isinstance(msg, HttpResponse):
-                                await SessionManager.log_response(stream_id, msg, verdict_tags)
-
-
+                        if await self.inspect_messages(messages, direction, stream_id, client_ip):
+                            return
 
                         #в идеале пропускать только распаршенное, но потом, пока весь буфер шлём
-
-
-
                         writer.write(buffer)
                         await writer.drain()
-                        buffer = b""
+                        buffer = bytearray()
                     else:
 
                         if len(buffer) > MAX_BUFFER:
                             logger.warning(f"[{direction}] !!Buf overflow ({len(buffer)} bytes). ") #переполнение
                             writer.write(buffer)
                             await writer.drain()
-                            buffer = b""
+                            buffer = bytearray()
 
                         if len(buffer) > 4096:
                              logger.warning(f"[{direction}] Parsing timeout (buff > 4KB without headers).") 
                              parser_failed = True
                              writer.write(buffer)
                              await writer.drain()
-                             buffer = b""
+                             buffer = bytearray()
                 else:
                     #пропуск, если лег парсер
                     writer.write(data)
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, Union
+from app.core.parser import HttpStreamParser, ParserMode, HttpRequest, HttpResponse
+from config import config
+
+logger = logging.getLogger(__name__)
+
+Message = Union[HttpRequest, HttpResponse]
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """
+    Одна сторона ретранслятора. Читает в заранее выделенный буфер и отдаёт
+    срез memoryview либо напрямую в транспорт пира (passthrough), либо в on_data
+    (инспекция). Чтение с этой стороны приостанавливается, когда буфер записи
+    пира переполнен, и пока идёт проверка правилами.
+    """
+
+    def __init__(self, on_connect: Optional[Callable[["RelayProtocol"], Awaitable[None]]] = None,
+                 buffer_size: int = config.RELAY_BUFFER_SIZE):
+        self._buffer_size = buffer_size
+        self._view = memoryview(bytearray(buffer_size))
+        self._on_connect = on_connect
+        self._connect_task: Optional[asyncio.Task] = None
+
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer: Optional["RelayProtocol"] = None
+        # None - пересылать как есть
+        self.on_data: Optional[Callable[[memoryview], None]] = None
+        # вызывается на EOF до того, как он будет передан пиру
+        self.on_eof: Optional[Callable[[], None]] = None
+        self.eof = False
+
+        # до связывания с пиром читать некуда
+        self._pause_reasons = {"connect"}
+        self.closed: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.pause_reading()
+        if self._on_connect is not None:
+            self._connect_task = asyncio.create_task(self._on_connect(self))
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        # пир больше не пишет в нас - снимаем с него паузу
+        if self.peer is not None:
+            self.peer.resume_reading("backpressure")
+
+    def eof_received(self):
+        self.eof = True
+        if self.on_eof is not None:
+            self.on_eof()
+
+        # полузакрытие: пир дописывает ответ, соединение рвём, когда закроются обе стороны
+        peer = self.peer
+        if peer is None or peer.eof or peer.transport is None or not peer.transport.can_write_eof():
+            self._finish()
+            return False
+        if not peer.transport.is_closing():
+            peer.transport.write_eof()
+        return True
+
+    def _finish(self):
+        for side in (self, self.peer):
+            if side is not None and not side.closed.done():
+                side.closed.set_result(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._view
+
+    def buffer_updated(self, nbytes: int):
+        chunk = self._view[:nbytes]
+        if self.on_data is not None:
+            self.on_data(chunk)
+            return
+
+        transport = self.peer.transport
+        transport.write(chunk)
+        if transport.get_write_buffer_size():
+            # транспорт мог оставить у себя ссылку на наш буфер - читаем дальше в новый
+            self._view = memoryview(bytearray(self._buffer_size))
+
+    def pause_writing(self):
+        if self.peer is not None:
+            self.peer.pause_reading("backpressure")
+
+    def resume_writing(self):
+        if self.peer is not None:
+            self.peer.resume_reading("backpressure")
+
+    def pause_reading(self, reason: str):
+        if not self._pause_reasons and self.transport is not None and not self.transport.is_closing():
+            self.transport.pause_reading()
+        self._pause_reasons.add(reason)
+
+    def resume_reading(self, reason: str):
+        if reason not in self._pause_reasons:
+            return
+        self._pause_reasons.discard(reason)
+        if not self._pause_reasons and self.transport is not None and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def write(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+def link(a: RelayProtocol, b: RelayProtocol):
+    a.peer = b
+    b.peer = a
+    a.resume_reading("connect")
+    b.resume_reading("connect")
+
+class HttpInspector:
+    """
+    Инспекция одного направления. Данные копятся в bytearray (без квадратичного
+    bytes +=), пир получает ровно байты сообщений, пропущенных handler'ом;
+    байты отклонённого сообщения выбрасываются, соединение остаётся открытым.
+    Пока handler работает, чтение с источника на паузе.
+    Тело больше stream_threshold уходит пиру по мере чтения, последний байт
+    ждёт вердикта; если сообщение всё же отклонено, соединение закрывается.
+    Тело запроса, отклонённого по заголовкам, выбрасывается не копясь.
+    Если поток не HTTP или сообщение не собирается - дальше чистый passthrough;
+    сообщения, завершённые до ошибки разбора, всё равно проверяются,
+    а без проверки уходят только байты за последним из них.
+    """
+
+    MAX_BUFFER = 10 * 1024 * 1024 # 10 мб на буфер для защиты от переполнения
+    MAX_PENDING_HEADERS = 4096
+
+    def __init__(self, source: RelayProtocol, parser: HttpStreamParser, direction: str,
+                 handler: Callable[[Message], Awaitable[bool]],
+                 on_forwarded: Optional[Callable[[Message], None]] = None,
+                 stream_threshold: int = config.STREAM_BODY_THRESHOLD,
+                 on_passthrough: Optional[Callable[[], None]] = None):
+        self.source = source
+        self.parser = parser
+        self.direction = direction
+        # True - сообщение не пропускать
+        self.handler = handler
+        self.on_forwarded = on_forwarded
+        # зовётся один раз, когда направление переходит в passthrough
+        self.on_passthrough = on_passthrough
+        self.stream_threshold = stream_threshold
+
+        self.pending = bytearray()
+        # смещение начала pending в потоке
+        self._base = 0
+        self._queue: Deque[Message] = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._passthrough_after = False
+        # сообщение, начало которого уже отправлено пиру
+        self._streaming: Optional[Message] = None
+
+        source.on_data = self.feed
+        source.on_eof = self.eof
+
+    def feed(self, chunk: memoryview):
+        self.pending += chunk
+
+        try:
+            messages = self.parser.feed(chunk)
+        except Exception as e:
+            # возможно не хттп, не парсится. Завершённые до ошибки сообщения
+            # проверяются как обычно, passthrough - после них
+            messages = getattr(e, "messages", None)
+            if messages:
+                self._queue.extend(messages)
+                self._passthrough_after = True
+                if self._task is None:
+                    self._start_processing()
+                return
+            self.passthrough()
+            return
+
+        if messages:
+            self._queue.extend(messages)
+            if self._task is None:
+                self._start_processing()
+            return
+
+        if self._task is not None:
+            return
+
+        if self._stream_current():
+            return
+
+        if len(self.pending) > self.MAX_BUFFER:
+            logger.warning(f"[{self.direction}] !!Buf overflow ({len(self.pending)} bytes). ") #переполнение
+            self._flush(len(self.pending))
+
+        # заголовки дочитаны - дальше просто длинное тело
+        if self.parser.current is None and len(self.pending) > self.MAX_PENDING_HEADERS:
+            logger.warning(f"[{self.direction}] Parsing timeout (buff > 4KB without headers).")
+            self.passthrough()
+
+    def _start_processing(self):
+        self.source.pause_reading("inspect")
+        self._task = asyncio.create_task(self._process())
+
+    def passthrough(self):
+        if self._task is not None:
+            self._passthrough_after = True
+            return
+        self._flush(len(self.pending))
+        self.source.on_data = None
+        if self.on_passthrough is not None:
+            self.on_passthrough()
+
+    def _flush(self, size: int):
+        if not size:
+            return
+        if size == len(self.pending):
+            # отдаём буфер целиком и начинаем новый, без копирования
+            self.source.peer.write(self.pending)
+            self.pending = bytearray()
+        else:
+            self.source.peer.write(bytes(memoryview(self.pending)[:size]))
+            del self.pending[:size]
+        self._base += size
+
+    def _discard(self, size: int):
+        del self.pending[:size]
+        self._base += size
+
+    def _stream_current(self) -> bool:
+        # зовётся, когда очередь пуста: всё в pending - недочитанное текущее сообщение
+        msg = self.parser.current
+        if msg is None:
+            return False
+
+        if getattr(msg, "dropped_phase", ""):
+            self._discard(len(self.pending))
+            if msg is self._streaming:
+                # начало уже у пира: вердикт сразу, не дожидаясь конца тела
+                self._queue.append(msg)
+                self._start_processing()
+            return True
+
+        if msg is self._streaming or (self.stream_threshold and len(self.pending) > self.stream_threshold):
+            self._streaming = msg
+            # сообщение у пира не завершится, пока не вынесен вердикт
+            self._flush(max(len(self.pending) - 1, 0))
+            return True
+        return False
+
+    async def _process(self):
+        try:
+            while self._queue:
+                msg = self._queue.popleft()
+                rejected = await self.handler(msg)
+                if self.source.transport.is_closing():
+                    return
+
+                # начало следующего сообщения ждёт своей проверки
+                size = msg.stream_end - self._base
+                if msg is self._streaming:
+                    self._streaming = None
+                    if rejected:
+                        # начало уже у пира, отозвать его нельзя - рвём соединение
+                        logger.warning(f"[{self.direction}] Streamed message rejected, closing connection")
+                        self.source.close()
+                        self.source.peer.close()
+                        return
+
+                if rejected:
+                    self._discard(size)
+                else:
+                    self._flush(size)
+                    if self.on_forwarded is not None:
+                        self.on_forwarded(msg)
+        finally:
+            self._task = None
+
+        if self._passthrough_after:
+            self.passthrough()
+        else:
+            self._stream_current()
+        if self._task is None:
+            self.source.resume_reading("inspect")
+
+    def eof(self):
+        # на EOF проверка не идёт: чтение на паузе, пока она не закончится.
+        # Недособранный запрос правила не видели - не отправляем его,
+        # ответ же мог быть ограничен закрытием соединения - досылаем
+        if self.source.on_data is None:
+            return
+        if self.parser.mode == ParserMode.RESPONSE:
+            self._flush(len(self.pending))
+        else:
+            self.pending.clear()
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
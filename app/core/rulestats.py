@@ -0,0 +1,85 @@
+import bisect
+from typing import Any, Dict, List
+
+# границы корзин гистограммы в секундах: 1мкс, 2мкс, 4мкс ... ~8.4с
+BUCKET_BOUNDS: List[float] = [1e-6 * 2 ** i for i in range(24)]
+
+PERCENTILES = (50, 90, 99)
+
+class RuleStats:
+    """
+    Счётчики одного правила. Обновляются из event loop без блокировок,
+    время копится в гистограмму с фиксированными корзинами - перцентили
+    считаются по ней приблизительно (с точностью до корзины).
+    """
+
+    __slots__ = ("evaluations", "accepts", "drops", "marks", "exceptions", "total_time", "max_time", "buckets")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.evaluations = 0
+        self.accepts = 0
+        self.drops = 0
+        self.marks = 0
+        self.exceptions = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def record(self, elapsed: float, verdict: str = None, marked: bool = False, failed: bool = False):
+        self.evaluations += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, elapsed)] += 1
+
+        if failed:
+            self.exceptions += 1
+        elif verdict == "ACCEPT":
+            self.accepts += 1
+        elif verdict == "DROP":
+            self.drops += 1
+        elif marked:
+            self.marks += 1
+
+    def percentile(self, p: float) -> float:
+        if not self.evaluations:
+            return 0.0
+        rank = self.evaluations * p / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                # верхняя граница корзины, последняя открыта - берём максимум
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max_time
+        return self.max_time
+
+    def dump(self) -> Dict[str, Any]:
+        # сырые счётчики для передачи в другой процесс
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def merge(self, data: Dict[str, Any]):
+        # добавить счётчики того же правила из другого процесса
+        self.evaluations += data["evaluations"]
+        self.accepts += data["accepts"]
+        self.drops += data["drops"]
+        self.marks += data["marks"]
+        self.exceptions += data["exceptions"]
+        self.total_time += data["total_time"]
+        self.max_time = max(self.max_time, data["max_time"])
+        self.buckets = [a + b for a, b in zip(self.buckets, data["buckets"])]
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "evaluations": self.evaluations,
+            "matches": {"accept": self.accepts, "drop": self.drops, "mark": self.marks},
+            "exceptions": self.exceptions,
+            "total_ms": round(self.total_time * 1000, 3),
+            "avg_ms": round(self.total_time * 1000 / self.evaluations, 4) if self.evaluations else 0.0,
+            "max_ms": round(self.max_time * 1000, 3),
+        }
+        for p in PERCENTILES:
+            data[f"p{p}_ms"] = round(min(self.percentile(p), self.max_time) * 1000, 4)
+        return data
@@ -1,54 +1,161 @@
+import asyncio
 import json
 import time
 import logging
-from typing import List
+from typing import Dict, Iterable, List, Optional
 from app.database.db import db
+from app.database.writer import writer
 from app.core.parser import HttpRequest, HttpResponse
 
 logger = logging.getLogger(__name__)
 
+# состояние для реестра после перезапуска: максимальные id и ещё активные сессии.
+# Потоки лежат по разделам БД, максимум ищется во всех
+MAX_SESSION_ID = "SELECT MAX(id) AS max_session FROM user_sessions"
+MAX_STREAM_ID = "SELECT MAX(id) AS max_stream FROM tcp_streams"
+RECENT_SESSIONS = """
+    SELECT id, client_ip, last_activity_time, alert_level FROM user_sessions
+    WHERE last_activity_time > ?
+    ORDER BY last_activity_time
+"""
+
+class IdSequence:
+    """
+    Id, которые выдаём сами, чтобы запись могла уйти в фоновый writer.
+    Несколько воркеров пишут в одну БД: воркер index берёт id, равные index по модулю step.
+    """
+
+    __slots__ = ("offset", "step", "_next")
+
+    def __init__(self):
+        self.offset = 0
+        self.step = 1
+        self._next: Optional[int] = None
+
+    def configure(self, index: int, count: int):
+        self.offset = index
+        self.step = max(1, count)
+        self._next = None
+
+    def start(self, max_id: Optional[int]):
+        first = (max_id or 0) + 1
+        self._next = first + (self.offset - first) % self.step
+
+    def next(self) -> int:
+        value = self._next
+        self._next += self.step
+        return value
+
+class ActiveSession:
+    __slots__ = ("id", "client_ip", "last_activity", "alert_level")
+
+    def __init__(self, session_id: int, client_ip: str, last_activity: float, alert_level: int = 0):
+        self.id = session_id
+        self.client_ip = client_ip
+        self.last_activity = last_activity
+        self.alert_level = alert_level
+
+class SessionRegistry:
+    """
+    Активные сессии в памяти: IP -> последняя сессия, поток -> сессия, уровень алерта.
+    Сессия жива, пока от IP приходят соединения не реже timeout (окно скользит).
+    БД только догоняет это состояние через writer.
+    """
+
+    def __init__(self):
+        self.by_ip: Dict[str, ActiveSession] = {}
+        self.streams: Dict[int, ActiveSession] = {}
+        self._pruned_at = 0.0
+
+    def clear(self):
+        self.by_ip.clear()
+        self.streams.clear()
+        self._pruned_at = 0.0
+
+    def restore(self, rows: Iterable):
+        # строки по возрастанию времени: у IP остаётся самая свежая
+        for row in rows:
+            self.by_ip[row['client_ip']] = ActiveSession(
+                row['id'], row['client_ip'], row['last_activity_time'], row['alert_level'] or 0
+            )
+
+    def find(self, client_ip: str, now: float, timeout: float) -> Optional[ActiveSession]:
+        self._prune(now, timeout)
+        session = self.by_ip.get(client_ip)
+        if session is None or now - session.last_activity >= timeout:
+            return None
+        session.last_activity = max(session.last_activity, now)
+        return session
+
+    def open(self, session_id: int, client_ip: str, now: float) -> ActiveSession:
+        session = ActiveSession(session_id, client_ip, now)
+        self.by_ip[client_ip] = session
+        return session
+
+    def _prune(self, now: float, timeout: float):
+        # истёкшие сессии вычищаем не чаще раза за окно
+        if now - self._pruned_at < timeout:
+            return
+        self._pruned_at = now
+        expired = [ip for ip, session in self.by_ip.items() if now - session.last_activity >= timeout]
+        for ip in expired:
+            del self.by_ip[ip]
+
 class SessionManager:
     SESSION_TIMEOUT = 30.0 #дебаг таймаут для непрерывных запросов. 30 сек раунд
 
+    registry = SessionRegistry()
+    _session_ids = IdSequence()
+    _stream_ids = IdSequence()
+    # реестр и счётчики id поднимаются из БД при первом соединении
+    _loaded = False
+    _load_lock = asyncio.Lock()
+
+    @staticmethod
+    def configure_ids(index: int, count: int):
+        SessionManager._session_ids.configure(index, count)
+        SessionManager._stream_ids.configure(index, count)
+        SessionManager.registry.clear()
+        SessionManager._loaded = False
+
+    @staticmethod
+    async def _ensure_loaded():
+        if SessionManager._loaded:
+            return
+        async with SessionManager._load_lock:
+            if SessionManager._loaded:
+                return
+            # события из выгрузки прошлого запуска могут быть ещё не в БД
+            replayed = writer.replayed_ids
+            rows = await db.fetch_all(MAX_SESSION_ID)
+            SessionManager._session_ids.start(max(rows[0]['max_session'] or 0, replayed["session_open"]))
+            partitions = await db.fetch_partitions(MAX_STREAM_ID)
+            SessionManager._stream_ids.start(max([rows[0]['max_stream'] or 0 for rows in partitions]
+                                                 + [replayed["stream_open"]]))
+            rows = await db.fetch_all(RECENT_SESSIONS, (time.time() - SessionManager.SESSION_TIMEOUT,))
+            SessionManager.registry.restore(rows)
+            SessionManager._loaded = True
+
     @staticmethod
     async def start_stream(client_ip: str, client_port: int, target_ip: str, target_port: int) -> int:
+        # на пути установки соединения к БД не ходим: только память и очередь writer
         try:
+            await SessionManager._ensure_loaded()
             now = time.time()
+            registry = SessionManager.registry
 
-
-            rows = await db.fetch_all(
-                """
-                SELECT id FROM user_sessions
-                WHERE client_ip = ? AND last_activity_time > ?
-                ORDER BY last_activity_time DESC LIMIT 1
-                """,
-                (client_ip, now - SessionManager.SESSION_TIMEOUT)
-            )
-
-            if rows:
-                user_session_id = rows[0]['id']
-
-                await db.execute(
-                    "UPDATE user_sessions SET last_activity_time = ? WHERE id = ?",
-                    (now, user_session_id)
-                )
+            session = registry.find(client_ip, now, SessionManager.SESSION_TIMEOUT)
+            if session is not None:
+                await writer.submit("session_touch", (now, session.id))
             else:
-
-                user_session_id = await db.execute(
-                    """
-                    INSERT INTO user_sessions (client_ip, start_time, last_activity_time)
-                    VALUES (?, ?, ?)
-                    """,
-                    (client_ip, now, now)
-                )
-
-
-            stream_id = await db.execute(
-                """
-                INSERT INTO tcp_streams (user_session_id, client_ip, client_port, target_ip, target_port, start_time)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (user_session_id, client_ip, client_port, target_ip, target_port, now)
+                session = registry.open(SessionManager._session_ids.next(), client_ip, now)
+                await writer.submit("session_open", (session.id, client_ip, now, now))
+
+            stream_id = SessionManager._stream_ids.next()
+            registry.streams[stream_id] = session
+            await writer.submit(
+                "stream_open",
+                (stream_id, session.id, client_ip, client_port, target_ip, target_port, now)
             )
             return stream_id
         except Exception as e:
@@ -57,11 +164,9 @@ class SessionManager:
 
     @staticmethod
     async def close_stream(stream_id: int):
+        SessionManager.registry.streams.pop(stream_id, None)
         try:
-            await db.execute(
-                "UPDATE tcp_streams SET is_closed = 1, end_time = ? WHERE id = ?",
-                (time.time(), stream_id)
-            )
+            await writer.submit("stream_close", (time.time(), stream_id))
         except Exception as e:
             logger.error(f"Failed to close stream {stream_id}: {e}")
 
@@ -79,12 +184,9 @@ class SessionManager:
         try:
             headers_json = json.dumps(req.headers)
             tags_json = json.dumps(tags or [])
-            await db.execute(
-                """
-                INSERT INTO messages (tcp_stream_id, type, method, url, headers, body, tags, timestamp)
-                VALUES (?, 'REQUEST', ?, ?, ?, ?, ?, ?)
-                """,
-                (stream_id, req.method, req.path, headers_json, req.body, tags_json, time.time())
+            await writer.submit(
+                "message",
+                (stream_id, 'REQUEST', req.method, req.path, None, headers_json, req.body, tags_json, time.time())
             )
             if tags:
                 await SessionManager.update_session_alert(stream_id, 1)
@@ -96,12 +198,9 @@ class SessionManager:
         try:
             headers_json = json.dumps(res.headers)
             tags_json = json.dumps(tags or [])
-            await db.execute(
-                """
-                INSERT INTO messages (tcp_stream_id, type, status_code, headers, body, tags, timestamp)
-                VALUES (?, 'RESPONSE', ?, ?, ?, ?, ?)
-                """,
-                (stream_id, res.status_code, headers_json, res.body, tags_json, time.time())
+            await writer.submit(
+                "message",
+                (stream_id, 'RESPONSE', None, None, res.status_code, headers_json, res.body, tags_json, time.time())
             )
             if tags:
                 await SessionManager.update_session_alert(stream_id, 1)
@@ -111,14 +210,13 @@ class SessionManager:
     @staticmethod
     async def update_session_alert(stream_id: int, level: int):
         try:
-
-            rows = await db.fetch_all("SELECT user_session_id FROM tcp_streams WHERE id = ?", (stream_id,))
-            if rows:
-                user_session_id = rows[0]['user_session_id']
-
-                await db.execute(
-                    "UPDATE user_sessions SET alert_level = MAX(alert_level, ?) WHERE id = ?",
-                    (level, user_session_id)
-                )
+            session = SessionManager.registry.streams.get(stream_id)
+            if session is None:
+                # поток уже закрыт: сессию найдёт сам UPDATE
+                await writer.submit("alert", (level, stream_id))
+            elif level > session.alert_level:
+                # пишем только повышение уровня
+                session.alert_level = level
+                await writer.submit("session_alert", (level, session.id))
         except Exception as e:
             logger.error(f"Failed to update alert level: {e}")
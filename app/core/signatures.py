@@ -0,0 +1,241 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, List, Set, Tuple, Iterable
+import logging
+import re
+import ahocorasick # pyahocorasick
+
+logger = logging.getLogger(__name__)
+
+# Сигнатуры (.sig) - декларативные правила "подстрока/регулярка в поле -> действие".
+# Одна сигнатура на строку:
+#
+#   <действие>   <поле>    <сравнение>  <шаблон до конца строки>
+#   drop         body      contains     union select
+#   mark:sqli    path      icontains    ../
+#   accept       headers   regex        X-Checker: \d+
+#
+# действие: drop | accept | mark:<тег>
+# поле: method | path | headers | body | decoded (тело без gzip/deflate)
+# сравнение: contains | icontains (без учёта регистра) | regex
+
+FIELDS = ("method", "path", "headers", "body", "decoded")
+MATCHERS = ("contains", "icontains", "regex")
+
+# меньше шаблонов быстрее проверить через `in`, автомат окупается на больших наборах
+AUTOMATON_MIN_PATTERNS = 16
+
+class SignatureError(ValueError):
+    pass
+
+@dataclass
+class Signature:
+    id: int
+    name: str # имя файла без расширения, как у .rule
+    path: str
+    line: int
+    action: str # DROP | ACCEPT | MARK
+    tag: Optional[str]
+    field: str
+    matcher: str
+    pattern: str
+
+def parse_signatures(source: str, path: str, name: str, first_id: int = 0) -> List[Signature]:
+    sigs = []
+    for lineno, line in enumerate(source.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        parts = line.split(None, 3)
+        if len(parts) < 4:
+            raise SignatureError(f"{path}:{lineno}: expected '<action> <field> <match> <pattern>'")
+        action, field, matcher, pattern = parts
+
+        tag = None
+        action = action.lower()
+        if action.startswith("mark:"):
+            tag = action[5:]
+            action = "MARK"
+            if not tag:
+                raise SignatureError(f"{path}:{lineno}: empty mark tag")
+        elif action in ("drop", "accept"):
+            action = action.upper()
+        else:
+            raise SignatureError(f"{path}:{lineno}: unknown action '{parts[0]}'")
+
+        field = field.lower()
+        if field not in FIELDS:
+            raise SignatureError(f"{path}:{lineno}: unknown field '{field}'")
+        matcher = matcher.lower()
+        if matcher not in MATCHERS:
+            raise SignatureError(f"{path}:{lineno}: unknown match type '{matcher}'")
+        if matcher == "regex":
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise SignatureError(f"{path}:{lineno}: bad regex: {e}")
+
+        sigs.append(Signature(
+            id=first_id + len(sigs),
+            name=name,
+            path=path,
+            line=lineno,
+            action=action,
+            tag=tag,
+            field=field,
+            matcher=matcher,
+            pattern=pattern
+        ))
+    return sigs
+
+class Automaton:
+    """Все подстроки набора, которые есть в тексте: Aho-Corasick за один проход."""
+
+    def __init__(self, patterns: Dict[str, Tuple[int, ...]]):
+        self._native = ahocorasick.Automaton()
+        for pattern, ids in patterns.items():
+            self._native.add_word(pattern, ids)
+        self._native.make_automaton()
+
+    def search(self, text: str, found: Set[int]):
+        for _, ids in self._native.iter(text):
+            found.update(ids)
+
+class LiteralMatcher:
+    def __init__(self, patterns: Dict[str, Tuple[int, ...]]):
+        self._patterns = None
+        self._automaton = None
+        if len(patterns) >= AUTOMATON_MIN_PATTERNS:
+            self._automaton = Automaton(patterns)
+        else:
+            self._patterns = list(patterns.items())
+
+    def search(self, text: str, found: Set[int]):
+        if self._automaton is not None:
+            self._automaton.search(text, found)
+            return
+        for pattern, ids in self._patterns:
+            if pattern in text:
+                found.update(ids)
+
+def _scoped(pattern: str) -> str:
+    # глобальные флаги "(?i)..." нельзя склеивать в одну регулярку, делаем их локальными
+    m = re.match(r'^\(\?([aiLmsux]+)\)', pattern)
+    if m:
+        return f"(?{m.group(1)}:{pattern[m.end():]})"
+    return f"(?:{pattern})"
+
+_UNMERGEABLE_RE = re.compile(r'\\[1-9]|\(\?P[<=]')
+
+class RegexMatcher:
+    """
+    Регулярки поля, склеенные в одну альтернативу, ищут позиции, где начинается
+    совпадение хоть одной из них. В каждой такой позиции одна проверка с
+    опережающими проверками всех регулярок даёт все сигнатуры, совпавшие с неё:
+    совпадения разных сигнатур могут пересекаться, а finditer по склейке
+    вернул бы только одно из них. Текст сканируется один раз, а не по разу
+    на каждую регулярку.
+    """
+
+    def __init__(self, sigs: List[Signature]):
+        self._combined = None
+        self._anchored = None
+        self._separate: List[Tuple[re.Pattern, int]] = []
+        self._group_ids: Dict[str, int] = {}
+
+        parts = []
+        for sig in sigs:
+            # обратные ссылки и именованные группы ломаются при склейке, такие проверяем по одной
+            if _UNMERGEABLE_RE.search(sig.pattern):
+                self._separate.append((re.compile(sig.pattern), sig.id))
+                continue
+            group = f"s{sig.id}"
+            self._group_ids[group] = sig.id
+            parts.append((group, _scoped(sig.pattern)))
+
+        if parts:
+            self._combined = re.compile("|".join(pattern for _, pattern in parts))
+            self._anchored = re.compile("".join(f"(?:(?=(?P<{group}>{pattern})))?" for group, pattern in parts))
+
+    def search(self, text: str, found: Set[int]):
+        if self._combined is not None:
+            left = dict(self._group_ids)
+            pos = 0
+            while left:
+                m = self._combined.search(text, pos)
+                if m is None:
+                    break
+                pos = m.start()
+                for group, value in self._anchored.match(text, pos).groupdict().items():
+                    if value is not None and group in left:
+                        found.add(left.pop(group))
+                pos += 1
+        for regex, sig_id in self._separate:
+            if sig_id not in found and regex.search(text):
+                found.add(sig_id)
+
+_ACTION_ORDER = {"ACCEPT": 0, "DROP": 1, "MARK": 2}
+
+class SignatureSet:
+    """Скомпилированные сигнатуры одного уровня (глобальные или конкретного порта)."""
+
+    def __init__(self, sigs: Iterable[Signature]):
+        self.signatures: Dict[int, Signature] = {}
+        # поле -> (contains, icontains, регулярки)
+        self._fields: Dict[str, Tuple[Optional[LiteralMatcher], Optional[LiteralMatcher], Optional[RegexMatcher]]] = {}
+
+        by_field: Dict[str, Dict[str, list]] = {}
+        for sig in sorted(sigs, key=lambda s: (_ACTION_ORDER[s.action], s.id)):
+            self.signatures[sig.id] = sig
+            by_field.setdefault(sig.field, {m: [] for m in MATCHERS})[sig.matcher].append(sig)
+
+        for field, groups in by_field.items():
+            self._fields[field] = (
+                self._literal(groups["contains"], fold=False),
+                self._literal(groups["icontains"], fold=True),
+                self._regex(groups["regex"])
+            )
+
+    @staticmethod
+    def _literal(sigs: List[Signature], fold: bool) -> Optional[LiteralMatcher]:
+        if not sigs:
+            return None
+        patterns: Dict[str, Tuple[int, ...]] = {}
+        for sig in sigs:
+            key = sig.pattern.lower() if fold else sig.pattern
+            patterns[key] = patterns.get(key, ()) + (sig.id,)
+        return LiteralMatcher(patterns)
+
+    @staticmethod
+    def _regex(sigs: List[Signature]) -> Optional[RegexMatcher]:
+        return RegexMatcher(sigs) if sigs else None
+
+    def __len__(self):
+        return len(self.signatures)
+
+    @staticmethod
+    def _field_text(request, field: str) -> str:
+        if field == "body":
+            return request.data
+        if field == "decoded":
+            # распаковка только если на уровне есть такие сигнатуры
+            return request.decoded_data
+        if field == "headers":
+            return request.raw_headers
+        if field == "path":
+            return request.path
+        return request.method
+
+    def scan(self, request) -> List[Signature]:
+        found: Set[int] = set()
+        for field, (literal, folded, regex) in self._fields.items():
+            text = self._field_text(request, field)
+            if not text:
+                continue
+            if literal is not None:
+                literal.search(text, found)
+            if folded is not None:
+                folded.search(text.lower(), found)
+            if regex is not None:
+                regex.search(text, found)
+        return [self.signatures[i] for i in sorted(found)]
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class UpstreamConnection:
+    __slots__ = ("reader", "writer", "reused", "idle_since")
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        # взято из пула: сервис мог уже закрыть его со своей стороны
+        self.reused = False
+        self.idle_since = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+class UpstreamPool:
+    """
+    Пул тёплых соединений к защищаемому сервису. В пул возвращаются только
+    соединения, на которых ответ полностью дочитан и обе стороны согласны на
+    keep-alive; простаивающие дольше idle_timeout закрываются.
+    """
+
+    def __init__(self, host: str, port: int, max_size: int = 32, idle_timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        # последним вернули - первым отдадим, самые тёплые соединения
+        self._idle: Deque[UpstreamConnection] = deque()
+        self._evict_task: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.opened = 0
+        self.evicted = 0
+        self.stale = 0
+
+    def start(self):
+        if self._evict_task is None:
+            self._evict_task = asyncio.create_task(self._evict_loop())
+
+    async def close(self):
+        if self._evict_task is not None:
+            self._evict_task.cancel()
+            self._evict_task = None
+        while self._idle:
+            self._idle.pop().close()
+
+    async def connect(self) -> Optional[UpstreamConnection]:
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except Exception as e:
+            logger.error(f"Failed to connect to target {self.host}:{self.port}: {e}")
+            return None
+        self.opened += 1
+        return UpstreamConnection(reader, writer)
+
+    async def acquire(self) -> Optional[UpstreamConnection]:
+        now = time.monotonic()
+        while self._idle:
+            conn = self._idle.pop()
+            if conn.alive and now - conn.idle_since < self.idle_timeout:
+                self.hits += 1
+                conn.reused = True
+                return conn
+            self.evicted += 1
+            conn.close()
+
+        self.misses += 1
+        return await self.connect()
+
+    def release(self, conn: UpstreamConnection):
+        if not conn.alive or len(self._idle) >= self.max_size:
+            conn.close()
+            return
+        conn.idle_since = time.monotonic()
+        self._idle.append(conn)
+
+    def discard_stale(self, conn: UpstreamConnection):
+        # сервис закрыл соединение, пока оно лежало в пуле
+        self.stale += 1
+        conn.close()
+
+    def evict_idle(self) -> int:
+        now = time.monotonic()
+        kept = deque()
+        evicted = 0
+        for conn in self._idle:
+            if conn.alive and now - conn.idle_since < self.idle_timeout:
+                kept.append(conn)
+            else:
+                conn.close()
+                evicted += 1
+        self._idle = kept
+        self.evicted += evicted
+        return evicted
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 0.1))
+            self.evict_idle()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "enabled": True,
+            "idle": len(self._idle),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "opened": self.opened,
+            "evicted": self.evicted,
+            "stale": self.stale,
+        }
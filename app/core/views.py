@@ -0,0 +1,219 @@
+import json
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+import httptools
+from app.core.body import decode_content
+from config import config
+
+class MultiDict(Mapping):
+    """
+    Отображение с повторяющимися ключами. [key] и get отдают первое значение,
+    getall - все по порядку: дубликаты не теряются молча.
+    """
+
+    def __init__(self, pairs: Iterable[Tuple[str, Any]] = ()):
+        self.pairs: List[Tuple[str, Any]] = []
+        self._index: Dict[str, List[Any]] = {}
+        for key, value in pairs:
+            self.pairs.append((key, value))
+            self._index.setdefault(self._key(key), []).append(value)
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return key
+
+    def __getitem__(self, key: str) -> Any:
+        return self._index[self._key(key)][0]
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self._key(key) in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def getall(self, key: str) -> List[Any]:
+        return list(self._index.get(self._key(key), ()))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.pairs!r})"
+
+class HeaderMap(MultiDict):
+    """Заголовки без учёта регистра имён; ключи при обходе - в нижнем регистре."""
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return key.lower()
+
+@dataclass(frozen=True)
+class UrlParts:
+    schema: str = ""
+    host: str = ""
+    port: Optional[int] = None
+    path: str = ""
+    query: str = ""
+    fragment: str = ""
+    userinfo: str = ""
+
+@dataclass(frozen=True)
+class FormFile:
+    filename: str
+    content_type: str
+    data: bytes
+
+def parse_url(target: str) -> UrlParts:
+    try:
+        url = httptools.parse_url(target.encode("utf-8"))
+    except httptools.HttpParserInvalidURLError:
+        # "*" у OPTIONS, "host:port" у CONNECT и прочее, что парсер не принял
+        path, _, fragment = target.partition("#")
+        path, _, query = path.partition("?")
+        return UrlParts(path=path, query=query, fragment=fragment)
+
+    def text(value: Optional[bytes]) -> str:
+        return value.decode("utf-8", errors="replace") if value else ""
+
+    return UrlParts(
+        schema=text(url.schema),
+        host=text(url.host),
+        port=url.port,
+        path=text(url.path),
+        query=text(url.query),
+        fragment=text(url.fragment),
+        userinfo=text(url.userinfo)
+    )
+
+_PARAM_RE = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+def parse_header_params(value: str) -> Tuple[str, Dict[str, str]]:
+    """'form-data; name="a"; filename="b.txt"' -> ('form-data', {'name': 'a', 'filename': 'b.txt'})"""
+    main, _, _ = value.partition(";")
+    params = {}
+    for name, raw in _PARAM_RE.findall(value):
+        raw = raw.strip()
+        if raw.startswith('"') and raw.endswith('"') and len(raw) >= 2:
+            raw = re.sub(r'\\(.)', r'\1', raw[1:-1])
+        params[name.lower()] = raw
+    return main.strip().lower(), params
+
+def parse_cookies(values: Iterable[str]) -> MultiDict:
+    pairs = []
+    for value in values:
+        for item in value.split(";"):
+            name, sep, val = item.partition("=")
+            name = name.strip()
+            if sep and name:
+                pairs.append((name, val.strip().strip('"')))
+    return MultiDict(pairs)
+
+def parse_set_cookies(values: Iterable[str]) -> MultiDict:
+    # атрибуты (Path, Expires...) не нужны, только имя=значение
+    return parse_cookies(value.split(";", 1)[0] for value in values)
+
+def parse_multipart(body: bytes, boundary: str) -> Tuple[MultiDict, MultiDict]:
+    """Поля и файлы multipart/form-data. Битые части пропускаются."""
+    fields, files = [], []
+    delimiter = b"--" + boundary.encode("latin-1")
+
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b"--"):
+            break
+        if part.startswith(b"\r\n"):
+            part = part[2:]
+        head, sep, content = part.partition(b"\r\n\r\n")
+        if not sep:
+            continue
+        if content.endswith(b"\r\n"):
+            content = content[:-2]
+
+        headers = HeaderMap(
+            (name.strip(), value.strip())
+            for name, _, value in (line.partition(":") for line in head.decode("utf-8", errors="replace").split("\r\n"))
+        )
+        _, params = parse_header_params(headers.get("content-disposition", ""))
+        name = params.get("name")
+        if name is None:
+            continue
+
+        if "filename" in params:
+            files.append((name, FormFile(params["filename"], headers.get("content-type", ""), content)))
+        else:
+            fields.append((name, content.decode("utf-8", errors="replace")))
+
+    return MultiDict(fields), MultiDict(files)
+
+class MessageViews:
+    """
+    Ленивые разборы сообщения. Каждый считается при первом обращении и
+    запоминается вместе с тем, из чего посчитан: если тело или заголовки
+    заменили (запрос с ранней фазы дочитан), разбор пересчитается.
+    """
+
+    def _view(self, name: str, source: Any, build: Callable[[Any], Any]) -> Any:
+        views = self.__dict__.setdefault("_views", {})
+        cached = views.get(name)
+        if cached is not None and cached[0] is source:
+            return cached[1]
+        value = build(source)
+        views[name] = (source, value)
+        return value
+
+    @property
+    def data(self) -> str:
+        return self._view("data", self.body, lambda body: body.decode('utf-8', errors='ignore'))
+
+    @property
+    def header_map(self) -> HeaderMap:
+        # повторяющиеся заголовки все на месте, в отличие от headers
+        # сообщение, собранное вручную (без header_list), берёт пары из headers
+        source = self.header_list or self.headers
+        return self._view("header_map", source,
+                          lambda pairs: HeaderMap(pairs.items() if isinstance(pairs, dict) else pairs))
+
+    @property
+    def content_type(self) -> Tuple[str, Dict[str, str]]:
+        return self._view("content_type", self.header_map,
+                          lambda headers: parse_header_params(headers.get("content-type", "")))
+
+    @property
+    def json(self) -> Any:
+        """Тело как JSON; None, если это не JSON."""
+        def build(body):
+            if not body:
+                return None
+            # тип не проверяем строго: сервис может принять JSON и с другим
+            if "json" not in self.content_type[0] and body[:64].lstrip()[:1] not in (b"{", b"["):
+                return None
+            try:
+                return json.loads(body[:])
+            except (ValueError, RecursionError):
+                return None
+        return self._view("json", self.body, build)
+
+    @property
+    def content_encodings(self) -> List[str]:
+        return self._view("content_encodings", self.header_map, lambda headers: [
+            value.strip().lower() for header in headers.getall("content-encoding") for value in header.split(",")
+        ])
+
+    def _decoded(self) -> Tuple[Any, str]:
+        return self._view("decoded", self.body, lambda body: decode_content(
+            body, self.content_encodings, config.BODY_DECODE_MAX_SIZE, config.BODY_DECODE_MAX_RATIO
+        ) if body else (body, ""))
+
+    @property
+    def decoded_body(self) -> Any:
+        """Тело без Content-Encoding (gzip/deflate). Распаковывается при первом обращении, с лимитами."""
+        return self._decoded()[0]
+
+    @property
+    def decode_error(self) -> str:
+        """Почему decoded_body неполное: "size limit", "ratio limit", "member limit", "invalid: ...", "incomplete"."""
+        return self._decoded()[1]
+
+    @property
+    def decoded_data(self) -> str:
+        return self._view("decoded_data", self.decoded_body, lambda body: body.decode('utf-8', errors='ignore'))
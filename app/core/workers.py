@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+from typing import Dict, Optional
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Режим нескольких процессов (PROXY_WORKERS > 1 или PANEL_PROCESS):
+#   супервизор - запускает остальных, перезапускает упавших воркеров,
+#                по SIGHUP рассылает воркерам перезагрузку правил и IP-списков;
+#   воркеры    - по TcpProxy с своим RuleEngine на общем порту (SO_REUSEPORT),
+#                у каждого свой канал управления (app.core.control);
+#   писатель   - единственный, кто пишет трафик в БД, воркеры шлют ему пачки;
+#   панель     - FastAPI со своими соединениями к БД, с воркерами говорит
+#                через их каналы управления.
+
+def worker_count() -> int:
+    return config.PROXY_WORKERS if config.PROXY_WORKERS > 0 else (os.cpu_count() or 1)
+
+def run_worker(index: int, count: int, channel):
+    # Ctrl+C получает вся группа процессов, останавливает воркеров супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker(index, count, channel))
+
+async def _worker(index: int, count: int, channel):
+    from app.core.control import ControlServer, control_path
+    from app.core.proxy import TcpProxy
+    from app.core.session import SessionManager
+    from app.database.db import db
+    from app.database.writer import writer
+
+    SessionManager.configure_ids(index, count)
+    writer.channel = channel
+    writer.spill_path = f"{config.LOG_SPILL_PATH}.{index}"
+    # воркер только читает id и сессии при старте, WAL и старые разделы - забота писателя
+    db.readers = 0
+    db.checkpoint_interval = 0
+    db.retention_hours = 0
+    await db.connect()
+    await writer.start()
+
+    proxy = TcpProxy(
+        listen_host=config.PROXY_HOST,
+        listen_port=config.PROXY_PORT,
+        target_host=config.TARGET_HOST,
+        target_port=config.TARGET_PORT,
+        reuse_port=True
+    )
+    control = ControlServer(proxy, control_path(index))
+    await control.start()
+
+    async def reload():
+        proxy.ip_list.reload()
+        generation = await proxy.rule_engine.reload_rules_async()
+        logger.info(f"Worker {index}: rules reloaded, generation {generation}")
+
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(reload()))
+    loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+
+    try:
+        await proxy.start()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await control.close()
+        proxy.rule_engine.close()
+        if proxy.upstream_pool is not None:
+            await proxy.upstream_pool.close()
+        # остаток очереди уходит писателю до выхода
+        await writer.stop()
+        await db.close()
+
+def run_log_writer(channel):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_log_writer(channel))
+
+async def _log_writer(channel):
+    from app.database.db import db
+    from app.database.writer import writer
+
+    # читает панель, писателю пул читателей не нужен
+    db.readers = 0
+    await db.connect()
+    try:
+        await writer.consume(channel)
+    finally:
+        await db.close()
+
+def run_panel(workers: int):
+    import uvicorn
+    from app.core.control import ControlClient, control_path
+    from app.core.iplist import IpAccessList
+    from app.database.db import db
+    from app.web.app import app
+
+    # checkpoint WAL и удаление старых разделов - в процессе писателя логов
+    db.checkpoint_interval = 0
+    db.retention_hours = 0
+
+    # файл IP-списков пишет только панель, воркеры меняют списки в памяти по команде
+    app.state.ip_list = IpAccessList()
+    app.state.control = ControlClient([control_path(index) for index in range(workers)])
+
+    uvicorn.run(app, host="0.0.0.0", port=config.WEB_PORT, log_level="info")
+
+class Supervisor:
+    def __init__(self, workers: int, web: bool = True):
+        self.workers = workers
+        self.web = web
+        self._ctx = multiprocessing.get_context("spawn")
+        self._channel = None
+        self._writer: Optional[multiprocessing.Process] = None
+        self._panel: Optional[multiprocessing.Process] = None
+        self._procs: Dict[int, multiprocessing.Process] = {}
+        self._stopping = False
+
+    def _prepare(self):
+        # общая подготовка один раз, а не наперегонки в каждом воркере
+        from app.core.iplist import IpAccessList
+        from app.database.db import db
+
+        async def init_db():
+            db.readers = 0
+            db.checkpoint_interval = 0
+            db.retention_hours = 0
+            await db.connect()
+            await db.close()
+
+        asyncio.run(init_db())
+        IpAccessList().migrate_rules("rules")
+
+    def _spawn_worker(self, index: int):
+        proc = self._ctx.Process(target=run_worker, args=(index, self.workers, self._channel),
+                                 name=f"waf-worker-{index}")
+        proc.start()
+        self._procs[index] = proc
+
+    def _spawn_panel(self):
+        self._panel = self._ctx.Process(target=run_panel, args=(self.workers,), name="waf-panel")
+        self._panel.start()
+
+    def _check_children(self) -> bool:
+        """Перезапускает упавших воркеров и панель. False - упал писатель, пора останавливаться."""
+        if self._stopping:
+            return True
+        if not self._writer.is_alive():
+            # очередь трафика держат воркеры, новому писателю её не передать, а
+            # писатель мог умереть посреди чтения из неё - перезапускается всё целиком
+            logger.critical(f"Log writer exited with code {self._writer.exitcode}, shutting down")
+            return False
+        for index, proc in list(self._procs.items()):
+            if not proc.is_alive():
+                logger.error(f"Worker {index} exited with code {proc.exitcode}, restarting")
+                self._spawn_worker(index)
+        if self._panel is not None and not self._panel.is_alive():
+            logger.error(f"Panel exited with code {self._panel.exitcode}, restarting")
+            self._spawn_panel()
+        return True
+
+    def _reload(self, *_):
+        logger.info("Reload requested, notifying workers")
+        for proc in self._procs.values():
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGHUP)
+
+    def _stop(self, *_):
+        self._stopping = True
+
+    def run(self) -> int:
+        """Код выхода: 0 - остановлен сигналом, 1 - упал писатель логов."""
+        self._prepare()
+        signal.signal(signal.SIGHUP, self._reload)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        batches = max(16, config.LOG_QUEUE_SIZE // max(1, config.LOG_BATCH_SIZE) * self.workers)
+        self._channel = self._ctx.Queue(maxsize=batches)
+        self._writer = self._ctx.Process(target=run_log_writer, args=(self._channel,), name="waf-log-writer")
+        self._writer.start()
+
+        for index in range(self.workers):
+            self._spawn_worker(index)
+        if self.web:
+            self._spawn_panel()
+        logger.info(f"Started {self.workers} proxy workers")
+
+        try:
+            while not self._stopping:
+                children = [*self._procs.values(), self._writer, self._panel]
+                multiprocessing.connection.wait([p.sentinel for p in children if p is not None], timeout=1)
+                if not self._check_children():
+                    return 1
+        finally:
+            self.shutdown()
+        return 0
+
+    def shutdown(self):
+        self._stopping = True
+        for proc in [*self._procs.values(), self._panel]:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        for proc in [*self._procs.values(), self._panel]:
+            if proc is not None:
+                proc.join(10)
+
+        # писатель дописывает всё, что воркеры успели отправить
+        if self._writer is not None and self._writer.is_alive():
+            self._channel.put(None)
+            self._writer.join(30)
+            if self._writer.is_alive():
+                self._writer.terminate()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from app.core.body import decode_content
+from config import config
+
+try:
+    import zstandard  # необязательная зависимость
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Тела сообщений хранятся отдельно от messages, по sha256 полного тела:
+# одинаковые тела (пейлоады чекера, типовые ответы сервиса) лежат один раз.
+# Сжатие - при записи в фоне, распаковка - только когда панель открывает сообщение.
+#
+#   bodies(hash, size, codec, truncated, data)
+#   size      - полный размер тела, data - не больше BODY_STORE_MAX_SIZE байт до сжатия
+#   codec     - raw | zlib | zstd (raw, если сжатие не помогло)
+#   truncated - сохранено только начало тела
+
+CODECS = ("raw", "zlib", "zstd")
+
+BodyRow = Tuple[bytes, int, str, int, bytes]
+
+def default_codec(name: str = config.BODY_STORE_CODEC) -> str:
+    if name == "auto":
+        return "zstd" if zstandard is not None else "zlib"
+    if name == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, bodies are compressed with zlib")
+        return "zlib"
+    if name not in CODECS:
+        raise ValueError(f"Unknown body codec: {name}")
+    return name
+
+def body_hash(body) -> bytes:
+    return hashlib.sha256(body).digest()
+
+def compress(data, codec: str) -> Tuple[str, bytes]:
+    """(codec, данные); несжимаемое остаётся raw."""
+    if codec == "zstd":
+        packed = zstandard.ZstdCompressor(level=3).compress(data)
+    elif codec == "zlib":
+        packed = zlib.compress(data, 6)
+    else:
+        return "raw", bytes(data)
+    if len(packed) >= len(data):
+        return "raw", bytes(data)
+    return codec, packed
+
+def decompress(codec: str, data: Optional[bytes]) -> bytes:
+    if data is None:
+        return b""
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Body is compressed with zstd, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return bytes(data)
+
+def encode_body(body, digest: bytes, codec: str, max_size: int) -> BodyRow:
+    size = len(body)
+    truncated = bool(max_size) and size > max_size
+    view = memoryview(body)
+    try:
+        stored_codec, data = compress(view[:max_size] if truncated else view, codec)
+    finally:
+        view.release()
+    return digest, size, stored_codec, int(truncated), data
+
+class BodyStore:
+    """
+    Подготовка тел для пачки писателя: хеш, отбор новых, сжатие.
+    Хеши недавно записанных тел помнятся (known_limit штук), повторное тело
+    не сжимается заново - в пачку уходит только ссылка.
+    """
+
+    def __init__(self, codec: Optional[str] = None, max_size: int = config.BODY_STORE_MAX_SIZE,
+                 known_limit: int = 65536):
+        self.codec = default_codec(codec or config.BODY_STORE_CODEC)
+        self.max_size = max_size
+        self.known_limit = known_limit
+        self._known: "OrderedDict[Tuple[object, bytes], None]" = OrderedDict()
+
+    def prepare(self, bodies: Iterable, scope=None) -> Tuple[List[Optional[bytes]], List[BodyRow]]:
+        """
+        Хеши тел по порядку (None для пустых) и строки bodies для новых.
+        scope - файл БД (раздел), в котором тела уже записаны.
+        """
+        hashes: List[Optional[bytes]] = []
+        rows: List[BodyRow] = []
+        seen: Set[bytes] = set()
+        for body in bodies:
+            if not body:
+                hashes.append(None)
+                continue
+            if isinstance(body, str):
+                body = body.encode()
+            digest = body_hash(body)
+            hashes.append(digest)
+            if digest in seen or (scope, digest) in self._known:
+                continue
+            seen.add(digest)
+            rows.append(encode_body(body, digest, self.codec, self.max_size))
+        return hashes, rows
+
+    def remember(self, hashes: Iterable[Optional[bytes]], scope=None):
+        # только после commit: иначе ссылка на тело, которого нет в БД
+        for digest in hashes:
+            if digest is None:
+                continue
+            key = (scope, digest)
+            self._known[key] = None
+            self._known.move_to_end(key)
+        while len(self._known) > self.known_limit:
+            self._known.popitem(last=False)
+
+    def forget(self):
+        self._known.clear()
+
+# тело индексируется, если после utf-8 в нём не больше такой доли битых символов
+_TEXT_MAX_ERRORS = 0.01
+
+def _content_encodings(headers: Dict[str, Any]) -> List[str]:
+    return [
+        value.strip().lower()
+        for name, header in headers.items() if name.lower() == "content-encoding"
+        for value in str(header).split(",")
+    ]
+
+def body_text(body, headers_json: Optional[str], max_size: int = config.SEARCH_BODY_MAX_SIZE) -> Optional[str]:
+    """Текст тела для индекса: без gzip/deflate, начало max_size байт; None - не текст."""
+    if not body:
+        return None
+    if isinstance(body, str):
+        return body[:max_size]
+    try:
+        headers = json.loads(headers_json) if headers_json else {}
+    except ValueError:
+        headers = {}
+    if isinstance(headers, dict):
+        encodings = _content_encodings(headers)
+        if encodings:
+            body, _ = decode_content(body, encodings, config.BODY_DECODE_MAX_SIZE, config.BODY_DECODE_MAX_RATIO)
+    text = bytes(body[:max_size]).decode("utf-8", errors="replace")
+    if text.count("�") > len(text) * _TEXT_MAX_ERRORS:
+        return None
+    return text
@@ -2,86 +2,363 @@ import aiosqlite
 import logging
 import os
 import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.request import pathname2url
+from app.database.migrations import has_search_index, migrate
 from config import config
 
 logger = logging.getLogger(__name__)
 
+# БД в режиме WAL: одно соединение пишет (трафик, миграции), панель читает
+# через пул соединений только на чтение и не ждёт записи пачек.
+# WAL сбрасывается в основной файл фоновым checkpoint, а не посреди commit.
+#
+# Разделы по времени (partition_minutes > 0): потоки, сообщения и тела пишутся
+# в файлы partitions/traffic-<начало периода>.sqlite, сессии остаются в основном
+# файле. Раздел - по времени открытия потока, поэтому поток целиком лежит в одном
+# файле. Старые разделы удаляются (или уносятся в архив) целиком, без DELETE.
+# Данные, записанные до разделов, остаются в основном файле и читаются как самый
+# старый раздел (partition=None).
+
+PARTITION_PREFIX = "traffic-"
+PARTITION_SUFFIX = ".sqlite"
+# свободных соединений на чтение к разделам держим открытыми не больше
+PARTITION_READERS = 16
+# соединений на запись: текущий раздел и предыдущий (длинные потоки)
+PARTITION_WRITERS = 2
+RETENTION_CHECK_INTERVAL = 60.0
+# открытый поток, который был активен после cutoff: раздел с ним ещё нужен
+_LIVE_STREAMS = """
+    SELECT 1 FROM tcp_streams t
+    WHERE t.is_closed = 0 AND MAX(t.start_time, IFNULL(
+        (SELECT MAX(m.timestamp) FROM messages m WHERE m.tcp_stream_id = t.id), 0)) >= ?
+    LIMIT 1
+"""
+
 class Database:
-    def __init__(self):
+    def __init__(self, readers: Optional[int] = None, checkpoint_interval: Optional[float] = None,
+                 partition_minutes: Optional[float] = None, retention_hours: Optional[float] = None):
         self.db_path = config.DB_PATH
+        self.readers = config.DB_READERS if readers is None else readers
+        self.checkpoint_interval = config.DB_CHECKPOINT_INTERVAL if checkpoint_interval is None else checkpoint_interval
+        self.partition_minutes = config.DB_PARTITION_MINUTES if partition_minutes is None else partition_minutes
+        self.retention_hours = config.DB_RETENTION_HOURS if retention_hours is None else retention_hours
+        self.archive_dir = config.DB_ARCHIVE_DIR
+        # есть ли messages_fts (SEARCH_INDEX и FTS5 в сборке SQLite), известно после connect
+        self.search_index = False
         self._connection = None
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._checkpoint_conn = None
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._partition_writers: "OrderedDict[int, aiosqlite.Connection]" = OrderedDict()
+        self._partition_readers: "OrderedDict[int, aiosqlite.Connection]" = OrderedDict()
+        # сколько запросов сейчас идёт через соединение к разделу
+        self._reader_users: Dict[aiosqlite.Connection, int] = {}
+        self._partition_lock: Optional[asyncio.Lock] = None
+        self._pruned_at = 0.0
+        # разделы, удалённые prune: запоздалые события их потоков не создают файл заново
+        self._removed: Set[int] = set()
+
+    @property
+    def partitioned(self) -> bool:
+        return self.partition_minutes > 0
+
+    @property
+    def partition_dir(self) -> str:
+        return os.path.join(os.path.dirname(self.db_path), "partitions")
+
+    def partition_path(self, partition: int) -> str:
+        return os.path.join(self.partition_dir, f"{PARTITION_PREFIX}{partition}{PARTITION_SUFFIX}")
+
+    def partition_of(self, timestamp: float) -> Optional[int]:
+        """Раздел (начало периода, unix-время) для момента timestamp; None без разделов."""
+        if not self.partitioned:
+            return None
+        period = int(self.partition_minutes * 60)
+        return int(timestamp // period) * period
+
+    def is_removed(self, partition: Optional[int]) -> bool:
+        return partition in self._removed
+
+    def partitions(self, start: Optional[float] = None, end: Optional[float] = None) -> List[Optional[int]]:
+        """
+        Разделы, которые пересекаются с [start, end], от новых к старым.
+        Последним всегда идёт None - основной файл с данными до разделов.
+        """
+        found = []
+        if self.partitioned:
+            try:
+                names = os.listdir(self.partition_dir)
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                if name.startswith(PARTITION_PREFIX) and name.endswith(PARTITION_SUFFIX):
+                    try:
+                        found.append(int(name[len(PARTITION_PREFIX):-len(PARTITION_SUFFIX)]))
+                    except ValueError:
+                        continue
+            found.sort(reverse=True)
+
+        period = int(self.partition_minutes * 60)
+        result: List[Optional[int]] = []
+        next_start = None
+        for partition in found:
+            # конец раздела - начало следующего, если длину периода меняли между запусками
+            partition_end = partition + period if next_start is None else min(partition + period, next_start)
+            next_start = partition
+            if start is not None and partition_end <= start:
+                continue
+            if end is not None and partition > end:
+                continue
+            result.append(partition)
+        result.append(None)
+        return result
+
+    async def _tune(self, conn: aiosqlite.Connection):
+        await conn.execute(f"PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT)}")
+        await conn.execute(f"PRAGMA cache_size = {int(config.DB_CACHE_SIZE)}")
+        await conn.execute(f"PRAGMA mmap_size = {int(config.DB_MMAP_SIZE)}")
+        await conn.execute(f"PRAGMA temp_store = {config.DB_TEMP_STORE}")
+
+    async def _open_writer(self, path: str) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(path)
+        conn.row_factory = aiosqlite.Row
+        await self._tune(conn)
+        async with conn.execute("PRAGMA journal_mode = WAL") as cursor:
+            mode = (await cursor.fetchone())[0]
+        if mode != "wal":
+            logger.warning(f"Database journal mode is {mode}, WAL is not available")
+        await conn.execute(f"PRAGMA synchronous = {config.DB_SYNCHRONOUS}")
+        await conn.execute(f"PRAGMA journal_size_limit = {int(config.DB_WAL_SIZE_LIMIT)}")
+        if self.checkpoint_interval > 0:
+            # checkpoint делает фоновая задача, commit пачки его не ждёт
+            await conn.execute("PRAGMA wal_autocheckpoint = 0")
+        return conn
+
+    async def _open_reader(self, path: str) -> aiosqlite.Connection:
+        uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro"
+        conn = await aiosqlite.connect(uri, uri=True)
+        conn.row_factory = aiosqlite.Row
+        await self._tune(conn)
+        await conn.execute("PRAGMA query_only = 1")
+        return conn
 
     async def connect(self):
         if not self._connection:
             os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-            self._connection = await aiosqlite.connect(self.db_path)
-            self._connection.row_factory = aiosqlite.Row
-            await self.init_db()
+            self._connection = await self._open_writer(self.db_path)
+            try:
+                await self.init_db()
+                # читатели открываются после миграций: схема им уже видна
+                self._reader_pool = asyncio.Queue()
+                for _ in range(max(0, self.readers)):
+                    conn = await self._open_reader(self.db_path)
+                    self._reader_conns.append(conn)
+                    self._reader_pool.put_nowait(conn)
+                self._partition_lock = asyncio.Lock()
+                if self.checkpoint_interval > 0:
+                    self._checkpoint_conn = await aiosqlite.connect(self.db_path)
+                    await self._checkpoint_conn.execute(f"PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT)}")
+                if self.checkpoint_interval > 0 or (self.partitioned and self.retention_hours > 0):
+                    self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+            except Exception:
+                await self.close()
+                raise
 
     async def close(self):
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            try:
+                await self._maintenance_task
+            except asyncio.CancelledError:
+                pass
+            self._maintenance_task = None
+        if self._checkpoint_conn:
+            await self._checkpoint_conn.close()
+            self._checkpoint_conn = None
+        for conn in self._partition_readers.values():
+            await conn.close()
+        self._partition_readers.clear()
+        self._reader_users.clear()
+        while self._partition_writers:
+            await self._close_writer(*self._partition_writers.popitem())
+        for conn in self._reader_conns:
+            await conn.close()
+        self._reader_conns = []
+        self._reader_pool = None
         if self._connection:
-            await self._connection.close()
+            await self._close_writer(None, self._connection)
             self._connection = None
 
+    async def _close_writer(self, partition: Optional[int], conn: aiosqlite.Connection):
+        try:
+            # WAL целиком в основной файл, -wal остаётся пустым
+            await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logger.warning(f"Final WAL checkpoint of partition {partition} failed: {e}")
+        await conn.close()
+
     async def init_db(self):
         if not self._connection:
             return
 
+        await migrate(self._connection)
+        # разделы создаются с той же настройкой и той же сборкой SQLite
+        self.search_index = await has_search_index(self._connection)
 
-        await self._connection.execute("""
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_ip TEXT,
-                start_time REAL,
-                last_activity_time REAL,
-                alert_level INTEGER DEFAULT 0 -- 0=None, 1=Mark, 2=Block
-            )
-        """)
-
-        await self._connection.execute("""
-            CREATE TABLE IF NOT EXISTS tcp_streams (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_session_id INTEGER,
-                client_ip TEXT,
-                client_port INTEGER,
-                target_ip TEXT,
-                target_port INTEGER,
-                start_time REAL,
-                end_time REAL,
-                is_closed INTEGER DEFAULT 0,
-                FOREIGN KEY(user_session_id) REFERENCES user_sessions(id)
-            )
-        """)
-
-        await self._connection.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tcp_stream_id INTEGER,
-                type TEXT,  -- 'REQUEST' or 'RESPONSE'
-                method TEXT,
-                url TEXT,
-                status_code INTEGER,
-                headers TEXT, -- JSON string
-                body BLOB,
-                tags TEXT, -- JSON list of tags
-                timestamp REAL,
-                FOREIGN KEY(tcp_stream_id) REFERENCES tcp_streams(id)
-            )
-        """)
+    async def _partition_writer(self, partition: int) -> aiosqlite.Connection:
+        conn = self._partition_writers.get(partition)
+        if conn is not None:
+            self._partition_writers.move_to_end(partition)
+            return conn
 
+        async with self._partition_lock:
+            conn = self._partition_writers.get(partition)
+            if conn is not None:
+                return conn
+            path = self.partition_path(partition)
+            if not os.path.exists(path):
+                # схема создаётся под временным именем: читатели видят раздел уже готовым
+                os.makedirs(self.partition_dir, exist_ok=True)
+                tmp_path = path + ".new"
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(tmp_path + suffix):
+                        os.remove(tmp_path + suffix)
+                tmp = await aiosqlite.connect(tmp_path)
+                try:
+                    await migrate(tmp)
+                finally:
+                    await tmp.close()
+                os.replace(tmp_path, path)
+                logger.info(f"Database partition {partition} created")
+            conn = await self._open_writer(path)
+            try:
+                await migrate(conn)
+            except Exception:
+                await conn.close()
+                raise
+            self._partition_writers[partition] = conn
+            while len(self._partition_writers) > PARTITION_WRITERS:
+                await self._close_writer(*self._partition_writers.popitem(last=False))
+            return conn
 
+    @asynccontextmanager
+    async def _partition_reader(self, partition: int):
+        """
+        Соединение на чтение к разделу на время запроса. Занятое соединение
+        из кеша не закрывается: при переполнении кеша ждёт, пока освободится.
+        """
+        async with self._partition_lock:
+            conn = self._partition_readers.get(partition)
+            if conn is not None:
+                self._partition_readers.move_to_end(partition)
+            else:
+                conn = await self._open_reader(self.partition_path(partition))
+                if self.readers > 0:
+                    self._partition_readers[partition] = conn
+            # процессу без пула читателей разделы нужны изредка - закрываем сразу
+            cached = self._partition_readers.get(partition) is conn
+            self._reader_users[conn] = self._reader_users.get(conn, 0) + 1
+            await self._evict_readers()
         try:
-            await self._connection.execute("ALTER TABLE messages ADD COLUMN tags TEXT")
-        except:
-            pass
+            yield conn
+        finally:
+            async with self._partition_lock:
+                users = self._reader_users.pop(conn) - 1
+                if users:
+                    self._reader_users[conn] = users
+                elif not cached or self._partition_readers.get(partition) is not conn:
+                    # не кешировалось или раздел удалён, пока шёл запрос
+                    await conn.close()
+                await self._evict_readers()
 
+    async def _evict_readers(self):
+        # под _partition_lock: лишние свободные соединения, старые первыми
+        excess = len(self._partition_readers) - PARTITION_READERS
+        for partition, conn in list(self._partition_readers.items()):
+            if excess <= 0:
+                break
+            if conn in self._reader_users:
+                continue
+            del self._partition_readers[partition]
+            await conn.close()
+            excess -= 1
 
-        try:
-            await self._connection.execute("ALTER TABLE user_sessions ADD COLUMN alert_level INTEGER DEFAULT 0")
-        except:
-            pass
+    async def checkpoint(self, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+        """wal_checkpoint основного файла: (busy, страниц в WAL, перенесено в основной файл)."""
+        conn = self._checkpoint_conn or self._connection
+        async with conn.execute(f"PRAGMA wal_checkpoint({mode})") as cursor:
+            return tuple(await cursor.fetchone())
+
+    async def _maintenance_loop(self):
+        interval = self.checkpoint_interval if self.checkpoint_interval > 0 else RETENTION_CHECK_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            if self.checkpoint_interval > 0:
+                try:
+                    # PASSIVE не ждёт читателей и писателя: что не успели - в следующий раз
+                    busy, log_pages, done = await self.checkpoint()
+                    if log_pages:
+                        logger.debug(f"WAL checkpoint: {done}/{log_pages} pages")
+                    for conn in list(self._partition_writers.values()):
+                        await conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+                except Exception as e:
+                    logger.error(f"WAL checkpoint failed: {e}")
+            if self.partitioned and self.retention_hours > 0 and time.time() - self._pruned_at >= RETENTION_CHECK_INTERVAL:
+                try:
+                    await self.prune()
+                except Exception as e:
+                    logger.error(f"Partition retention failed: {e}")
 
-        await self._connection.commit()
+    async def prune(self, now: Optional[float] = None) -> List[int]:
+        """
+        Удаляет (или переносит в archive_dir) разделы, которые целиком старше
+        retention_hours, и сессии без активности за это время. Текущий раздел не трогается,
+        как и раздел с открытым потоком, активным в пределах retention_hours: его сообщения
+        ещё пишутся туда. Поток, молчащий дольше, считается брошенным (например, процесс
+        упал до stream_close), его запоздалые события писатель отбрасывает.
+        """
+        now = time.time() if now is None else now
+        self._pruned_at = now
+        cutoff = now - self.retention_hours * 3600
+        live = self.partition_of(now)
+        period = int(self.partition_minutes * 60)
+        removed = []
+        for partition in self.partitions():
+            # раздел целиком старше cutoff; текущий не трогаем никогда
+            if partition is None or partition >= live or partition + period > cutoff:
+                continue
+            if await self.fetch_all(_LIVE_STREAMS, (cutoff,), partition=partition):
+                continue
+            async with self._partition_lock:
+                conn = self._partition_writers.pop(partition, None)
+                if conn is not None:
+                    await self._close_writer(partition, conn)
+                conn = self._partition_readers.pop(partition, None)
+                if conn is not None and conn not in self._reader_users:
+                    # занятое закроет тот, кто его держит
+                    await conn.close()
+                path = self.partition_path(partition)
+                for suffix in ("", "-wal", "-shm"):
+                    if not os.path.exists(path + suffix):
+                        continue
+                    if self.archive_dir:
+                        os.makedirs(self.archive_dir, exist_ok=True)
+                        os.replace(path + suffix, os.path.join(self.archive_dir, os.path.basename(path + suffix)))
+                    else:
+                        os.remove(path + suffix)
+            removed.append(partition)
+            self._removed.add(partition)
+            logger.info(f"Database partition {partition} {'archived' if self.archive_dir else 'removed'}")
+
+        if removed:
+            # сессии маленькие и с индексом по времени, их достаточно удалить
+            await self.execute("DELETE FROM user_sessions WHERE last_activity_time < ?", (cutoff,))
+        return removed
 
     async def execute(self, query: str, parameters: tuple = ()):
         if not self._connection:
@@ -90,10 +367,64 @@ class Database:
             await self._connection.commit()
             return cursor.lastrowid
 
-    async def fetch_all(self, query: str, parameters: tuple = ()):
+    async def execute_batch(self, statements: List[Tuple[str, List[tuple]]], partition: Optional[int] = None):
+        # несколько executemany в одной транзакции, один commit на всю пачку
         if not self._connection:
             await self.connect()
-        async with self._connection.execute(query, parameters) as cursor:
-            return await cursor.fetchall()
+        conn = self._connection if partition is None else await self._partition_writer(partition)
+        try:
+            for query, rows in statements:
+                if rows:
+                    await conn.executemany(query, rows)
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+    async def fetch_all(self, query: str, parameters: tuple = (), partition: Optional[int] = None):
+        if not self._connection:
+            await self.connect()
+        if partition is not None:
+            if partition not in self._partition_readers and not os.path.exists(self.partition_path(partition)):
+                # раздела ещё нет (или уже удалён) - и строк в нём нет
+                return []
+            async with self._partition_reader(partition) as conn:
+                async with conn.execute(query, parameters) as cursor:
+                    return await cursor.fetchall()
+
+        if not self._reader_conns:
+            async with self._connection.execute(query, parameters) as cursor:
+                return await cursor.fetchall()
+
+        # свободный читатель; все заняты - ждём, а не лезем в соединение записи
+        pool = self._reader_pool
+        conn = await pool.get()
+        try:
+            async with conn.execute(query, parameters) as cursor:
+                return await cursor.fetchall()
+        finally:
+            pool.put_nowait(conn)
+
+    async def fetch_partitions(self, query: str, parameters: tuple = (),
+                               start: Optional[float] = None, end: Optional[float] = None) -> List[list]:
+        """
+        Запрос к каждому разделу, пересекающемуся с [start, end], параллельно.
+        Результаты по разделам от старых к новым, первым - основной файл.
+        """
+        partitions = list(reversed(self.partitions(start, end)))
+        results = await asyncio.gather(*(self._fetch_partition(query, parameters, p) for p in partitions))
+        return [rows for rows in results if rows is not None]
+
+    async def _fetch_partition(self, query: str, parameters: tuple, partition: Optional[int]):
+        if partition is None:
+            return await self.fetch_all(query, parameters)
+        try:
+            return await self.fetch_all(query, parameters, partition=partition)
+        except Exception as e:
+            # раздел могли удалить между listdir и открытием
+            if os.path.exists(self.partition_path(partition)):
+                raise
+            logger.debug(f"Partition {partition} disappeared: {e}")
+            return None
 
 db = Database()
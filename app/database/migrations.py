@@ -0,0 +1,233 @@
+import logging
+import sqlite3
+import time
+from typing import Awaitable, Callable, List, Tuple
+import aiosqlite
+from app.database.bodies import BodyStore, body_text, decompress
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Схема БД трафика. Номер применённой версии лежит в schema_version,
+# при подключении догоняются недостающие миграции по порядку, каждая в своей транзакции.
+# Новую схему - только новой миграцией в конце списка, старые не меняются.
+
+Migration = Tuple[int, str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+
+async def _columns(conn: aiosqlite.Connection, table: str) -> List[str]:
+    async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+        return [row[1] for row in await cursor.fetchall()]
+
+async def _add_column(conn: aiosqlite.Connection, table: str, column: str, declaration: str):
+    # БД до миграций могла уже иметь колонку
+    if column not in await _columns(conn, table):
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+async def _initial(conn: aiosqlite.Connection):
+    # IF NOT EXISTS: БД, созданная до миграций, принимается как есть
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_ip TEXT,
+            start_time REAL,
+            last_activity_time REAL
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS tcp_streams (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_session_id INTEGER,
+            client_ip TEXT,
+            client_port INTEGER,
+            target_ip TEXT,
+            target_port INTEGER,
+            start_time REAL,
+            end_time REAL,
+            is_closed INTEGER DEFAULT 0,
+            FOREIGN KEY(user_session_id) REFERENCES user_sessions(id)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tcp_stream_id INTEGER,
+            type TEXT,  -- 'REQUEST' or 'RESPONSE'
+            method TEXT,
+            url TEXT,
+            status_code INTEGER,
+            headers TEXT, -- JSON string
+            body BLOB,
+            timestamp REAL,
+            FOREIGN KEY(tcp_stream_id) REFERENCES tcp_streams(id)
+        )
+    """)
+
+async def _tags_and_alerts(conn: aiosqlite.Connection):
+    await _add_column(conn, "messages", "tags", "TEXT")  # JSON list of tags
+    await _add_column(conn, "user_sessions", "alert_level", "INTEGER DEFAULT 0")  # 0=None, 1=Mark, 2=Block
+
+async def _indexes(conn: aiosqlite.Connection):
+    # индексы без миграций из первой версии панели
+    for name in ("idx_user_sessions_activity", "idx_tcp_streams_session", "idx_messages_stream"):
+        await conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+    # SessionManager.start_stream: последняя активная сессия IP
+    await conn.execute("CREATE INDEX idx_user_sessions_ip_activity ON user_sessions(client_ip, last_activity_time)")
+    # страница сессий, новые сверху (id - rowid, уже в индексе); активные сессии при старте
+    await conn.execute("CREATE INDEX idx_user_sessions_activity ON user_sessions(last_activity_time)")
+    # потоки сессии по порядку
+    await conn.execute("CREATE INDEX idx_tcp_streams_session ON tcp_streams(user_session_id, start_time)")
+    # сообщения потока по порядку; tags в индексе - счётчики и теги страницы сессий не читают таблицу
+    await conn.execute("CREATE INDEX idx_messages_stream ON messages(tcp_stream_id, timestamp, tags)")
+
+async def _drop_session_lookup_index(conn: aiosqlite.Connection):
+    # сессию IP теперь ищет реестр в памяти, а не SELECT на каждое соединение
+    await conn.execute("DROP INDEX IF EXISTS idx_user_sessions_ip_activity")
+
+async def _body_store(conn: aiosqlite.Connection):
+    # тела по хешу (app.database.bodies), в messages - только ссылка
+    await conn.execute("""
+        CREATE TABLE bodies (
+            hash BLOB PRIMARY KEY,
+            size INTEGER,
+            codec TEXT,
+            truncated INTEGER DEFAULT 0,
+            data BLOB
+        )
+    """)
+    await _add_column(conn, "messages", "body_hash", "BLOB")
+
+    # старые тела переезжают пачками, чтобы не держать всю таблицу в памяти
+    store = BodyStore()
+    last_id = 0
+    while True:
+        async with conn.execute(
+            "SELECT id, body FROM messages WHERE id > ? AND body IS NOT NULL ORDER BY id LIMIT 500", (last_id,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        bodies = [body.encode() if isinstance(body, str) else body for _, body in rows]
+        hashes, new_rows = store.prepare(bodies)
+        await conn.executemany("INSERT OR IGNORE INTO bodies (hash, size, codec, truncated, data) VALUES (?, ?, ?, ?, ?)", new_rows)
+        await conn.executemany("UPDATE messages SET body_hash = ?, body = NULL WHERE id = ?",
+                               [(digest, row[0]) for digest, row in zip(hashes, rows)])
+        store.remember(hashes)
+
+async def fts5_available(conn: aiosqlite.Connection) -> bool:
+    # FTS5 есть не в каждой сборке SQLite, проверяем пробной таблицей
+    try:
+        await conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    await conn.execute("DROP TABLE temp.fts5_probe")
+    return True
+
+async def has_search_index(conn: aiosqlite.Connection) -> bool:
+    async with conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'") as cursor:
+        return await cursor.fetchone() is not None
+
+async def _search_index(conn: aiosqlite.Connection):
+    # без индекса поиск недоступен, остальное работает; включённый позже
+    # SEARCH_INDEX достраивает индекс в migrate()
+    if not config.SEARCH_INDEX:
+        logger.info("SEARCH_INDEX is off, full-text search index not created")
+        return
+    if not await fts5_available(conn):
+        logger.warning("SQLite is built without FTS5, full-text search is unavailable")
+        return
+
+    # app.database.search: contentless, текст не хранится второй раз; prefix - быстрый abc*
+    await conn.execute("""
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            url, headers, body, content='', prefix='2 3', tokenize='unicode61'
+        )
+    """)
+
+    # уже записанные сообщения индексируются пачками
+    last_id = 0
+    while True:
+        async with conn.execute("""
+            SELECT m.id, m.url, m.headers, b.codec, b.data
+            FROM messages m LEFT JOIN bodies b ON b.hash = m.body_hash
+            WHERE m.id > ? ORDER BY m.id LIMIT 500
+        """, (last_id,)) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        await conn.executemany(
+            "INSERT INTO messages_fts (rowid, url, headers, body) VALUES (?, ?, ?, ?)",
+            [(message_id, url, headers, body_text(decompress(codec, data), headers))
+             for message_id, url, headers, codec, data in rows]
+        )
+
+MIGRATIONS: List[Migration] = [
+    (1, "initial schema", _initial),
+    (2, "message tags and session alert level", _tags_and_alerts),
+    (3, "indexes for proxy and panel queries", _indexes),
+    (4, "drop session lookup index", _drop_session_lookup_index),
+    (5, "content-addressed compressed bodies", _body_store),
+    (6, "full-text search index", _search_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+async def schema_version(conn: aiosqlite.Connection) -> int:
+    async with conn.execute("SELECT MAX(version) FROM schema_version") as cursor:
+        row = await cursor.fetchone()
+    return row[0] or 0
+
+async def migrate(conn: aiosqlite.Connection) -> int:
+    """Догоняет схему до последней версии. Возвращает версию после миграций."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at REAL
+        )
+    """)
+    await conn.commit()
+
+    version = await schema_version(conn)
+    if version > LATEST_VERSION:
+        logger.warning(f"Database schema version {version} is newer than this code ({LATEST_VERSION})")
+        return version
+
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        # IMMEDIATE: несколько процессов могут подключаться одновременно,
+        # миграцию применяет первый, остальные видят уже новую версию
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            if await schema_version(conn) >= number:
+                await conn.rollback()
+                continue
+            await apply(conn)
+            await conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (number, description, time.time())
+            )
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            logger.error(f"Database migration {number} ({description}) failed")
+            raise
+        logger.info(f"Database migrated to version {number}: {description}")
+        version = number
+
+    if config.SEARCH_INDEX and not await has_search_index(conn):
+        # миграция 6 прошла с выключенным SEARCH_INDEX - индекс строится сейчас
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not await has_search_index(conn):
+                await _search_index(conn)
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            logger.error("Building full-text search index failed")
+            raise
+
+    return version
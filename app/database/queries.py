@@ -0,0 +1,185 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+from app.database.bodies import decompress
+from app.database.db import db, Database
+
+# Запросы панели. Число запросов к БД не зависит от числа сессий и потоков:
+# страница сессий - запрос к сессиям и по запросу счётчиков на раздел БД,
+# который пересекается со временем сессий страницы; сессия - так же.
+
+SESSIONS_PAGE_MAX = 500
+
+# теги сообщений сессии без повторов; битый JSON в tags не роняет запрос
+SESSION_TAGS = """
+    SELECT json_group_array(DISTINCT j.value)
+    FROM tcp_streams t
+    JOIN messages m ON m.tcp_stream_id = t.id,
+         json_each(CASE WHEN json_valid(m.tags) THEN m.tags ELSE '[]' END) j
+    WHERE t.user_session_id = s.value
+"""
+
+# размер и признак обрезки лежат рядом с телом в bodies, сами данные не читаются
+MESSAGE_SUMMARY = (
+    "m.id, m.tcp_stream_id, m.type, m.method, m.url, m.status_code, m.tags, m.timestamp, "
+    "b.size AS body_size, b.truncated AS body_truncated"
+)
+MESSAGE_BODY = "m.headers, b.codec AS body_codec, b.data AS body_data"
+
+_SESSIONS_PAGE = """
+    SELECT s.id, s.client_ip, s.start_time, s.last_activity_time, s.alert_level
+    FROM user_sessions s
+    {where}
+    ORDER BY s.last_activity_time DESC, s.id DESC
+    LIMIT ?
+"""
+SESSIONS_FIRST_PAGE = _SESSIONS_PAGE.format(where="")
+SESSIONS_NEXT_PAGE = _SESSIONS_PAGE.format(where="WHERE (s.last_activity_time, s.id) < (?, ?)")
+
+# счётчики и теги сессий страницы в одном разделе, id сессий - JSON-массивом
+SESSION_STATS = f"""
+    SELECT s.value AS id,
+           (SELECT COUNT(*) FROM tcp_streams t WHERE t.user_session_id = s.value) AS stream_count,
+           (SELECT COUNT(*) FROM tcp_streams t JOIN messages m ON m.tcp_stream_id = t.id
+            WHERE t.user_session_id = s.value) AS message_count,
+           ({SESSION_TAGS}) AS tags
+    FROM json_each(?) s
+"""
+
+_SESSION_STREAMS = """
+    SELECT t.id AS stream_id, t.client_ip AS stream_client_ip, t.client_port, t.target_ip,
+           t.target_port, t.start_time AS stream_start_time, t.end_time, t.is_closed,
+           {columns}
+    FROM tcp_streams t
+    LEFT JOIN messages m ON m.tcp_stream_id = t.id
+    LEFT JOIN bodies b ON b.hash = m.body_hash
+    WHERE t.user_session_id = ?
+    ORDER BY t.start_time, t.id, m.timestamp
+"""
+SESSION_STREAMS = _SESSION_STREAMS.format(columns=MESSAGE_SUMMARY)
+SESSION_STREAMS_FULL = _SESSION_STREAMS.format(columns=f"{MESSAGE_SUMMARY}, {MESSAGE_BODY}")
+
+STREAM_MESSAGES = f"""
+    SELECT {MESSAGE_SUMMARY}, {MESSAGE_BODY}
+    FROM messages m
+    LEFT JOIN bodies b ON b.hash = m.body_hash
+    WHERE m.tcp_stream_id = ?
+    ORDER BY m.timestamp
+"""
+
+SUMMARY_FIELDS = ("id", "tcp_stream_id", "type", "method", "url", "status_code", "tags", "timestamp",
+                  "body_size", "body_truncated")
+
+def encode_cursor(last_activity_time: float, session_id: int) -> str:
+    return f"{last_activity_time!r}:{session_id}"
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """ValueError, если курсор не наш."""
+    time_part, _, id_part = cursor.rpartition(":")
+    return float(time_part), int(id_part)
+
+async def list_sessions(limit: int = 50, cursor: Optional[str] = None,
+                        database: Database = db) -> Dict[str, Any]:
+    """
+    Страница сессий, новые сверху, без потоков и тел: счётчики и теги считает SQL.
+    Следующая страница - по next_cursor (keyset по last_activity_time, id).
+    """
+    limit = max(1, min(limit, SESSIONS_PAGE_MAX))
+    if cursor:
+        last_activity_time, session_id = decode_cursor(cursor)
+        rows = await database.fetch_all(SESSIONS_NEXT_PAGE, (last_activity_time, session_id, limit + 1))
+    else:
+        rows = await database.fetch_all(SESSIONS_FIRST_PAGE, (limit + 1,))
+
+    sessions = [dict(row, stream_count=0, message_count=0, tags=[]) for row in rows[:limit]]
+    if sessions:
+        # потоки сессии открыты между её началом и последней активностью
+        by_id = {session["id"]: session for session in sessions}
+        tags = {session_id: set() for session_id in by_id}
+        partitions = await database.fetch_partitions(
+            SESSION_STATS, (json.dumps(list(by_id)),),
+            min(s["start_time"] for s in sessions), max(s["last_activity_time"] for s in sessions)
+        )
+        for partition_rows in partitions:
+            for row in partition_rows:
+                session = by_id[row["id"]]
+                session["stream_count"] += row["stream_count"]
+                session["message_count"] += row["message_count"]
+                tags[row["id"]].update(json.loads(row["tags"]) if row["tags"] else [])
+        for session_id, session in by_id.items():
+            session["tags"] = sorted(tags[session_id])
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = sessions[-1]
+        next_cursor = encode_cursor(last["last_activity_time"], last["id"])
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+def _message(row, bodies: bool) -> Dict[str, Any]:
+    message = {key: row[key] for key in SUMMARY_FIELDS}
+    message["body_size"] = message["body_size"] or 0
+    message["body_truncated"] = bool(message["body_truncated"])
+    if bodies:
+        # распаковка только здесь, когда сообщение открывают в панели
+        message["headers"] = row["headers"]
+        message["body"] = decompress(row["body_codec"], row["body_data"]).decode('utf-8', errors='replace')
+    return message
+
+async def session_details(session_id: int, bodies: bool = False,
+                          database: Database = db) -> Optional[Dict[str, Any]]:
+    """Сессия с потоками и сообщениями. Заголовки и тела - только при bodies."""
+    rows = await database.fetch_all("SELECT * FROM user_sessions WHERE id = ?", (session_id,))
+    if not rows:
+        return None
+    session = dict(rows[0])
+
+    # потоки и сообщения одним запросом на раздел; у потока без сообщений m.* пустые.
+    # Разделы идут от старых к новым, поток целиком лежит в одном
+    partitions = await database.fetch_partitions(
+        SESSION_STREAMS_FULL if bodies else SESSION_STREAMS, (session_id,),
+        session["start_time"], session["last_activity_time"]
+    )
+    rows = [row for partition_rows in partitions for row in partition_rows]
+
+    streams: List[Dict[str, Any]] = []
+    tags = set()
+    for row in rows:
+        if not streams or streams[-1]["id"] != row["stream_id"]:
+            streams.append({
+                "id": row["stream_id"],
+                "user_session_id": session_id,
+                "client_ip": row["stream_client_ip"],
+                "client_port": row["client_port"],
+                "target_ip": row["target_ip"],
+                "target_port": row["target_port"],
+                "start_time": row["stream_start_time"],
+                "end_time": row["end_time"],
+                "is_closed": row["is_closed"],
+                "messages": [],
+            })
+        if row["id"] is None:
+            continue
+
+        streams[-1]["messages"].append(_message(row, bodies))
+
+        try:
+            tags.update(json.loads(row["tags"] or "[]"))
+        except (ValueError, TypeError):
+            pass
+
+    session["streams"] = streams
+    session["tags"] = sorted(tags)
+    return session
+
+async def stream_details(stream_id: int, database: Database = db) -> Optional[Dict[str, Any]]:
+    """Поток со всеми сообщениями, с заголовками и телами."""
+    # раздел потока неизвестен: ищем от новых к старым, обычно он в первых
+    for partition in database.partitions():
+        rows = await database.fetch_all("SELECT * FROM tcp_streams WHERE id = ?", (stream_id,), partition=partition)
+        if rows:
+            break
+    else:
+        return None
+    stream = dict(rows[0])
+    rows = await database.fetch_all(STREAM_MESSAGES, (stream_id,), partition=partition)
+    stream["messages"] = [_message(row, True) for row in rows]
+    return stream
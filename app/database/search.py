@@ -0,0 +1,120 @@
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple
+from app.database.bodies import body_text
+from app.database.db import db, Database
+
+# Полнотекстовый поиск по сообщениям: FTS5-таблица messages_fts в каждом файле БД
+# (в основном и в каждом разделе), rowid = messages.id. Таблица contentless:
+# текст не хранится второй раз, только индекс. Пополняется писателем трафика
+# в той же транзакции, что и сами сообщения.
+
+SEARCH_PAGE_MAX = 200
+
+def search_row(message_id: int, params: tuple) -> tuple:
+    """Строка messages_fts для события message (тело - ещё байты, до замены на хеш)."""
+    return message_id, params[3], params[5], body_text(params[6], params[5])
+
+# так SQLite сообщает, что MATCH не разобрал запрос; прочие OperationalError
+# (БД занята, нет messages_fts, соединение закрыто) к запросу отношения не имеют
+_QUERY_ERRORS = ("fts5: ", "unterminated string", "unknown special query", "no such column")
+
+class SearchIndexMissing(Exception):
+    """Индекса нет: SEARCH_INDEX выключен или SQLite собран без FTS5."""
+
+def is_query_error(error: sqlite3.OperationalError) -> bool:
+    return str(error).startswith(_QUERY_ERRORS)
+
+def quote_query(query: str) -> str:
+    # весь ввод как одна фраза: "../../etc/passwd" не разбирается как синтаксис FTS5
+    return '"' + query.replace('"', '""') + '"'
+
+def encode_cursor(partition: Optional[int], message_id: int) -> str:
+    return f"{'main' if partition is None else partition}:{message_id}"
+
+def decode_cursor(cursor: str) -> Tuple[Optional[int], int]:
+    """ValueError, если курсор не наш."""
+    partition, _, message_id = cursor.partition(":")
+    return (None if partition == "main" else int(partition)), int(message_id)
+
+_SEARCH = """
+    SELECT m.id, m.tcp_stream_id, m.type, m.method, m.url, m.status_code, m.tags, m.timestamp,
+           t.user_session_id, t.client_ip, t.client_port, t.target_port
+    FROM messages_fts f
+    JOIN messages m ON m.id = f.rowid
+    JOIN tcp_streams t ON t.id = m.tcp_stream_id
+    WHERE messages_fts MATCH ? AND f.rowid < ? {filters}
+    ORDER BY f.rowid DESC
+    LIMIT ?
+"""
+
+FILTERS = {
+    "client_ip": "t.client_ip = ?",
+    "client_port": "t.client_port = ?",
+    "status": "m.status_code = ?",
+    "since": "m.timestamp >= ?",
+    "until": "m.timestamp <= ?",
+    "tag": "EXISTS (SELECT 1 FROM json_each(CASE WHEN json_valid(m.tags) THEN m.tags ELSE '[]' END) WHERE value = ?)",
+}
+
+async def search_messages(query: str, limit: int = 50, cursor: Optional[str] = None,
+                          database: Database = db, **filters) -> Dict[str, Any]:
+    """
+    Сообщения, подходящие под запрос FTS5 (слова, "фраза", префикс*, AND/OR/NOT),
+    новые сверху. Фильтры: client_ip, client_port, status, tag, since, until (unix-время).
+    Разделы спрашиваются по очереди от новых к старым, пока страница не наберётся;
+    следующая страница - по next_cursor. ValueError - пустой запрос или чужой курсор,
+    SearchIndexMissing - поиск недоступен.
+    """
+    if not database.search_index:
+        raise SearchIndexMissing("full-text search index is missing: SEARCH_INDEX is off or SQLite lacks FTS5")
+    query = query.strip()
+    if not query:
+        raise ValueError("empty query")
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    active = {name: value for name, value in filters.items() if value is not None and value != ""}
+    unknown = set(active) - set(FILTERS)
+    if unknown:
+        raise ValueError(f"unknown filters: {', '.join(sorted(unknown))}")
+    sql = _SEARCH.format(filters="".join(f" AND {FILTERS[name]}" for name in active))
+
+    partitions = database.partitions(active.get("since"), active.get("until"))
+    before = None
+    if cursor:
+        start, before = decode_cursor(cursor)
+        if start not in partitions:
+            return {"results": [], "next_cursor": None}
+        partitions = partitions[partitions.index(start):]
+
+    results: List[Dict[str, Any]] = []
+    quoted = False
+    more = False
+    for partition in partitions:
+        upper = before if before is not None else 2 ** 63 - 1
+        before = None
+        params = (query, upper, *active.values(), limit + 1 - len(results))
+        try:
+            rows = await database.fetch_all(sql, params, partition=partition)
+        except sqlite3.OperationalError as e:
+            if str(e) == "no such table: messages_fts":
+                raise SearchIndexMissing(f"full-text search index is missing in partition {partition}") from e
+            if quoted or not is_query_error(e):
+                raise
+            # ввод не разобрался как запрос FTS5 (../etc/passwd, Header: value) - ищем как фразу
+            query, quoted = quote_query(query), True
+            rows = await database.fetch_all(sql, (query, *params[1:]), partition=partition)
+
+        for row in rows:
+            if len(results) == limit:
+                more = True
+                break
+            result = dict(row)
+            result["partition"] = partition
+            results.append(result)
+        if more:
+            break
+
+    next_cursor = None
+    if more:
+        last = results[-1]
+        next_cursor = encode_cursor(last["partition"], last["id"])
+    return {"results": results, "next_cursor": next_cursor}
@@ -0,0 +1,365 @@
+import asyncio
+import logging
+import os
+import pickle
+import queue
+import time
+from collections import OrderedDict
+from typing import List, Tuple, Optional
+from app.database.bodies import BodyStore
+from app.database.db import db, Database
+from app.database.search import search_row
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# события трафика и их запросы. Внутри пачки выполняются в этом порядке,
+# поэтому сессия и поток всегда создаются раньше, чем пишутся их сообщения/закрытие/алерты
+STATEMENTS = {
+    "session_open": """
+        INSERT INTO user_sessions (id, client_ip, start_time, last_activity_time)
+        VALUES (?, ?, ?, ?)
+    """,
+    "stream_open": """
+        INSERT INTO tcp_streams (id, user_session_id, client_ip, client_port, target_ip, target_port, start_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """,
+    "session_touch": "UPDATE user_sessions SET last_activity_time = MAX(last_activity_time, ?) WHERE id = ?",
+    "body": "INSERT OR IGNORE INTO bodies (hash, size, codec, truncated, data) VALUES (?, ?, ?, ?, ?)",
+    "message": """
+        INSERT INTO messages (id, tcp_stream_id, type, method, url, status_code, headers, body_hash, tags, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+    "search": "INSERT INTO messages_fts (rowid, url, headers, body) VALUES (?, ?, ?, ?)",
+    "stream_close": "UPDATE tcp_streams SET is_closed = 1, end_time = ? WHERE id = ?",
+    "alert": """
+        UPDATE user_sessions SET alert_level = MAX(alert_level, ?)
+        WHERE id = (SELECT user_session_id FROM tcp_streams WHERE id = ?)
+    """,
+    "session_alert": "UPDATE user_sessions SET alert_level = MAX(alert_level, ?) WHERE id = ?",
+}
+
+# события потока: номер параметра с id потока (по нему выбирается раздел)
+STREAM_PARAM = {"message": 0, "stream_close": 1}
+# столько последних потоков писатель помнит: раздел и сессия
+STREAM_ROUTES = 65536
+# события с id, которые выдаёт SessionManager
+ID_EVENTS = ("session_open", "stream_open")
+
+OVERFLOW_POLICIES = ("drop", "block", "spill")
+
+class TrafficWriter:
+    """
+    Отложенная запись трафика: прокси кладёт события в ограниченную очередь,
+    фоновая задача раз в flush_interval (или при наборе batch_size) пишет их
+    через executemany одной транзакцией.
+    Если задан channel (очередь multiprocessing), пачки уходят в неё, а пишет
+    их в БД один процесс-писатель через consume - так у воркеров прокси
+    нет конкурирующих транзакций.
+    """
+
+    def __init__(self, database: Database = db,
+                 flush_interval: float = config.LOG_FLUSH_INTERVAL,
+                 batch_size: int = config.LOG_BATCH_SIZE,
+                 queue_size: int = config.LOG_QUEUE_SIZE,
+                 overflow_policy: str = config.LOG_OVERFLOW_POLICY,
+                 spill_path: str = config.LOG_SPILL_PATH):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.db = database
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.spill_path = spill_path
+        self.channel = None
+        self.bodies = BodyStore()
+        self._streams: "OrderedDict[int, Tuple[Optional[int], int]]" = OrderedDict()
+        self._next_message_id = {}
+        self.search_index = config.SEARCH_INDEX
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+        self._spill_pending = 0
+        self._channel_full = False
+        # наибольшие id сессий и потоков из выгрузки прошлого запуска: их может
+        # ещё не быть в БД, новые id SessionManager выдаёт после них
+        self.replayed_ids = {kind: 0 for kind in ID_EVENTS}
+
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        spill_dir = os.path.dirname(self.spill_path)
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        # остатки от прошлого запуска дописываем сразу, до первого соединения:
+        # их id должны быть учтены раньше, чем SessionManager начнёт выдавать новые
+        if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) > 0:
+            self._spill_pending = 1
+            self._channel_full = False
+            await self._replay_spill()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def submit(self, kind: str, params: tuple):
+        event = (kind, params)
+
+        if not self.running:
+            # фоновая запись не запущена (тесты, утилиты) - пишем сразу
+            await self._write([event])
+            return
+
+        if self._spill_pending:
+            # пока есть выгруженные на диск события, новые идут туда же, иначе сломается порядок
+            self._spill(event)
+        elif self.overflow_policy == "block":
+            await self._queue.put(event)
+        else:
+            try:
+                self._queue.put_nowait(event)
+            except asyncio.QueueFull:
+                if self.overflow_policy == "spill":
+                    self._spill(event)
+                else:
+                    self.dropped += 1
+                    if self.dropped % 1000 == 1:
+                        logger.warning(f"Log queue overflow, dropped {self.dropped} events so far")
+
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        self._channel_full = False
+        while self._queue is not None and not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._write(batch)
+
+        await self._replay_spill()
+
+    async def _replay_spill(self):
+        # процесс-писатель не успевает - выгрузка ждёт следующего сброса, а не крутится по кругу
+        while self._spill_pending and not self._channel_full:
+            for batch in self._read_spill():
+                for kind, params in batch:
+                    if kind in ID_EVENTS and params[0] > self.replayed_ids[kind]:
+                        self.replayed_ids[kind] = params[0]
+                await self._write(batch)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Traffic writer flush failed: {e}")
+
+        await self.flush()
+
+    async def consume(self, channel):
+        """Процесс-писатель: пишет пачки воркеров из channel, пока не придёт None."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await loop.run_in_executor(None, channel.get)
+            if batch is None:
+                return
+            await self._write(batch)
+
+    async def _write(self, batch: List[Tuple[str, tuple]]):
+        if self.channel is not None:
+            await self._send(batch)
+            return
+
+        # при разделах по времени поток со всеми сообщениями пишется в раздел,
+        # где он открыт; сессии и алерты - в основной файл
+        groups = {}
+        now = time.time()
+        for kind, params in batch:
+            partition = None
+            if kind == "stream_open":
+                partition = self.db.partition_of(params[6])
+                self._remember_stream(params[0], partition, params[1])
+            elif kind in STREAM_PARAM:
+                partition = self._stream_partition(params[STREAM_PARAM[kind]], now)
+                if self.db.is_removed(partition):
+                    # поток брошен и его раздел уже удалён - файл заново не создаём
+                    self.dropped += 1
+                    continue
+            elif kind == "alert" and self.db.partitioned:
+                # потоков в основном файле нет, сессию знает маршрут потока
+                route = self._streams.get(params[1])
+                if route is not None:
+                    kind, params = "session_alert", (params[0], route[1])
+            if partition not in groups:
+                groups[partition] = {kind: [] for kind in STATEMENTS}
+            groups[partition][kind].append(params)
+
+        # основной файл первым: сессии раньше их потоков
+        for partition in sorted(groups, key=lambda p: -1 if p is None else p):
+            grouped = groups[partition]
+            count = sum(len(rows) for rows in grouped.values())
+            try:
+                hashes = await self._store_bodies(grouped, partition)
+                await self.db.execute_batch([(STATEMENTS[kind], rows) for kind, rows in grouped.items()], partition)
+                self.bodies.remember(hashes, partition)
+                self.written += count
+            except Exception as e:
+                # id сообщений могли разойтись с БД - перечитаем
+                self._next_message_id.pop(partition, None)
+                logger.error(f"Failed to write {count} traffic events in one batch, retrying one by one: {e}")
+                await self._write_rows(grouped, partition)
+
+    async def _send(self, batch: List[Tuple[str, tuple]]):
+        try:
+            self.channel.put_nowait(batch)
+        except queue.Full:
+            # процесс-писатель не успевает: как при переполнении своей очереди
+            if self.overflow_policy == "block":
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.channel.put, batch)
+            elif self.overflow_policy == "spill":
+                self._channel_full = True
+                for event in batch:
+                    self._spill(event)
+                return
+            else:
+                self.dropped += len(batch)
+                logger.warning(f"Log writer process is behind, dropped {len(batch)} traffic events")
+                return
+        self.written += len(batch)
+
+    async def _write_rows(self, grouped, partition: Optional[int]):
+        # пачка не записалась (например, id уже занят) - пишем по строке, теряется только плохая.
+        # id сообщений выдаются заново, строка поиска идёт только за своим записанным сообщением
+        message_ids = {}
+        for kind, rows in grouped.items():
+            for row in rows:
+                if kind == "message":
+                    old_id, row = row[0], (await self._message_ids(partition, 1),) + row[1:]
+                elif kind == "search":
+                    if row[0] not in message_ids:
+                        continue
+                    row = (message_ids[row[0]],) + row[1:]
+                try:
+                    await self.db.execute_batch([(STATEMENTS[kind], [row])], partition)
+                except Exception as e:
+                    if kind != "body":
+                        self.dropped += 1
+                        logger.error(f"Failed to write traffic event {kind}: {e}")
+                    continue
+                if kind == "message":
+                    message_ids[old_id] = row[0]
+                if kind not in ("body", "search"):
+                    self.written += 1
+
+    def _remember_stream(self, stream_id: int, partition: Optional[int], session_id: int):
+        self._streams[stream_id] = (partition, session_id)
+        while len(self._streams) > STREAM_ROUTES:
+            self._streams.popitem(last=False)
+
+    def _stream_partition(self, stream_id: int, now: float) -> Optional[int]:
+        route = self._streams.get(stream_id)
+        if route is not None:
+            return route[0]
+        # поток открыт до перезапуска писателя - в текущий раздел
+        return self.db.partition_of(now)
+
+    async def _store_bodies(self, grouped, partition: Optional[int] = None) -> List[Optional[bytes]]:
+        # в событии message тело (7-й параметр) - сами байты; в БД уходит ссылка
+        # на bodies своего раздела. Хеш, сжатие и текст для поиска - в потоке,
+        # zlib/zstd отпускают GIL
+        messages = grouped["message"]
+        if not messages:
+            return []
+        # id сообщений выдаём сами: по ним же строки поискового индекса
+        first_id = await self._message_ids(partition, len(messages))
+        loop = asyncio.get_running_loop()
+        hashes, grouped["body"], grouped["search"] = await loop.run_in_executor(
+            None, self._prepare_messages, messages, first_id, partition)
+        grouped["message"] = [
+            (first_id + index,) + params[:6] + (digest,) + params[7:]
+            for index, (params, digest) in enumerate(zip(messages, hashes))
+        ]
+        return hashes
+
+    def _prepare_messages(self, messages: List[tuple], first_id: int, partition: Optional[int]):
+        hashes, bodies = self.bodies.prepare([params[6] for params in messages], partition)
+        search = []
+        if self.search_index and self.db.search_index:
+            search = [search_row(first_id + index, params) for index, params in enumerate(messages)]
+        return hashes, bodies, search
+
+    async def _message_ids(self, partition: Optional[int], count: int) -> int:
+        # сообщения в файл пишет только этот писатель, максимум читаем один раз
+        next_id = self._next_message_id.get(partition)
+        if next_id is None:
+            rows = await self.db.fetch_all("SELECT MAX(id) FROM messages", partition=partition)
+            next_id = ((rows[0][0] if rows else None) or 0) + 1
+        self._next_message_id[partition] = next_id + count
+        return next_id
+
+    def _spill(self, event: Tuple[str, tuple]):
+        try:
+            with open(self.spill_path, "ab") as f:
+                pickle.dump(event, f)
+            self._spill_pending += 1
+            self.spilled += 1
+        except Exception as e:
+            self.dropped += 1
+            logger.error(f"Failed to spill traffic event: {e}")
+
+    def _read_spill(self):
+        # забираем файл целиком, новые выгрузки пойдут в свежий
+        reading_path = self.spill_path + ".replay"
+        try:
+            os.replace(self.spill_path, reading_path)
+        except FileNotFoundError:
+            self._spill_pending = 0
+            return
+
+        batch = []
+        with open(reading_path, "rb") as f:
+            while True:
+                try:
+                    batch.append(pickle.load(f))
+                except EOFError:
+                    break
+                except Exception as e:
+                    logger.error(f"Corrupted spill file {reading_path}: {e}")
+                    break
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+        os.remove(reading_path)
+        # пока читали, могли выгрузиться новые события
+        self._spill_pending = 1 if os.path.exists(self.spill_path) else 0
+
+writer = TrafficWriter()
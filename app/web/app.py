@@ -4,8 +4,12 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import os
 import secrets
+from typing import Optional
 
+from app.core.control import ControlError
 from app.database.db import db
+from app.database.queries import list_sessions, session_details, stream_details
+from app.database.search import SearchIndexMissing, search_messages
 from config import config
 
 app = FastAPI(title="SmplWAF")
@@ -36,107 +40,159 @@ async def startup():
 async def shutdown():
     await db.close()
 
+def proxy_control():
+    # панель в отдельном процессе (PANEL_PROCESS, PROXY_WORKERS > 1): движок правил
+    # и IP-списки прокси доступны только через канал управления
+    return getattr(app.state, "control", None)
+
+def has_engine() -> bool:
+    return hasattr(app.state, 'rule_engine') or proxy_control() is not None
+
+async def reload_rules() -> int:
+    control = proxy_control()
+    if control is not None:
+        return min(await control.broadcast("reload"))
+    return await app.state.rule_engine.reload_rules_async()
+
+async def notify_proxy(cmd: str, **args):
+    # в одном процессе список общий с прокси, сообщать некому
+    control = proxy_control()
+    if control is not None:
+        await control.broadcast(cmd, **args)
+
+async def engine_stats() -> dict:
+    control = proxy_control()
+    if control is not None:
+        return await control.stats()
+    engine = app.state.rule_engine
+    pool = getattr(app.state, 'upstream_pool', None)
+    return {
+        "status": engine.status(),
+        "rules": engine.rule_stats(),
+        "quarantined": engine.quarantined(),
+        "pool": pool.stats() if pool is not None else {"enabled": False},
+    }
+
 @app.get("/")
 async def index(username: str = Depends(get_current_username)):
     return FileResponse(os.path.join(static_dir, "index.html"))
 
 @app.get("/api/sessions")
-async def get_sessions(username: str = Depends(get_current_username)):
+async def get_sessions(limit: int = 50, cursor: Optional[str] = None, username: str = Depends(get_current_username)):
+    # страница без потоков и тел, следующая - по next_cursor
     try:
-        #потом сделать пагинацию, а не рендерить на одной странице разом
-        user_sessions_rows = await db.fetch_all("SELECT * FROM user_sessions ORDER BY last_activity_time DESC LIMIT 50")
-        user_sessions = [dict(row) for row in user_sessions_rows]
-
-        for us in user_sessions:
-            streams_rows = await db.fetch_all(
-                "SELECT * FROM tcp_streams WHERE user_session_id = ? ORDER BY start_time ASC",
-                (us['id'],)
-            )
-            streams = [dict(row) for row in streams_rows]
-
-            us_tags = set()
-            for stream in streams:
-                msgs_rows = await db.fetch_all(
-                    "SELECT id, type, method, url, status_code, tags, headers, body, timestamp FROM messages WHERE tcp_stream_id = ? ORDER BY timestamp ASC",
-                    (stream['id'],)
-                )
-                stream['messages'] = []
-                for m in msgs_rows:
-                    msg_dict = dict(m)
-                    if isinstance(msg_dict.get('body'), bytes):
-                        try:
-                            msg_dict['body'] = msg_dict['body'].decode('utf-8', errors='replace')
-                        except:
-                            msg_dict['body'] = "[Binary Data]"
-
-                    #теги
-                    if msg_dict.get('tags'):
-                        try:
-                            import json
-                            tags_list = json.loads(msg_dict['tags'])
-                            for t in tags_list:
-                                us_tags.add(t)
-                        except:
-                            pass
-
-                    stream['messages'].append(msg_dict)
-
-            us['streams'] = streams
-            us['tags'] = list(us_tags)
-
-        return JSONResponse(content=user_sessions)
+        return JSONResponse(content=await list_sessions(limit, cursor))
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Неверный курсор"})
     except Exception as e:
         import traceback
         traceback.print_exc()
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: int, bodies: bool = False, username: str = Depends(get_current_username)):
+    # потоки и сообщения сессии; заголовки и тела только с ?bodies=1
+    session = await session_details(session_id, bodies)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Сессия не найдена"})
+    return JSONResponse(content=session)
+
 @app.get("/api/stream/{stream_id}")
 async def get_stream_details(stream_id: int, username: str = Depends(get_current_username)):
-    stream = await db.fetch_all("SELECT * FROM tcp_streams WHERE id = ?", (stream_id,))
-    if not stream:
+    stream = await stream_details(stream_id)
+    if stream is None:
         return JSONResponse(status_code=404, content={"error": "Поток не найден"})
 
-    messages = await db.fetch_all("SELECT * FROM messages WHERE tcp_stream_id = ?", (stream_id,))
-
-    result = dict(stream[0])
-    result['messages'] = []
-    for m in messages:
-        msg_dict = dict(m)
-        if isinstance(msg_dict.get('body'), bytes):
-            try:
-                msg_dict['body'] = msg_dict['body'].decode('utf-8', errors='replace')
-            except:
-                msg_dict['body'] = "[Binary Data]"
-        result['messages'].append(msg_dict)
+    return JSONResponse(content=stream)
 
-    return JSONResponse(content=result)
+@app.get("/api/search")
+async def search(q: str, limit: int = 50, cursor: Optional[str] = None, ip: Optional[str] = None,
+                 port: Optional[int] = None, tag: Optional[str] = None, status: Optional[int] = None,
+                 since: Optional[float] = None, until: Optional[float] = None,
+                 username: str = Depends(get_current_username)):
+    # полнотекстовый поиск по url, заголовкам и телам; следующая страница - по next_cursor
+    try:
+        page = await search_messages(q, limit, cursor, client_ip=ip, client_port=port, tag=tag,
+                                     status=status, since=since, until=until)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Неверный запрос или курсор"})
+    except SearchIndexMissing as e:
+        return JSONResponse(status_code=503, content={"error": f"Поиск недоступен: {e}"})
+    except Exception as e:
+        # запрос, который FTS5 не разобрал, ищется как фраза - сюда попадают ошибки самой БД
+        import traceback
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    return JSONResponse(content=page)
 
 @app.post("/api/rules/block_ip")
 async def block_ip(request: Request, username: str = Depends(get_current_username)):
+    # старый адрес кнопки "заблокировать IP", теперь пишет в блок-лист, а не генерирует правило
     try:
         data = await request.json()
         ip = data.get("ip")
         if not ip:
             raise HTTPException(status_code=400, detail="Нужно указать IP")
 
-        rule_content = f"if request.client_ip == '{ip}': action.drop()"
+        if not hasattr(app.state, 'ip_list'):
+            return JSONResponse(status_code=503, content={"error": "Блок-лист недоступен"})
 
+        changed, invalid = app.state.ip_list.add("block", [ip])
+        if invalid:
+            return JSONResponse(status_code=400, content={"error": f"Неверный IP: {ip}"})
+        if changed:
+            await notify_proxy("block_ip", ip=ip)
+        return JSONResponse(content={"status": "ok", "message": f"IP {ip} заблокирован"})
 
-        if hasattr(app.state, 'rule_engine'):
-            success = app.state.rule_engine.add_rule(f"block_{ip.replace('.', '_')}", rule_content)
-            if success:
-                return JSONResponse(content={"status": "ok", "message": f"IP {ip} заблокирован"})
-            else:
-                return JSONResponse(status_code=500, content={"error": "Не удалось добавить правило"})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+# блок/белый списки IP, применяются сразу без перезагрузки правил
+
+IP_LIST_NAMES = ("block", "allow")
+
+@app.get("/api/ip/list")
+async def get_ip_lists(username: str = Depends(get_current_username)):
+    if not hasattr(app.state, 'ip_list'):
+        return JSONResponse(status_code=503, content={"error": "Блок-лист недоступен"})
+    return JSONResponse(content=app.state.ip_list.to_dict())
+
+@app.post("/api/ip/{list_name}/{operation}")
+async def update_ip_list(list_name: str, operation: str, request: Request, username: str = Depends(get_current_username)):
+    try:
+        if list_name not in IP_LIST_NAMES or operation not in ("add", "remove"):
+            raise HTTPException(status_code=404, detail="Неизвестный список или операция")
+
+        data = await request.json()
+        ips = data.get("ips")
+        if isinstance(ips, str):
+            ips = ips.split()
+        if not ips:
+            raise HTTPException(status_code=400, detail="Нужно указать список ips")
+
+        if not hasattr(app.state, 'ip_list'):
+            return JSONResponse(status_code=503, content={"error": "Блок-лист недоступен"})
+
+        if operation == "add":
+            changed, invalid = app.state.ip_list.add(list_name, ips)
         else:
-            return JSONResponse(status_code=503, content={"error": "Движок правил недоступен"})
+            changed, invalid = app.state.ip_list.remove(list_name, ips)
+        if changed:
+            await notify_proxy("ip", list=list_name, operation=operation, ips=changed)
 
+        return JSONResponse(content={"status": "ok", "changed": changed, "invalid": invalid})
+    except HTTPException as he:
+        raise he
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 # ниже управление правилами
 
 RULES_ROOT = "rules"
+RULE_EXTENSIONS = (".rule", ".sig")
+DISABLED_SUFFIX = ".disabled"
 
 def validate_rule_path(path: str):
 
@@ -154,11 +210,12 @@ async def list_rules(username: str = Depends(get_current_username)):
 
     for root, dirs, files in os.walk(RULES_ROOT):
         for file in files:
-            if file.endswith(".rule") or file.endswith(".rule.disabled"):
+            enabled = file.endswith(RULE_EXTENSIONS)
+            if enabled or (file.endswith(DISABLED_SUFFIX) and file[:-len(DISABLED_SUFFIX)].endswith(RULE_EXTENSIONS)):
                 rel_path = os.path.relpath(os.path.join(root, file), RULES_ROOT)
                 files_list.append({
                     "path": rel_path,
-                    "enabled": file.endswith(".rule")
+                    "enabled": enabled
                 })
 
     files_list.sort(key=lambda x: x["path"])
@@ -175,10 +232,10 @@ async def toggle_rule(request: Request, username: str = Depends(get_current_user
         full_path = validate_rule_path(path)
 
         # расширение для выключения правил
-        if path.endswith(".rule"):
-            new_path = full_path + ".disabled"
-        elif path.endswith(".rule.disabled"):
-            new_path = full_path[:-9] 
+        if path.endswith(RULE_EXTENSIONS):
+            new_path = full_path + DISABLED_SUFFIX
+        elif path.endswith(DISABLED_SUFFIX) and path[:-len(DISABLED_SUFFIX)].endswith(RULE_EXTENSIONS):
+            new_path = full_path[:-len(DISABLED_SUFFIX)]
         else:
             raise HTTPException(status_code=400, detail="Неверный формат файла")
 
@@ -188,8 +245,8 @@ async def toggle_rule(request: Request, username: str = Depends(get_current_user
         os.rename(full_path, new_path)
 
         # рестарт движка
-        if hasattr(app.state, 'rule_engine'):
-            app.state.rule_engine.reload_rules()
+        if has_engine():
+            await reload_rules()
 
         return JSONResponse(content={"status": "ok", "message": "Состояние правила изменено"})
     except HTTPException as he:
@@ -211,8 +268,8 @@ async def delete_rule(request: Request, username: str = Depends(get_current_user
 
         os.remove(full_path)
 
-        if hasattr(app.state, 'rule_engine'):
-            app.state.rule_engine.reload_rules()
+        if has_engine():
+            await reload_rules()
 
         return JSONResponse(content={"status": "ok", "message": "Правило удалено"})
     except HTTPException as he:
@@ -244,8 +301,8 @@ async def rename_rule(request: Request, username: str = Depends(get_current_user
 
         os.rename(full_old_path, full_new_path)
 
-        if hasattr(app.state, 'rule_engine'):
-            app.state.rule_engine.reload_rules()
+        if has_engine():
+            await reload_rules()
 
         return JSONResponse(content={"status": "ok", "message": "Правило переименовано"})
     except HTTPException as he:
@@ -294,11 +351,100 @@ async def save_rule_content(request: Request, username: str = Depends(get_curren
 
 @app.post("/api/rules/reload")
 async def reload_rules_endpoint(username: str = Depends(get_current_username)):
-    if hasattr(app.state, 'rule_engine'):
+    if has_engine():
         try:
-            app.state.rule_engine.reload_rules()
-            return JSONResponse(content={"status": "ok", "message": "Движок правил перезагружен, правила обновлены"})
+            generation = await reload_rules()
+            return JSONResponse(content={"status": "ok", "message": "Движок правил перезагружен, правила обновлены", "generation": generation})
         except Exception as e:
             return JSONResponse(status_code=500, content={"error": str(e)})
     else:
         return JSONResponse(status_code=503, content={"error": "Движок правил недоступен"})
+
+@app.get("/api/rules/status")
+async def rules_status(username: str = Depends(get_current_username)):
+    if not has_engine():
+        return JSONResponse(status_code=503, content={"error": "Движок правил недоступен"})
+
+    try:
+        stats = await engine_stats()
+    except ControlError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    return JSONResponse(content=stats["status"])
+
+@app.get("/api/proxy/pool")
+async def proxy_pool_stats(username: str = Depends(get_current_username)):
+    if proxy_control() is None:
+        pool = getattr(app.state, 'upstream_pool', None)
+        if pool is None:
+            return JSONResponse(content={"enabled": False})
+        return JSONResponse(content=pool.stats())
+
+    try:
+        stats = await engine_stats()
+    except ControlError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    return JSONResponse(content=stats["pool"])
+
+@app.get("/api/rules/stats")
+async def rules_stats(username: str = Depends(get_current_username)):
+    if not has_engine():
+        return JSONResponse(status_code=503, content={"error": "Движок правил недоступен"})
+
+    try:
+        stats = await engine_stats()
+    except ControlError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    return JSONResponse(content={"generation": stats["status"]["generation"], "rules": stats["rules"]})
+
+@app.post("/api/rules/stats/reset")
+async def rules_stats_reset(request: Request, username: str = Depends(get_current_username)):
+    if not has_engine():
+        return JSONResponse(status_code=503, content={"error": "Движок правил недоступен"})
+
+    # без тела - сброс всех счётчиков, {"path": ...} - одного правила
+    data = {}
+    if await request.body():
+        data = await request.json()
+    control = proxy_control()
+    try:
+        if control is not None:
+            reset = max(await control.broadcast("reset_stats", path=data.get("path")))
+        else:
+            reset = app.state.rule_engine.reset_stats(data.get("path"))
+    except ControlError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    return JSONResponse(content={"status": "reset", "rules": reset})
+
+@app.get("/api/rules/quarantine")
+async def rules_quarantine(username: str = Depends(get_current_username)):
+    if not has_engine():
+        return JSONResponse(status_code=503, content={"error": "Движок правил недоступен"})
+
+    try:
+        stats = await engine_stats()
+    except ControlError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    return JSONResponse(content={"quarantined": stats["quarantined"]})
+
+@app.post("/api/rules/quarantine/release")
+async def rules_quarantine_release(request: Request, username: str = Depends(get_current_username)):
+    if not has_engine():
+        return JSONResponse(status_code=503, content={"error": "Движок правил недоступен"})
+
+    data = await request.json()
+    path = data.get("path")
+    if not path:
+        return JSONResponse(status_code=400, content={"error": "Не указан путь"})
+
+    control = proxy_control()
+    try:
+        if control is not None:
+            released = any(await control.broadcast("release", path=path))
+        else:
+            released = await app.state.rule_engine.release(path)
+    except ControlError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    if not released:
+        return JSONResponse(status_code=404, content={"error": "Правило не в карантине"})
+
+    return JSONResponse(content={"status": "released", "path": path})
@@ -0,0 +1,386 @@
+"""
+Нагрузочный стенд прокси: TcpProxy в отдельном процессе перед локальным
+asyncio HTTP-сервисом, генератор нагрузки в основном процессе.
+
+    python -m bench.proxy_bench                       # все сценарии
+    python -m bench.proxy_bench -s keepalive -s rules_100 -o results.json
+    python -m bench.proxy_bench --replay requests.jsonl
+
+Результаты пишутся в JSON (ключи отсортированы), так что файлы разных коммитов
+можно сравнивать обычным diff.
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@dataclass
+class Scenario:
+    name: str
+    requests: int = 2000
+    concurrency: int = 16
+    keep_alive: bool = True
+    body_size: int = 0
+    rules: int = 0 # сгенерированных правил в global/
+    db_logging: bool = False
+    upstream_pool: bool = False
+    replay: Optional[str] = None # JSONL с запросами вместо синтетического GET/POST
+
+SCENARIOS = [
+    Scenario("keepalive"),
+    Scenario("conn_per_request", keep_alive=False),
+    Scenario("pooled_conn_per_request", keep_alive=False, upstream_pool=True),
+    Scenario("body_1k", body_size=1024),
+    Scenario("body_64k", body_size=64 * 1024, requests=500),
+    Scenario("rules_100", rules=100),
+    Scenario("rules_1000", rules=1000, requests=1000),
+    Scenario("db_logging", db_logging=True),
+    Scenario("db_logging_rules_100", db_logging=True, rules=100),
+]
+
+# --- сервис-заглушка ---------------------------------------------------------
+
+RESPONSE_BODY = b"ok"
+
+async def _upstream_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lower = head.lower()
+            length = 0
+            if b"content-length:" in lower:
+                length = int(lower.split(b"content-length:", 1)[1].split(b"\r\n", 1)[0])
+            if length:
+                await reader.readexactly(length)
+
+            close = b"connection: close" in lower
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s\r\n%s" % (
+                len(RESPONSE_BODY), b"Connection: close\r\n" if close else b"", RESPONSE_BODY))
+            await writer.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_upstream():
+    server = await asyncio.start_server(_upstream_handler, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+# --- нагрузка ----------------------------------------------------------------
+
+def load_replay(path: str) -> List[bytes]:
+    """
+    Строка JSONL - один запрос. Либо {"raw": "..."} с сырым HTTP, либо поля
+    method/path/headers/body. Остальные строки (например, записи бэклога с
+    request_id/title/body) превращаются в POST /<request_id> с body в теле.
+    """
+    requests = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if "raw" in item:
+                requests.append(item["raw"].encode("utf-8"))
+                continue
+
+            body = item.get("body", "")
+            body = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+            method = item.get("method", "POST" if body else "GET")
+            path_ = item.get("path") or "/" + str(item.get("request_id", ""))
+            headers = dict(item.get("headers") or {})
+            headers.setdefault("Host", "bench")
+            requests.append(build_request(method, path_, headers, body))
+    return requests
+
+def build_request(method: str, path: str, headers: Dict[str, str], body: bytes) -> bytes:
+    headers = {k: v for k, v in headers.items() if k.lower() not in ("content-length", "connection")}
+    if body or method in ("POST", "PUT", "PATCH"):
+        headers["Content-Length"] = str(len(body))
+    head = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+    return head.encode("utf-8") + b"\r\n" + body
+
+def synthetic_requests(scenario: Scenario) -> List[bytes]:
+    if scenario.body_size:
+        body = (b"a=" + b"x" * scenario.body_size)[:scenario.body_size]
+        return [build_request("POST", "/bench", {"Host": "bench", "Content-Type": "application/x-www-form-urlencoded"}, body)]
+    return [build_request("GET", "/bench?id=1", {"Host": "bench", "User-Agent": "bench"}, b"")]
+
+def with_close(raw: bytes) -> bytes:
+    head, sep, body = raw.partition(b"\r\n\r\n")
+    return head + b"\r\nConnection: close" + sep + body
+
+async def read_response(reader: asyncio.StreamReader) -> bytes:
+    head = await reader.readuntil(b"\r\n\r\n")
+    lower = head.lower()
+    if b"content-length:" in lower:
+        length = int(lower.split(b"content-length:", 1)[1].split(b"\r\n", 1)[0])
+        await reader.readexactly(length)
+    return head
+
+async def drive(port: int, scenario: Scenario, workload: List[bytes]) -> Dict[str, Any]:
+    if not scenario.keep_alive:
+        workload = [with_close(raw) for raw in workload]
+
+    latencies: List[float] = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal errors, next_index
+        reader = writer = None
+        while next_index < scenario.requests:
+            raw = workload[next_index % len(workload)]
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(raw)
+                await writer.drain()
+                await read_response(reader)
+                latencies.append(time.perf_counter() - started)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                # правило могло закрыть соединение
+                errors += 1
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                continue
+
+            if not scenario.keep_alive:
+                writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(scenario.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "completed": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {name: round(percentile(latencies, p) * 1000, 3)
+                       for name, p in (("p50", 50), ("p99", 99), ("p999", 99.9))},
+    }
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * p / 100))
+    return values[index]
+
+# --- процесс прокси ----------------------------------------------------------
+
+def write_rules(rules_dir: str, count: int):
+    global_dir = os.path.join(rules_dir, "global")
+    os.makedirs(global_dir, exist_ok=True)
+    for i in range(count):
+        # типичное правило: поиск подстроки в теле и регулярка по пути
+        with open(os.path.join(global_dir, f"bench_{i:04d}.rule"), "w") as f:
+            if i % 2:
+                f.write(f"if 'needle{i}' in request.data:\n    action.drop()\n")
+            else:
+                f.write(f"if re.search(r'/admin{i}\\b', request.path):\n    action.mark('bench{i}')\n")
+
+def _proxy_process(conn, scenario: Dict[str, Any], upstream_port: int, workdir: str):
+    # относительные пути (rules/, data/) - внутри временного каталога
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+    scenario = Scenario(**scenario)
+    asyncio.run(_serve_proxy(conn, scenario, upstream_port))
+
+async def _serve_proxy(conn, scenario: Scenario, upstream_port: int):
+    from app.core.proxy import TcpProxy
+    from app.core.session import SessionManager
+    from app.database.db import db
+    from app.database.writer import writer
+
+    write_rules("rules", scenario.rules)
+
+    if scenario.db_logging:
+        db.db_path = os.path.join("data", "bench.sqlite")
+        await db.connect()
+        await writer.start()
+    else:
+        # прокси без записи в БД: меряем только разбор, правила и пересылку
+        async def start_stream(*args, **kwargs):
+            return 0
+
+        async def noop(*args, **kwargs):
+            pass
+
+        SessionManager.start_stream = staticmethod(start_stream)
+        for name in ("close_stream", "log_request", "log_response", "update_session_alert"):
+            setattr(SessionManager, name, staticmethod(noop))
+
+    proxy = TcpProxy("127.0.0.1", 0, "127.0.0.1", upstream_port, upstream_pool=scenario.upstream_pool)
+    serve_task = asyncio.create_task(proxy.start())
+    while proxy.server is None:
+        await asyncio.sleep(0.01)
+
+    loop = asyncio.get_running_loop()
+    conn.send(("ready", proxy.server.sockets[0].getsockname()[1]))
+
+    await loop.run_in_executor(None, conn.recv) # start
+    cpu_started = time.process_time()
+    conn.send("started")
+
+    await loop.run_in_executor(None, conn.recv) # stop
+    cpu = time.process_time() - cpu_started
+
+    serve_task.cancel()
+    # клиенты уже отключились, даём обработчикам соединений доработать
+    handlers = asyncio.all_tasks() - {asyncio.current_task(), serve_task}
+    if handlers:
+        await asyncio.wait(handlers, timeout=2)
+    if scenario.db_logging:
+        await writer.stop()
+        await db.close()
+    proxy.rule_engine.close()
+
+    conn.send({
+        "cpu_s": round(cpu, 3),
+        # ru_maxrss в Linux - килобайты
+        "rss_max_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "rss_kb": current_rss_kb(),
+        "rules_loaded": len(proxy.rule_engine.rules),
+        "pool": proxy.upstream_pool.stats() if proxy.upstream_pool else None,
+    })
+
+def current_rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+async def run_scenario(scenario: Scenario) -> Dict[str, Any]:
+    server, upstream_port = await start_upstream()
+    workdir = tempfile.mkdtemp(prefix="smplwaf_bench_")
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(
+        target=_proxy_process,
+        args=(child_conn, dataclasses.asdict(scenario), upstream_port, workdir),
+        daemon=True
+    )
+    process.start()
+    loop = asyncio.get_running_loop()
+
+    try:
+        _, proxy_port = await loop.run_in_executor(None, parent_conn.recv)
+        workload = load_replay(scenario.replay) if scenario.replay else synthetic_requests(scenario)
+
+        # прогрев: импорты, кеши, первые соединения
+        warmup = dataclasses.replace(scenario, requests=min(100, scenario.requests))
+        await drive(proxy_port, warmup, workload)
+
+        parent_conn.send("start")
+        await loop.run_in_executor(None, parent_conn.recv)
+        result = await drive(proxy_port, scenario, workload)
+        parent_conn.send("stop")
+        result["proxy"] = await loop.run_in_executor(None, parent_conn.recv)
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+        server.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result["scenario"] = dataclasses.asdict(scenario)
+    return result
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(scenarios: List[Scenario]) -> Dict[str, Any]:
+    results = {}
+    for scenario in scenarios:
+        print(f"[bench] {scenario.name} ...", file=sys.stderr, flush=True)
+        results[scenario.name] = await run_scenario(scenario)
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "scenarios": results,
+    }
+
+def print_table(report: Dict[str, Any]):
+    print(f"{'scenario':<28}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'cpu s':>8}{'rss MB':>8}{'err':>6}")
+    for name, r in report["scenarios"].items():
+        lat = r["latency_ms"]
+        print(f"{name:<28}{r['rps']:>10}{lat['p50']:>10}{lat['p99']:>10}{lat['p999']:>10}"
+              f"{r['proxy']['cpu_s']:>8}{r['proxy']['rss_max_kb'] // 1024:>8}{r['errors']:>6}")
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="SimpleWAF proxy benchmark")
+    parser.add_argument("-s", "--scenario", action="append", help="run only these scenarios")
+    parser.add_argument("-o", "--output", help="write JSON results here")
+    parser.add_argument("-n", "--requests", type=int, help="override request count")
+    parser.add_argument("-c", "--concurrency", type=int, help="override concurrency")
+    parser.add_argument("--replay", help="JSONL workload, replayed against the keepalive/conn_per_request scenarios")
+    parser.add_argument("--list", action="store_true", help="list scenarios and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for s in SCENARIOS:
+            print(s.name)
+        return
+
+    scenarios = SCENARIOS
+    if args.replay:
+        scenarios = [Scenario("replay_keepalive", replay=args.replay),
+                     Scenario("replay_conn_per_request", keep_alive=False, replay=args.replay)]
+    if args.scenario:
+        known = {s.name: s for s in scenarios}
+        unknown = [name for name in args.scenario if name not in known]
+        if unknown:
+            parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+        scenarios = [known[name] for name in args.scenario]
+
+    overrides = {}
+    if args.requests:
+        overrides["requests"] = args.requests
+    if args.concurrency:
+        overrides["concurrency"] = args.concurrency
+    scenarios = [dataclasses.replace(s, **overrides) for s in scenarios]
+
+    report = asyncio.run(run(scenarios))
+    print_table(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+if __name__ == "__main__":
+    main()
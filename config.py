@@ -20,6 +20,110 @@ class Config:
     # Путь к БД
     DB_PATH = "data/db.sqlite"
 
+    # SQLite в режиме WAL: запись трафика и чтение панели идут параллельно.
+    # Значения pragma см. в документации SQLite (cache_size < 0 - в килобайтах)
+    DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+    DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-20000"))
+    DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+    DB_TEMP_STORE = os.getenv("DB_TEMP_STORE", "MEMORY")
+    DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "5000"))  # мс
+    # соединения только на чтение для панели, 0 - читать через соединение записи
+    DB_READERS = int(os.getenv("DB_READERS", "2"))
+    # фоновый checkpoint WAL, секунды; 0 - автоматический checkpoint SQLite при коммитах
+    DB_CHECKPOINT_INTERVAL = float(os.getenv("DB_CHECKPOINT_INTERVAL", "10"))
+    # после checkpoint файл WAL обрезается до этого размера
+    DB_WAL_SIZE_LIMIT = int(os.getenv("DB_WAL_SIZE_LIMIT", str(64 * 1024 * 1024)))
+
+    # Трафик (потоки, сообщения, тела) пишется в отдельный файл на каждый период,
+    # сессии остаются в DB_PATH. 0 - всё в одном файле
+    DB_PARTITION_MINUTES = float(os.getenv("DB_PARTITION_MINUTES", "30"))
+    # разделы старше этого удаляются целиком (0 - хранить всё);
+    # с DB_ARCHIVE_DIR не удаляются, а переносятся туда
+    DB_RETENTION_HOURS = float(os.getenv("DB_RETENTION_HOURS", "0"))
+    DB_ARCHIVE_DIR = os.getenv("DB_ARCHIVE_DIR", "")
+
+    # Полнотекстовый поиск (FTS5) по url, заголовкам и текстовым телам, /api/search.
+    # Из тела индексируется начало SEARCH_BODY_MAX_SIZE байт после распаковки gzip/deflate
+    SEARCH_INDEX = os.getenv("SEARCH_INDEX", "1") == "1"
+    SEARCH_BODY_MAX_SIZE = int(os.getenv("SEARCH_BODY_MAX_SIZE", str(64 * 1024)))
+
+    # Фоновая запись трафика в БД (пачками, одна транзакция на пачку)
+    LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.5"))  # секунды
+    LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    # что делать при переполнении очереди: drop | block | spill
+    LOG_OVERFLOW_POLICY = os.getenv("LOG_OVERFLOW_POLICY", "spill")
+    LOG_SPILL_PATH = os.getenv("LOG_SPILL_PATH", "data/log_spill.bin")
+
+    # Блок/белый список IP (проверяется до подключения к сервису)
+    IP_LISTS_PATH = os.getenv("IP_LISTS_PATH", "data/ip_lists.json")
+
+    # Правила: когда вердикт уже не может измениться, выполнять только сигнатуры и
+    # правила, которые лишь ставят теги (action.mark без drop/accept). Теги правил
+    # с drop/accept (в том числе автотеги DROP) после вердикта не собираются
+    RULES_SHORT_CIRCUIT = os.getenv("RULES_SHORT_CIRCUIT", "0") == "1"
+
+    # Бюджет времени правил (мс, 0 - без ограничения)
+    RULE_TIME_BUDGET_MS = float(os.getenv("RULE_TIME_BUDGET_MS", "50"))
+    # процессорное время потока на все правила запроса; по умолчанию выключен
+    REQUEST_TIME_BUDGET_MS = float(os.getenv("REQUEST_TIME_BUDGET_MS", "0"))
+    # вердикт, если из-за бюджета запроса часть правил пропущена (тег budget_exceeded):
+    # DROP (среди пропущенных мог быть DROP, медленными ранними правилами их не обойти) или ACCEPT
+    REQUEST_BUDGET_FALLBACK = os.getenv("REQUEST_BUDGET_FALLBACK", "DROP")
+    # после стольких превышений правило уходит в карантин (0 - никогда)
+    RULE_QUARANTINE_AFTER = int(os.getenv("RULE_QUARANTINE_AFTER", "0"))
+
+    # Тяжёлые правила ("# @heavy") выполняются в пуле процессов с дедлайном
+    HEAVY_RULE_TIMEOUT_MS = float(os.getenv("HEAVY_RULE_TIMEOUT_MS", "200"))
+    HEAVY_RULE_WORKERS = int(os.getenv("HEAVY_RULE_WORKERS", "2"))
+    # вердикт, если тяжёлое правило не уложилось или пул процессов сломался: ACCEPT (ничего не делать) или DROP
+    HEAVY_RULE_FALLBACK = os.getenv("HEAVY_RULE_FALLBACK", "ACCEPT")
+
+    # Ответ на запрос, отклонённый правилами: соединение остаётся открытым.
+    # 0 - без ответа, соединение закрывается
+    DROP_RESPONSE_STATUS = int(os.getenv("DROP_RESPONSE_STATUS", "403"))
+    DROP_RESPONSE_BODY = os.getenv("DROP_RESPONSE_BODY", "Forbidden")
+
+    # Ранние фазы правил: stream-правило видит столько байт предыдущих кусков тела
+    STREAM_LOOKBEHIND = int(os.getenv("STREAM_LOOKBEHIND", "1024"))
+    # тело больше этого отправляется в сервис по мере чтения, не дожидаясь конца
+    # сообщения (последний байт ждёт вердикта правил); 0 - всегда целиком
+    STREAM_BODY_THRESHOLD = int(os.getenv("STREAM_BODY_THRESHOLD", str(64 * 1024)))
+
+    # Тело сообщения в памяти (байт): больше - во временный файл;
+    # больше BODY_MAX_SIZE не сохраняется вовсе (правила видят начало)
+    BODY_MEMORY_LIMIT = int(os.getenv("BODY_MEMORY_LIMIT", str(1024 * 1024)))
+    BODY_MAX_SIZE = int(os.getenv("BODY_MAX_SIZE", str(16 * 1024 * 1024)))
+
+    # Тела в БД: одинаковые хранятся один раз, сжатые (auto - zstd, если установлен
+    # zstandard, иначе zlib; raw - без сжатия). Больше BODY_STORE_MAX_SIZE байт
+    # сохраняется только начало, панель помечает такое тело как обрезанное (0 - целиком)
+    BODY_STORE_CODEC = os.getenv("BODY_STORE_CODEC", "auto")
+    BODY_STORE_MAX_SIZE = int(os.getenv("BODY_STORE_MAX_SIZE", str(1024 * 1024)))
+
+    # Распаковка gzip/deflate тела для правил (request.decoded_body): не больше
+    # BODY_DECODE_MAX_SIZE байт и не больше BODY_DECODE_MAX_RATIO к сжатому
+    BODY_DECODE_MAX_SIZE = int(os.getenv("BODY_DECODE_MAX_SIZE", str(16 * 1024 * 1024)))
+    BODY_DECODE_MAX_RATIO = float(os.getenv("BODY_DECODE_MAX_RATIO", "100"))
+
+    # Размер буфера чтения на каждую сторону соединения
+    RELAY_BUFFER_SIZE = int(os.getenv("RELAY_BUFFER_SIZE", str(64 * 1024)))
+
+    # Пул соединений к сервису (только для HTTP-сервисов: соединения переиспользуются между клиентами)
+    UPSTREAM_POOL = os.getenv("UPSTREAM_POOL", "0") == "1"
+    UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))
+    UPSTREAM_POOL_IDLE_TIMEOUT = float(os.getenv("UPSTREAM_POOL_IDLE_TIMEOUT", "30"))
+
+    # Процессы прокси на одном порту (SO_REUSEPORT), у каждого свой движок правил.
+    # 1 - всё в одном процессе, 0 - по числу ядер
+    PROXY_WORKERS = int(os.getenv("PROXY_WORKERS", "1"))
+
+    # Панель в отдельном процессе, чтобы запросы к UI не задерживали трафик.
+    # При PROXY_WORKERS > 1 включается всегда. С прокси говорит через Unix-сокет
+    PANEL_PROCESS = os.getenv("PANEL_PROCESS", "0") == "1"
+    CONTROL_SOCKET = os.getenv("CONTROL_SOCKET", "data/control.sock")
+    CONTROL_TIMEOUT = float(os.getenv("CONTROL_TIMEOUT", "5"))
+
     # Уровень логирования
     LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
 
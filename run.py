@@ -11,7 +11,9 @@ sys.path.append(os.getcwd())
 from config import config
 from app.core.proxy import TcpProxy
 from app.database.db import db
+from app.database.writer import writer
 from app.web.app import app as web_app 
+from app.core.workers import Supervisor, worker_count
 
 
 logging.basicConfig(
@@ -33,27 +35,39 @@ async def run_proxy():
 
 
     web_app.state.rule_engine = proxy.rule_engine
+    web_app.state.ip_list = proxy.ip_list
+    web_app.state.upstream_pool = proxy.upstream_pool
 
 
     await db.connect()
+    await writer.start()
 
     try:
         await proxy.start()
     except asyncio.CancelledError:
         pass
+    finally:
+        # пул процессов для тяжёлых правил
+        proxy.rule_engine.close()
+        if proxy.upstream_pool is not None:
+            await proxy.upstream_pool.close()
 
 async def run_web():
     config_uvicorn = uvicorn.Config(web_app, host="0.0.0.0", port=config.WEB_PORT, log_level="info")
     server = uvicorn.Server(config_uvicorn)
     await server.serve()
 
-async def main():
+def banner(workers: int):
     print("="*60)
     print(f"Файрволл запущен")
     print(f"Прокси слушает: {config.PROXY_HOST}:{config.PROXY_PORT} -> {config.TARGET_HOST}:{config.TARGET_PORT}")
+    if workers > 1:
+        print(f"Процессов прокси: {workers}")
     print(f"Панель управления: http://localhost:{config.WEB_PORT}")
     print("="*60)
 
+async def main():
+    banner(1)
 
     try:
         await asyncio.gather(
@@ -63,10 +77,18 @@ async def main():
     except KeyboardInterrupt:
         logger.info("Остановка...")
     finally:
+        # дописываем всё, что осталось в очереди, до закрытия БД
+        await writer.stop()
         await db.close()
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        pass
+    workers = worker_count()
+    if workers > 1 or config.PANEL_PROCESS:
+        # воркеры, писатель логов и панель - отдельные процессы
+        banner(workers)
+        sys.exit(Supervisor(workers).run())
+    else:
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
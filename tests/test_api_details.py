@@ -18,25 +18,26 @@ async def test_api_details():
             assert resp.status == 200
 
             data = await resp.json()
-            print(f"Sessions: {len(data)}")
+            print(f"Sessions: {len(data['sessions'])}")
 
-            # Find a session with messages
+            # потоки и сообщения отдаются отдельно для каждой сессии
             found_msg = False
-            for s in data:
-                if 'streams' in s:
-                    for st in s['streams']:
-                        if 'messages' in st:
-                            for m in st['messages']:
-                                print(f"Checking Message ID {m['id']}...")
-                                if 'timestamp' in m:
-                                    print(f"PASS: Timestamp present: {m['timestamp']}")
-                                    assert m['timestamp'] is not None
-                                    found_msg = True
-                                else:
-                                    print("FAIL: Timestamp missing!")
-                                    assert False
-                                break
-                        if found_msg: break
+            for s in data['sessions']:
+                async with session.get(f"{url}/{s['id']}", auth=auth) as details:
+                    assert details.status == 200
+                    s = await details.json()
+                for st in s['streams']:
+                    for m in st['messages']:
+                        print(f"Checking Message ID {m['id']}...")
+                        if 'timestamp' in m:
+                            print(f"PASS: Timestamp present: {m['timestamp']}")
+                            assert m['timestamp'] is not None
+                            found_msg = True
+                        else:
+                            print("FAIL: Timestamp missing!")
+                            assert False
+                        break
+                    if found_msg: break
                 if found_msg: break
 
             if not found_msg:
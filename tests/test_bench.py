@@ -0,0 +1,42 @@
+import unittest
+import asyncio
+import json
+import os
+import shutil
+from bench.proxy_bench import Scenario, load_replay, run_scenario
+
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/data_bench"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_load_replay(self):
+        path = os.path.join(self.test_dir, "workload.jsonl")
+        with open(path, "w") as f:
+            f.write(json.dumps({"raw": "GET /raw HTTP/1.1\r\n\r\n"}) + "\n")
+            f.write(json.dumps({"method": "PUT", "path": "/x", "headers": {"X-A": "1"}, "body": "abc"}) + "\n")
+            f.write(json.dumps({"request_id": "user-001", "title": "t", "body": "hello"}) + "\n")
+
+        raw, put, backlog = load_replay(path)
+        self.assertEqual(raw, b"GET /raw HTTP/1.1\r\n\r\n")
+        self.assertTrue(put.startswith(b"PUT /x HTTP/1.1\r\nX-A: 1\r\n"))
+        self.assertTrue(put.endswith(b"Content-Length: 3\r\n\r\nabc"))
+        self.assertTrue(backlog.startswith(b"POST /user-001 HTTP/1.1\r\n"))
+        self.assertTrue(backlog.endswith(b"\r\n\r\nhello"))
+
+    def test_small_run(self):
+        result = asyncio.run(run_scenario(Scenario("smoke", requests=50, concurrency=4, rules=5, keep_alive=False)))
+        self.assertEqual(result["completed"], 50)
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["rps"], 0)
+        self.assertEqual(set(result["latency_ms"]), {"p50", "p99", "p999"})
+        self.assertEqual(result["proxy"]["rules_loaded"], 5)
+        self.assertGreater(result["proxy"]["rss_max_kb"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
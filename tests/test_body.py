@@ -0,0 +1,94 @@
+import unittest
+import os
+import pickle
+import re
+import shutil
+from app.core.body import BodyBuffer, MappedBody
+from app.core.engine import RuleEngine, ActionType
+from app.core.parser import HttpStreamParser, ParserMode, HttpRequest
+
+class TestBodyBuffer(unittest.TestCase):
+    def test_join_once(self):
+        buf = BodyBuffer(0, 0)
+        for part in (b"ab", b"cd", b"ef"):
+            buf.append(part)
+        value = buf.getvalue()
+        self.assertEqual(value, b"abcdef")
+        self.assertIs(buf.getvalue(), value)
+
+        buf.append(b"gh")
+        self.assertEqual(buf.getvalue(), b"abcdefgh")
+
+    def test_spill_to_disk(self):
+        buf = BodyBuffer(memory_limit=8, max_size=0)
+        buf.append(b"x" * 6)
+        self.assertFalse(buf.spilled)
+        buf.append(b"EVIL" + b"y" * 20)
+        self.assertTrue(buf.spilled)
+
+        body = buf.getvalue()
+        self.assertIsInstance(body, MappedBody)
+        self.assertEqual(len(body), 30)
+        self.assertIn(b"EVIL", body)
+        self.assertNotIn(b"GOOD", body)
+        self.assertTrue(body.startswith(b"xxxxxxEV"))
+        self.assertTrue(re.search(rb"EV.L", body))
+        self.assertEqual(body, b"x" * 6 + b"EVIL" + b"y" * 20)
+        self.assertEqual(body.decode()[6:10], "EVIL")
+        # goes to the heavy-rule pool as a plain copy
+        self.assertEqual(pickle.loads(pickle.dumps(body)), bytes(body[:]))
+
+    def test_max_size(self):
+        buf = BodyBuffer(memory_limit=0, max_size=5)
+        buf.append(b"abc")
+        buf.append(b"defg")
+        buf.append(b"hij")
+        self.assertEqual(buf.getvalue(), b"abcde")
+        self.assertTrue(buf.truncated)
+
+class TestParserBody(unittest.TestCase):
+    def test_chunked_body_spilled(self):
+        parser = HttpStreamParser(ParserMode.REQUEST, body_memory_limit=16, body_max_size=64)
+        parser.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for _ in range(10):
+            parser.feed(b"a\r\n0123456789\r\n")
+        req = parser.feed(b"0\r\n\r\n")[0]
+
+        self.assertIsInstance(req.body, MappedBody)
+        self.assertEqual(req.body, b"0123456789" * 6 + b"0123")
+        self.assertTrue(req.body_truncated)
+        self.assertIn("789", req.data)
+
+    def test_rules_see_bytes(self):
+        rules_dir = "tests/rules_spilled_body"
+        if os.path.exists(rules_dir):
+            shutil.rmtree(rules_dir)
+        os.makedirs(os.path.join(rules_dir, "global"))
+        self.addCleanup(shutil.rmtree, rules_dir)
+        with open(os.path.join(rules_dir, "global", "evil.rule"), "w") as f:
+            f.write(
+                "body = request.body.lower()\n"
+                "if isinstance(request.body, bytes) and b'evil' in body.strip() + b'!' and body.split(b'&'):\n"
+                "    action.mark('bytes')\n"
+                "if request.decoded_body.upper().count(b'EVIL') == 1 and re.search(rb'ev.l', body):\n"
+                "    action.drop()\n"
+            )
+        engine = RuleEngine(rules_dir)
+
+        parser = HttpStreamParser(ParserMode.REQUEST, body_memory_limit=16, body_max_size=0)
+        req = parser.feed(b"POST / HTTP/1.1\r\nContent-Length: 40\r\n\r\n" + b"a=1&" * 5 + b"q=EVIL" + b"x" * 14)[0]
+        self.assertIsInstance(req.body, MappedBody)
+
+        act = engine.evaluate(req)
+        self.assertEqual((act.type, sorted(act.tags)), (ActionType.DROP, ["bytes", "evil"]))
+        # the request itself keeps the file-backed body
+        self.assertIsInstance(req.body, MappedBody)
+
+    def test_text_cached(self):
+        req = HttpRequest(body="привет".encode())
+        self.assertIs(req.data, req.data)
+        req.body = b"changed"
+        self.assertEqual(req.data, "changed")
+
+if __name__ == "__main__":
+    unittest.main()
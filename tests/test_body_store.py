@@ -0,0 +1,95 @@
+import unittest
+import shutil
+import os
+import sqlite3
+from app.database import bodies
+from app.database.bodies import BodyStore, decompress
+from app.database.db import Database
+from app.database.queries import stream_details
+
+# messages до миграций: тело прямо в строке
+LEGACY_SCHEMA = """
+    CREATE TABLE user_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, client_ip TEXT, start_time REAL, last_activity_time REAL);
+    CREATE TABLE tcp_streams (id INTEGER PRIMARY KEY AUTOINCREMENT, user_session_id INTEGER, client_ip TEXT, client_port INTEGER,
+                              target_ip TEXT, target_port INTEGER, start_time REAL, end_time REAL, is_closed INTEGER DEFAULT 0);
+    CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, tcp_stream_id INTEGER, type TEXT, method TEXT, url TEXT,
+                           status_code INTEGER, headers TEXT, body BLOB, timestamp REAL);
+"""
+
+class TestBodyStore(unittest.TestCase):
+    def test_dedup_and_codecs(self):
+        store = BodyStore(codec="zlib", max_size=0)
+        text = b"flag=" + b"A" * 1000
+        noise = os.urandom(1000)
+        hashes, rows = store.prepare([text, b"", text, noise])
+        self.assertEqual(hashes[0], hashes[2])
+        self.assertIsNone(hashes[1])
+        self.assertEqual(len(rows), 2)
+
+        digest, size, codec, truncated, data = rows[0]
+        self.assertEqual((size, codec, truncated), (len(text), "zlib", 0))
+        self.assertLess(len(data), 100)
+        self.assertEqual(decompress(codec, data), text)
+        # несжимаемое хранится как есть
+        self.assertEqual(rows[1][2], "raw")
+        self.assertEqual(decompress("raw", rows[1][4]), noise)
+
+        # записанные тела не сжимаются повторно, пока их хеш помнится
+        store.remember(hashes)
+        again, rows = store.prepare([text])
+        self.assertEqual((again, rows), ([hashes[0]], []))
+
+    def test_truncation(self):
+        store = BodyStore(codec="zlib", max_size=16)
+        body = bytes(range(100))
+        (digest,), (row,) = store.prepare([body])
+        self.assertEqual(digest, bodies.body_hash(body))
+        self.assertEqual((row[1], row[3]), (100, 1))
+        self.assertEqual(decompress(row[2], row[4]), body[:16])
+
+    def test_known_limit(self):
+        store = BodyStore(codec="raw", known_limit=2)
+        hashes, _ = store.prepare([b"a", b"b", b"c"])
+        store.remember(hashes)
+        self.assertEqual(len(store.prepare([b"a"])[1]), 1)
+        self.assertEqual(len(store.prepare([b"c"])[1]), 0)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            BodyStore(codec="lz4")
+
+class TestBodyMigration(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_body_store"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+        self.db = Database()
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def test_legacy_bodies_moved(self):
+        conn = sqlite3.connect(self.db.db_path)
+        conn.executescript(LEGACY_SCHEMA)
+        conn.execute("INSERT INTO tcp_streams (user_session_id, start_time) VALUES (1, 1.0)")
+        conn.executemany("INSERT INTO messages (tcp_stream_id, type, body, timestamp) VALUES (1, 'REQUEST', ?, ?)",
+                         [(b"same body" * 50, 1.0), (b"same body" * 50, 2.0), ("text body", 3.0), (None, 4.0)])
+        conn.commit()
+        conn.close()
+
+        await self.db.connect()
+        rows = await self.db.fetch_all("SELECT COUNT(*) FROM messages WHERE body IS NOT NULL")
+        self.assertEqual(rows[0][0], 0)
+        rows = await self.db.fetch_all("SELECT codec, size FROM bodies ORDER BY size")
+        self.assertEqual([tuple(row) for row in rows], [("raw", 9), ("zlib", 450)])
+
+        stream = await stream_details(1, database=self.db)
+        self.assertEqual([m["body"] for m in stream["messages"]],
+                         ["same body" * 50, "same body" * 50, "text body", ""])
+        self.assertEqual([m["body_size"] for m in stream["messages"]], [450, 450, 9, 0])
+
+if __name__ == "__main__":
+    unittest.main()
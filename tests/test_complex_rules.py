@@ -56,5 +56,61 @@ class TestComplexRules(unittest.TestCase):
         act2 = engine.evaluate(req2)
         self.assertNotIn("api", act2.tags)
 
+    def test_service_buckets(self):
+        with open(os.path.join(self.test_dir, "global", "g.rule"), "w") as f:
+            f.write("pass")
+        with open(os.path.join(self.test_dir, "services", "8080", "s.rule"), "w") as f:
+            f.write("pass")
+
+        engine = RuleEngine(self.test_dir)
+        self.assertEqual([r.name for r in engine.global_rules], ["g"])
+        self.assertEqual([r.name for r in engine.service_rules[8080]], ["s"])
+        self.assertNotIn(9090, engine.service_rules)
+
+    def test_priority_order(self):
+        with open(os.path.join(self.test_dir, "global", "a_low.rule"), "w") as f:
+            f.write("action.mark('low')")
+        with open(os.path.join(self.test_dir, "global", "b_high.rule"), "w") as f:
+            f.write("# @priority: 10\naction.mark('high')")
+
+        engine = RuleEngine(self.test_dir)
+        self.assertEqual([r.name for r in engine.global_rules], ["b_high", "a_low"])
+        self.assertEqual(engine.global_rules[0].priority, 10)
+
+    def test_short_circuit(self):
+        with open(os.path.join(self.test_dir, "global", "drop_all.rule"), "w") as f:
+            f.write("action.drop()")
+        with open(os.path.join(self.test_dir, "services", "8080", "allow.rule"), "w") as f:
+            f.write("# @priority: 5\nif '/safe' in request.path: action.accept()")
+        with open(os.path.join(self.test_dir, "services", "8080", "later.rule"), "w") as f:
+            f.write("action.mark('later')")
+        with open(os.path.join(self.test_dir, "services", "8080", "decides.rule"), "w") as f:
+            f.write("action.mark('decides')\nif 'x' in request.path: action.drop()")
+        with open(os.path.join(self.test_dir, "global", "seen.rule"), "w") as f:
+            f.write("if request.path: action.mark('seen')")
+        with open(os.path.join(self.test_dir, "global", "trav.sig"), "w") as f:
+            f.write("mark:trav path contains /safe\n")
+
+        engine = RuleEngine(self.test_dir, short_circuit=True)
+        self.assertEqual({r.name: r.tag_only for r in engine.rules},
+                         {"drop_all": False, "allow": False, "later": True, "decides": False, "seen": True})
+
+        # service ACCEPT decides the verdict: rules that could change it are skipped,
+        # tag-only rules and signatures of both buckets still run
+        act = engine.evaluate(HttpRequest(path="/safe", destination_port=8080))
+        self.assertEqual(act.type, ActionType.ACCEPT)
+        self.assertEqual(sorted(act.tags), ["later", "seen", "trav"])
+
+        # no service verdict: the whole service bucket and the global bucket run
+        act = engine.evaluate(HttpRequest(path="/other", destination_port=8080))
+        self.assertEqual(act.type, ActionType.DROP)
+        self.assertEqual(sorted(act.tags), ["decides", "drop_all", "later", "seen"])
+
+        # without short-circuit the verdict is the same, only more rules run
+        full = RuleEngine(self.test_dir)
+        act = full.evaluate(HttpRequest(path="/safe", destination_port=8080))
+        self.assertEqual(act.type, ActionType.ACCEPT)
+        self.assertEqual(sorted(act.tags), ["decides", "drop_all", "later", "seen", "trav"])
+
 if __name__ == "__main__":
     unittest.main()
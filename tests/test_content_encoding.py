@@ -0,0 +1,71 @@
+import unittest
+import gzip
+import zlib
+import time
+from app.core.body import decode_content
+from app.core.parser import HttpStreamParser, ParserMode, HttpRequest, HttpResponse
+from app.core.signatures import SignatureSet, parse_signatures
+
+class TestDecodeContent(unittest.TestCase):
+    def test_encodings(self):
+        self.assertEqual(decode_content(gzip.compress(b"a") + gzip.compress(b"b"), ["gzip"], 0, 0), (b"ab", ""))
+        self.assertEqual(decode_content(zlib.compress(b"zlib"), ["deflate"], 0, 0), (b"zlib", ""))
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.assertEqual(decode_content(raw.compress(b"raw") + raw.flush(), ["deflate"], 0, 0), (b"raw", ""))
+        # layers are removed in reverse order
+        self.assertEqual(decode_content(gzip.compress(zlib.compress(b"two")), ["deflate", "gzip"], 0, 0), (b"two", ""))
+
+    def test_errors(self):
+        self.assertEqual(decode_content(b"x", ["br"], 0, 0), (b"x", "unsupported encoding: br"))
+        self.assertTrue(decode_content(b"garbage", ["gzip"], 0, 0)[1].startswith("invalid"))
+        data, error = decode_content(gzip.compress(b"x" * 1000)[:15], ["gzip"], 0, 0)
+        self.assertEqual(error, "incomplete")
+
+    def test_bomb_limits(self):
+        bomb = gzip.compress(b"\0" * (64 * 1024 * 1024))
+        data, error = decode_content(bomb, ["gzip"], 0, 100)
+        self.assertEqual(error, "ratio limit")
+        self.assertLess(len(data), 4 * 1024 * 1024)
+
+        data, error = decode_content(bomb, ["gzip"], 1000, 0)
+        self.assertEqual((len(data), error), (1000, "size limit"))
+
+    def test_many_members(self):
+        empty = gzip.compress(b"")
+        started = time.perf_counter()
+        data, error = decode_content(empty * 40000, ["gzip"], 0, 100)
+        self.assertEqual((data, error), (b"", "member limit"))
+        self.assertLess(time.perf_counter() - started, 0.5)
+        # trailing zero padding after the last member is fine
+        self.assertEqual(decode_content(empty * 3 + gzip.compress(b"x") + b"\0" * 8, ["gzip"], 0, 0), (b"x", ""))
+
+class TestDecodedView(unittest.TestCase):
+    def request(self, body, encoding="gzip"):
+        raw = b"POST / HTTP/1.1\r\nContent-Encoding: %s\r\nContent-Length: %d\r\n\r\n" % (encoding.encode(), len(body))
+        return HttpStreamParser(ParserMode.REQUEST).feed(raw + body)[0]
+
+    def test_lazy_and_cached(self):
+        payload = gzip.compress(b"id=1 UNION SELECT password")
+        req = self.request(payload)
+        # the original bytes are what gets forwarded and logged
+        self.assertEqual(req.body, payload)
+        self.assertNotIn("decoded", req.__dict__.get("_views", {}))
+
+        self.assertEqual(req.decoded_body, b"id=1 UNION SELECT password")
+        self.assertIs(req.decoded_body, req.decoded_body)
+        self.assertEqual(req.decode_error, "")
+        self.assertIn("UNION", req.decoded_data)
+
+    def test_identity(self):
+        req = HttpRequest(body=b"plain")
+        self.assertIs(req.decoded_body, req.body)
+        res = HttpResponse(headers={"Content-Encoding": "gzip"}, body=gzip.compress(b"page"))
+        self.assertEqual(res.decoded_body, b"page")
+
+    def test_signature_field(self):
+        sigs = SignatureSet(parse_signatures("drop decoded icontains union select\n", "t.sig", "sqli"))
+        self.assertEqual(len(sigs.scan(self.request(gzip.compress(b"1 union select 2")))), 1)
+        self.assertEqual(sigs.scan(self.request(gzip.compress(b"fine"))), [])
+
+if __name__ == "__main__":
+    unittest.main()
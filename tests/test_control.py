@@ -0,0 +1,88 @@
+import unittest
+import shutil
+import os
+from types import SimpleNamespace
+from app.core.control import ControlClient, ControlError, ControlServer
+from app.core.engine import RuleEngine
+from app.core.iplist import IpAccessList
+from app.core.parser import HttpRequest
+
+class TestControlChannel(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_control"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "rules", "global"))
+        self.write("drop.rule", "if 'evil' in request.path: action.drop()")
+
+        # два воркера со своими движками и списками, файл списков общий
+        self.proxies = []
+        self.servers = []
+        for index in range(2):
+            proxy = SimpleNamespace(
+                rule_engine=RuleEngine(os.path.join(self.test_dir, "rules")),
+                ip_list=IpAccessList(os.path.join(self.test_dir, "ip_lists.json")),
+                upstream_pool=None
+            )
+            server = ControlServer(proxy, os.path.join(self.test_dir, f"control.sock.{index}"))
+            await server.start()
+            self.proxies.append(proxy)
+            self.servers.append(server)
+        self.client = ControlClient([server.path for server in self.servers], timeout=2)
+
+    async def asyncTearDown(self):
+        for server in self.servers:
+            await server.close()
+        for proxy in self.proxies:
+            proxy.rule_engine.close()
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.test_dir, "rules", "global", name), "w") as f:
+            f.write(content)
+
+    async def test_reload_reaches_all_workers(self):
+        self.write("mark.rule", "action.mark('seen')")
+        generations = await self.client.broadcast("reload")
+        self.assertEqual(generations, [2, 2])
+        for proxy in self.proxies:
+            self.assertEqual(len(proxy.rule_engine.rules), 2)
+
+    async def test_ip_commands(self):
+        await self.client.broadcast("block_ip", ip="1.2.3.4")
+        await self.client.broadcast("ip", list="allow", operation="add", ips=["10.0.0.0/8"])
+        for proxy in self.proxies:
+            self.assertTrue(proxy.ip_list.is_blocked("1.2.3.4"))
+            self.assertIn("10.0.0.0/8", proxy.ip_list.to_dict()["allow"])
+        # файл воркеры не трогают
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, "ip_lists.json")))
+
+    async def test_stats_are_merged(self):
+        self.proxies[0].rule_engine.evaluate(HttpRequest(path="/evil"))
+        self.proxies[1].rule_engine.evaluate(HttpRequest(path="/ok"))
+        self.proxies[1].rule_engine.evaluate(HttpRequest(path="/evil"))
+
+        stats = await self.client.stats()
+        self.assertEqual(stats["status"]["workers"], 2)
+        self.assertEqual(stats["status"]["rules"], 1)
+        self.assertEqual(stats["pool"], {"enabled": False})
+        [rule] = stats["rules"]
+        self.assertEqual(rule["path"], os.path.join("global", "drop.rule"))
+        self.assertEqual(rule["evaluations"], 3)
+        self.assertEqual(rule["matches"]["drop"], 2)
+        self.assertGreater(rule["p99_ms"], 0)
+
+        self.assertEqual(await self.client.broadcast("reset_stats"), [1, 1])
+        self.assertEqual((await self.client.stats())["rules"][0]["evaluations"], 0)
+
+    async def test_errors(self):
+        with self.assertRaises(ControlError):
+            await self.client.request(self.servers[0].path, "no_such_command")
+
+        # упавший воркер не мешает остальным
+        await self.servers[1].close()
+        self.assertEqual(len(await self.client.broadcast("reload")), 1)
+
+        await self.servers[0].close()
+        with self.assertRaises(ControlError):
+            await self.client.broadcast("reload")
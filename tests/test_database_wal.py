@@ -0,0 +1,91 @@
+import unittest
+import asyncio
+import shutil
+import os
+import sqlite3
+from app.database.db import Database
+
+class TestDatabaseWal(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_wal"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+    async def asyncTearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    async def open(self, **kwargs):
+        database = Database(**kwargs)
+        database.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await database.connect()
+        self.addAsyncCleanup(database.close)
+        return database
+
+    async def test_wal_and_pragmas(self):
+        database = await self.open(readers=1, checkpoint_interval=0)
+        self.assertEqual((await database.fetch_all("PRAGMA journal_mode"))[0][0], "wal")
+        self.assertEqual((await database.fetch_all("PRAGMA temp_store"))[0][0], 2)  # MEMORY
+        async with database._connection.execute("PRAGMA synchronous") as cursor:
+            self.assertEqual((await cursor.fetchone())[0], 1)  # NORMAL
+
+    async def test_readers_see_commits_and_cannot_write(self):
+        database = await self.open(readers=2, checkpoint_interval=0)
+        session_id = await database.execute(
+            "INSERT INTO user_sessions (client_ip, start_time, last_activity_time) VALUES (?, ?, ?)",
+            ("10.0.0.1", 1.0, 2.0))
+        rows = await database.fetch_all("SELECT client_ip FROM user_sessions WHERE id = ?", (session_id,))
+        self.assertEqual([row["client_ip"] for row in rows], ["10.0.0.1"])
+
+        with self.assertRaises(sqlite3.OperationalError):
+            await database.fetch_all("DELETE FROM user_sessions")
+        # соединение вернулось в пул и работает дальше
+        self.assertEqual(database._reader_pool.qsize(), 2)
+        self.assertEqual(len(await database.fetch_all("SELECT id FROM user_sessions")), 1)
+
+    async def test_read_during_open_write_transaction(self):
+        database = await self.open(readers=1, checkpoint_interval=0)
+        await database._connection.execute("BEGIN IMMEDIATE")
+        await database._connection.execute(
+            "INSERT INTO user_sessions (client_ip, start_time, last_activity_time) VALUES ('10.0.0.1', 1, 1)")
+        # читатель не ждёт писателя и видит последнее зафиксированное состояние
+        rows = await asyncio.wait_for(database.fetch_all("SELECT COUNT(*) FROM user_sessions"), 1)
+        self.assertEqual(rows[0][0], 0)
+        await database._connection.commit()
+        self.assertEqual((await database.fetch_all("SELECT COUNT(*) FROM user_sessions"))[0][0], 1)
+
+    async def test_background_checkpoint(self):
+        database = await self.open(readers=1, checkpoint_interval=0.05)
+        await database.execute_batch([(
+            "INSERT INTO user_sessions (client_ip, start_time, last_activity_time) VALUES (?, ?, ?)",
+            [(f"10.0.0.{i}", i, i) for i in range(200)]
+        )])
+        wal_path = database.db_path + "-wal"
+        self.assertGreater(os.path.getsize(wal_path), 0)
+
+        # wal_autocheckpoint выключен: WAL переносит только фоновая задача
+        results = []
+        checkpoint = database.checkpoint
+
+        async def recording(mode="PASSIVE"):
+            results.append(await checkpoint(mode))
+            return results[-1]
+        database.checkpoint = recording
+        await asyncio.sleep(0.2)
+        self.assertTrue(results)
+        busy, log_pages, done = results[0]
+        self.assertEqual(busy, 0)
+        self.assertGreater(log_pages, 0)
+        self.assertEqual(done, log_pages)
+
+        await database.close()
+        self.assertFalse(os.path.exists(wal_path) and os.path.getsize(wal_path) > 0)
+        conn = sqlite3.connect(database.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM user_sessions").fetchone()[0], 200)
+        conn.close()
+
+    async def test_no_readers_uses_writer(self):
+        database = await self.open(readers=0, checkpoint_interval=0)
+        self.assertEqual(database._reader_conns, [])
+        rows = await database.fetch_all("SELECT COUNT(*) FROM user_sessions")
+        self.assertEqual(rows[0][0], 0)
@@ -56,5 +56,38 @@ class TestRuleEngine(unittest.TestCase):
         self.assertIn('suspicious', act.tags)
         self.assertEqual(act.type, ActionType.ACCEPT) # Mark is neutral/accept
 
+    def test_compiled_rule_names(self):
+        # httprequest alias, re and helper functions defined inside the rule
+        with open(f"{self.test_dir}/helpers.rule", "w") as f:
+            f.write(
+                "def is_bad(p):\n"
+                "    return re.search(r'evil', p) is not None\n"
+                "if is_bad(httprequest.path):\n"
+                "    action.drop()\n"
+            )
+
+        engine = RuleEngine(self.test_dir)
+        self.assertEqual(engine.rules[0].name, "helpers")
+
+        act = engine.evaluate(HttpRequest(path="/evil"))
+        self.assertEqual(act.type, ActionType.DROP)
+        self.assertIn("helpers", act.tags)
+
+        # the same engine is reused for the next request without leftovers
+        act = engine.evaluate(HttpRequest(path="/fine"))
+        self.assertEqual(act.type, ActionType.ACCEPT)
+        self.assertEqual(act.tags, [])
+
+    def test_failing_rule_tags_discarded(self):
+        with open(f"{self.test_dir}/broken.rule", "w") as f:
+            f.write("action.mark('half')\nraise ValueError('boom')")
+        with open(f"{self.test_dir}/ok.rule", "w") as f:
+            f.write("action.mark('ok')")
+
+        engine = RuleEngine(self.test_dir)
+        act = engine.evaluate(HttpRequest())
+
+        self.assertEqual(act.tags, ['ok'])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import shutil
+import os
+import json
+from app.core.iplist import IpAccessList, IpSet, parse_entry
+
+class TestIpSet(unittest.TestCase):
+    def test_hosts_and_networks(self):
+        ips = IpSet()
+        ips.add(parse_entry("10.0.0.5"))
+        ips.add(parse_entry("192.168.0.0/16"))
+        ips.add(parse_entry("2001:db8::/32"))
+
+        self.assertIn("10.0.0.5", ips)
+        self.assertNotIn("10.0.0.6", ips)
+        self.assertIn("192.168.44.1", ips)
+        self.assertNotIn("192.169.0.1", ips)
+        self.assertIn("2001:db8::1", ips)
+        # dual-stack sockets report IPv4 clients as mapped IPv6
+        self.assertIn("::ffff:10.0.0.5", ips)
+        self.assertNotIn("not an ip", ips)
+
+        ips.remove(parse_entry("192.168.0.0/16"))
+        self.assertNotIn("192.168.44.1", ips)
+
+class TestIpAccessList(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/data_iplist"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "rules", "dynamic"))
+        self.path = os.path.join(self.test_dir, "ip_lists.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_bulk_and_persist(self):
+        lists = IpAccessList(self.path)
+        changed, invalid = lists.add("block", ["1.2.3.4", "10.0.0.0/8", "bogus"])
+        self.assertEqual(changed, ["1.2.3.4/32", "10.0.0.0/8"])
+        self.assertEqual(invalid, ["bogus"])
+        lists.add("allow", ["10.1.1.1"])
+
+        self.assertTrue(lists.is_blocked("1.2.3.4"))
+        self.assertTrue(lists.is_blocked("10.9.9.9"))
+        self.assertFalse(lists.is_blocked("10.1.1.1")) # allow wins
+        self.assertFalse(lists.is_blocked("8.8.8.8"))
+
+        reloaded = IpAccessList(self.path)
+        self.assertTrue(reloaded.is_blocked("1.2.3.4"))
+        self.assertFalse(reloaded.is_blocked("10.1.1.1"))
+
+        reloaded.remove("block", ["1.2.3.4"])
+        self.assertFalse(IpAccessList(self.path).is_blocked("1.2.3.4"))
+
+    def test_migrate_legacy_rules(self):
+        dynamic = os.path.join(self.test_dir, "rules", "dynamic")
+        with open(os.path.join(dynamic, "block_6_6_6_6.rule"), "w") as f:
+            f.write("if request.client_ip == '6.6.6.6': action.drop()")
+        with open(os.path.join(dynamic, "block_custom.rule"), "w") as f:
+            f.write("if request.client_ip == '7.7.7.7' and 'x' in request.path: action.drop()")
+
+        lists = IpAccessList(self.path)
+        self.assertEqual(lists.migrate_rules(os.path.join(self.test_dir, "rules")), 1)
+        self.assertTrue(lists.is_blocked("6.6.6.6"))
+        self.assertFalse(lists.is_blocked("7.7.7.7"))
+
+        self.assertEqual(os.listdir(dynamic), ["block_custom.rule"])
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)["block"], ["6.6.6.6/32"])
+
+if __name__ == "__main__":
+    unittest.main()
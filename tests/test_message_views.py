@@ -0,0 +1,78 @@
+import unittest
+from app.core.parser import HttpStreamParser, ParserMode, HttpRequest, HttpResponse
+
+def parse(raw):
+    return HttpStreamParser(ParserMode.REQUEST).feed(raw)[0]
+
+class TestMessageViews(unittest.TestCase):
+    def test_duplicate_headers(self):
+        req = parse(b"GET / HTTP/1.1\r\nHost: a\r\nX-Id: 1\r\nhost: b\r\nX-Id: 2\r\n\r\n")
+        self.assertEqual(req.headers["X-Id"], "1, 2")
+        self.assertEqual(req.header_map.getall("HOST"), ["a", "b"])
+        self.assertEqual(req.header_map["x-id"], "1")
+        self.assertIn("X-ID", req.header_map)
+        self.assertIs(req.header_map, req.header_map)
+
+    def test_url_and_query(self):
+        req = parse(b"GET /api/v1/users?id=1&id=2&q=a+b%27&empty= HTTP/1.1\r\n\r\n")
+        self.assertEqual(req.url.path, "/api/v1/users")
+        self.assertEqual(req.url.query, "id=1&id=2&q=a+b%27&empty=")
+        self.assertEqual(req.query.getall("id"), ["1", "2"])
+        self.assertEqual(req.query["q"], "a b'")
+        self.assertEqual(req.query["empty"], "")
+        self.assertIs(req.query, req.query)
+
+        # absolute form and targets httptools does not accept
+        self.assertEqual(HttpRequest(path="http://example.com:8080/x?y=1").url.port, 8080)
+        self.assertEqual(HttpRequest(path="*").url.path, "*")
+
+    def test_cookies(self):
+        req = HttpRequest(headers={"Cookie": 'sid=abc; theme="dark"; broken'})
+        self.assertEqual(dict(req.cookies), {"sid": "abc", "theme": "dark"})
+
+        res = HttpResponse(header_list=[("Set-Cookie", "sid=xyz; Path=/; HttpOnly"), ("Set-Cookie", "a=1")])
+        self.assertEqual(res.cookies["sid"], "xyz")
+        self.assertEqual(res.cookies["a"], "1")
+
+    def test_urlencoded_form(self):
+        req = HttpRequest(headers={"Content-Type": "application/x-www-form-urlencoded"},
+                          body=b"user=admin&pass=%27+or+1%3D1--")
+        self.assertEqual(req.form["pass"], "' or 1=1--")
+        self.assertEqual(len(req.files), 0)
+
+    def test_multipart_form(self):
+        body = (b"--XyZ\r\n"
+                b'Content-Disposition: form-data; name="title"\r\n\r\n'
+                b"hello\r\n"
+                b"--XyZ\r\n"
+                b'Content-Disposition: form-data; name="upload"; filename="shell.php"\r\n'
+                b"Content-Type: application/x-php\r\n\r\n"
+                b"<?php system($_GET['c']); ?>\r\n"
+                b"--XyZ--\r\n")
+        req = HttpRequest(headers={"Content-Type": 'multipart/form-data; boundary="XyZ"'}, body=body)
+        self.assertEqual(req.form["title"], "hello")
+        upload = req.files["upload"]
+        self.assertEqual(upload.filename, "shell.php")
+        self.assertEqual(upload.content_type, "application/x-php")
+        self.assertEqual(upload.data, b"<?php system($_GET['c']); ?>")
+
+    def test_json(self):
+        req = HttpRequest(headers={"Content-Type": "application/json"}, body=b'{"a": [1, 2]}')
+        self.assertEqual(req.json, {"a": [1, 2]})
+        self.assertIs(req.json, req.json)
+        # sniffed without the content type, garbage is None
+        self.assertEqual(HttpRequest(body=b' [1]').json, [1])
+        self.assertIsNone(HttpRequest(body=b'{broken').json)
+        self.assertIsNone(HttpRequest(body=b'plain').json)
+
+    def test_views_follow_body(self):
+        # a header-phase request gets its body later: body views are recomputed
+        parser = HttpStreamParser(ParserMode.REQUEST)
+        parser.feed(b"POST / HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: 8\r\n\r\n")
+        req = parser.current
+        self.assertIsNone(req.json)
+        parser.feed(b'{"x": 1}')
+        self.assertEqual(req.json, {"x": 1})
+
+if __name__ == "__main__":
+    unittest.main()
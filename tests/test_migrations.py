@@ -0,0 +1,112 @@
+import unittest
+import shutil
+import os
+import sqlite3
+from unittest import mock
+from app.core.session import MAX_SESSION_ID, MAX_STREAM_ID, RECENT_SESSIONS
+from app.database import migrations, queries
+from app.database.db import Database
+from app.database.writer import STATEMENTS
+
+# схема, которую создавал init_db до миграций (без tags и alert_level)
+LEGACY_SCHEMA = """
+    CREATE TABLE user_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, client_ip TEXT, start_time REAL, last_activity_time REAL);
+    CREATE TABLE tcp_streams (id INTEGER PRIMARY KEY AUTOINCREMENT, user_session_id INTEGER, client_ip TEXT, client_port INTEGER,
+                              target_ip TEXT, target_port INTEGER, start_time REAL, end_time REAL, is_closed INTEGER DEFAULT 0);
+    CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, tcp_stream_id INTEGER, type TEXT, method TEXT, url TEXT,
+                           status_code INTEGER, headers TEXT, body BLOB, timestamp REAL);
+    INSERT INTO user_sessions (client_ip, start_time, last_activity_time) VALUES ('10.0.0.1', 1.0, 2.0);
+"""
+
+class TestMigrations(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_migrations"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+        self.db = Database()
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def versions(self):
+        rows = await self.db.fetch_all("SELECT version FROM schema_version ORDER BY version")
+        return [row['version'] for row in rows]
+
+    async def test_fresh_database(self):
+        await self.db.connect()
+        self.assertEqual(await self.versions(), [m[0] for m in migrations.MIGRATIONS])
+
+        # повторное подключение ничего не применяет
+        await self.db.close()
+        await self.db.connect()
+        self.assertEqual(len(await self.versions()), len(migrations.MIGRATIONS))
+
+    async def test_legacy_database(self):
+        conn = sqlite3.connect(self.db.db_path)
+        conn.executescript(LEGACY_SCHEMA)
+        conn.close()
+
+        await self.db.connect()
+        self.assertEqual((await self.versions())[-1], migrations.LATEST_VERSION)
+        rows = await self.db.fetch_all("SELECT client_ip, alert_level FROM user_sessions")
+        self.assertEqual([tuple(row) for row in rows], [('10.0.0.1', 0)])
+        columns = await self.db.fetch_all("PRAGMA table_info(messages)")
+        self.assertIn('tags', [row['name'] for row in columns])
+
+    async def test_failed_migration_rolls_back(self):
+        async def broken(conn):
+            await conn.execute("CREATE TABLE half_done (id INTEGER)")
+            raise RuntimeError("boom")
+
+        with mock.patch.object(migrations, "MIGRATIONS", migrations.MIGRATIONS + [(99, "broken", broken)]):
+            with self.assertRaises(RuntimeError):
+                await self.db.connect()
+
+        conn = sqlite3.connect(self.db.db_path)
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        versions = [row[0] for row in conn.execute("SELECT version FROM schema_version")]
+        conn.close()
+        self.assertNotIn("half_done", tables)
+        self.assertEqual(max(versions), migrations.LATEST_VERSION)
+
+class TestQueryPlans(unittest.IsolatedAsyncioTestCase):
+    # запросы прокси и панели на горячем пути
+    HOT_QUERIES = {
+        "max_session_id": (MAX_SESSION_ID, 0),
+        "max_stream_id": (MAX_STREAM_ID, 0),
+        "recent_sessions": (RECENT_SESSIONS, 1),
+        "sessions_first_page": (queries.SESSIONS_FIRST_PAGE, 1),
+        "sessions_next_page": (queries.SESSIONS_NEXT_PAGE, 3),
+        "session_stats": (queries.SESSION_STATS, 1),
+        "session_streams": (queries.SESSION_STREAMS, 1),
+        "session_streams_full": (queries.SESSION_STREAMS_FULL, 1),
+        "stream_messages": (queries.STREAM_MESSAGES, 1),
+        **{f"writer_{kind}": (sql, sql.count("?")) for kind, sql in STATEMENTS.items()},
+    }
+
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_query_plans"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+        self.db = Database()
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await self.db.connect()
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def test_no_full_scans(self):
+        for name, (sql, params) in self.HOT_QUERIES.items():
+            with self.subTest(query=name):
+                plan = [row['detail'] for row in await self.db.fetch_all("EXPLAIN QUERY PLAN " + sql, (1,) * params)]
+                for detail in plan:
+                    # SCAN ... USING INDEX - проход по индексу в нужном порядке до LIMIT
+                    if detail.startswith("SCAN") and detail != "SCAN CONSTANT ROW":
+                        self.assertTrue("USING" in detail or "VIRTUAL TABLE" in detail, f"{name}: {plan}")
+                    # сортировка во временном дереве вместо порядка индекса
+                    self.assertFalse("TEMP B-TREE" in detail and "ORDER BY" in detail, f"{name}: {plan}")
@@ -1,5 +1,5 @@
 import unittest
-from app.core.parser import HttpStreamParser, ParserMode
+from app.core.parser import HttpStreamParser, HttpStreamError, ParserMode
 
 class TestHttpParser(unittest.TestCase):
     def test_get_request(self):
@@ -75,5 +75,20 @@ class TestHttpParser(unittest.TestCase):
         self.assertEqual(len(reqs2), 1)
         self.assertEqual(reqs2[0].path, "/second")
 
+    def test_error_keeps_completed_messages(self):
+        """A complete request followed by garbage in the same chunk is not lost"""
+        parser = HttpStreamParser(mode=ParserMode.REQUEST)
+        req = b"GET /first HTTP/1.1\r\nHost: loc\r\n\r\n"
+
+        with self.assertRaises(HttpStreamError) as ctx:
+            parser.feed(req + b"\x00\x01garbage\r\n\r\n")
+        self.assertEqual([msg.path for msg in ctx.exception.messages], ["/first"])
+        self.assertEqual(ctx.exception.messages[0].stream_end, len(req))
+
+        # the rest of the stream is not parsed
+        with self.assertRaises(HttpStreamError) as ctx:
+            parser.feed(req)
+        self.assertEqual(ctx.exception.messages, [])
+
 if __name__ == "__main__":
     unittest.main()
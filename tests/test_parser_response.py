@@ -24,5 +24,16 @@ class TestResponseParser(unittest.TestCase):
         self.assertEqual(len(msgs), 1)
         self.assertEqual(msgs[0].body, b'hello')
 
+    def test_head_response(self):
+        parser = HttpStreamParser(mode=ParserMode.RESPONSE)
+        parser.expect_response("HEAD")
+        parser.expect_response("GET")
+        raw_res = (b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n"
+                   b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+
+        msgs = parser.feed(raw_res)
+        self.assertEqual([msg.body for msg in msgs], [b"", b"hello"])
+        self.assertEqual([(msg.stream_start, msg.stream_end) for msg in msgs], [(0, 38), (38, 81)])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+import shutil
+import os
+import json
+import asyncio
+from app.database import db as db_module
+from app.database.db import Database
+from app.database.queries import list_sessions, session_details, stream_details
+from app.database.writer import TrafficWriter
+
+class TestPartitions(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_partitions"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+        # разделы по минуте: 960, 1020, 1080, ...
+        self.db = Database(readers=1, checkpoint_interval=0, partition_minutes=1, retention_hours=0)
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await self.db.connect()
+        self.writer = TrafficWriter(self.db, spill_path=os.path.join(self.test_dir, "spill.bin"))
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def exchange(self, stream_id, session_id, opened, body=b"payload", tags=()):
+        await self.writer.submit("stream_open", (stream_id, session_id, "10.0.0.1", 4000 + stream_id, "127.0.0.1", 80, opened))
+        await self.writer.submit("message", (stream_id, "REQUEST", "POST", "/x", None, "{}", body,
+                                             json.dumps(list(tags)), opened + 1))
+
+    async def fill(self):
+        await self.writer.submit("session_open", (1, "10.0.0.1", 1000.0, 1100.0))
+        await self.exchange(1, 1, 1000.0, tags=["a"])
+        await self.exchange(2, 1, 1100.0, tags=["b"])
+        # поток из первого раздела живёт дольше него: сообщения идут к нему же
+        await self.writer.submit("message", (1, "RESPONSE", None, None, 200, "{}", b"late", "[]", 1150.0))
+        await self.writer.submit("stream_close", (1150.0, 1))
+
+    async def test_streams_go_to_partition_of_open(self):
+        await self.fill()
+        self.assertEqual(self.db.partitions(), [1080, 960, None])
+        self.assertTrue(os.path.exists(self.db.partition_path(960)))
+
+        first = await self.db.fetch_all("SELECT id, is_closed FROM tcp_streams", partition=960)
+        self.assertEqual([tuple(row) for row in first], [(1, 1)])
+        rows = await self.db.fetch_all("SELECT COUNT(*) FROM messages", partition=960)
+        self.assertEqual(rows[0][0], 2)
+        second = await self.db.fetch_all("SELECT id FROM tcp_streams", partition=1080)
+        self.assertEqual([row["id"] for row in second], [2])
+        # сессии - только в основном файле
+        self.assertEqual(len(await self.db.fetch_all("SELECT * FROM user_sessions")), 1)
+        self.assertEqual(await self.db.fetch_all("SELECT * FROM tcp_streams"), [])
+
+        # одинаковое тело хранится по разу в каждом разделе
+        for partition in (960, 1080):
+            rows = await self.db.fetch_all("SELECT COUNT(*) FROM bodies WHERE size = 7", partition=partition)
+            self.assertEqual(rows[0][0], 1)
+
+    async def test_fan_out_by_time(self):
+        await self.fill()
+        self.assertEqual(self.db.partitions(1000, 1010), [960, None])
+        self.assertEqual(self.db.partitions(1090, 2000), [1080, None])
+
+        page = await list_sessions(database=self.db)
+        session = page["sessions"][0]
+        self.assertEqual((session["stream_count"], session["message_count"]), (2, 3))
+        self.assertEqual(session["tags"], ["a", "b"])
+
+        details = await session_details(1, bodies=True, database=self.db)
+        self.assertEqual([s["id"] for s in details["streams"]], [1, 2])
+        self.assertEqual([m["body"] for m in details["streams"][0]["messages"]], ["payload", "late"])
+
+        stream = await stream_details(1, database=self.db)
+        self.assertEqual(stream["is_closed"], 1)
+        self.assertEqual(len(stream["messages"]), 2)
+        self.assertIsNone(await stream_details(99, database=self.db))
+
+    async def test_alert_of_partitioned_stream(self):
+        await self.fill()
+        await self.writer.submit("alert", (2, 2))
+        rows = await self.db.fetch_all("SELECT alert_level FROM user_sessions WHERE id = 1")
+        self.assertEqual(rows[0][0], 2)
+
+    async def test_more_partitions_than_readers(self):
+        await self.writer.submit("session_open", (1, "10.0.0.1", 1000.0, 1000.0 + 60 * 20))
+        for i in range(21):
+            await self.exchange(i + 1, 1, 1000.0 + 60 * i)
+        self.assertEqual(len(self.db.partitions()), 22)
+
+        # кеш читателей меньше числа разделов: занятые соединения не закрываются
+        results = await self.db.fetch_partitions("SELECT COUNT(*) FROM messages")
+        self.assertEqual(sum(rows[0][0] for rows in results), 21)
+        self.assertLessEqual(len(self.db._partition_readers), db_module.PARTITION_READERS)
+        self.assertEqual(self.db._reader_users, {})
+
+        # одновременные промахи по одному разделу - одно соединение
+        while self.db._partition_readers:
+            await self.db._partition_readers.popitem()[1].close()
+        await asyncio.gather(*(self.db.fetch_all("SELECT 1", partition=960) for _ in range(5)))
+        self.assertEqual(list(self.db._partition_readers), [960])
+
+        page = await list_sessions(database=self.db)
+        self.assertEqual(page["sessions"][0]["message_count"], 21)
+
+    async def test_retention(self):
+        await self.fill()
+        await self.writer.submit("session_open", (2, "10.0.0.2", 1150.0, 1150.0))
+        self.db.retention_hours = 1 / 60
+
+        # хранится минута: в 1070 первый раздел (960-1020) ещё частично нужен
+        self.assertEqual(await self.db.prune(now=1070.0), [])
+        removed = await self.db.prune(now=1165.0)
+        self.assertEqual(removed, [960])
+        self.assertFalse(os.path.exists(self.db.partition_path(960)))
+        self.assertEqual(self.db.partitions(), [1080, None])
+        rows = await self.db.fetch_all("SELECT id FROM user_sessions")
+        self.assertEqual([row["id"] for row in rows], [2])
+
+        # текущий раздел не удаляется, даже если он старше срока хранения
+        self.db.archive_dir = os.path.join(self.test_dir, "archive")
+        self.assertEqual(await self.db.prune(now=1080.0 + 30), [])
+        self.assertEqual(await self.db.prune(now=1080.0 + 3600), [1080])
+        self.assertTrue(os.path.exists(os.path.join(self.db.archive_dir, "traffic-1080.sqlite")))
+        self.assertEqual(self.db.partitions(), [None])
+
+    async def test_retention_keeps_open_streams(self):
+        await self.writer.submit("session_open", (1, "10.0.0.1", 1000.0, 1000.0))
+        await self.exchange(1, 1, 1000.0)
+        await self.writer.submit("message", (1, "RESPONSE", None, None, 200, "{}", b"late", "[]", 1150.0))
+        self.db.retention_hours = 1 / 60
+
+        # раздел 960 старше срока, но его поток открыт и писал недавно
+        self.assertEqual(await self.db.prune(now=1165.0), [])
+        await self.writer.submit("stream_close", (1170.0, 1))
+        self.assertEqual(await self.db.prune(now=1175.0), [960])
+
+        # запоздалое событие потока удалённого раздела не создаёт раздел заново
+        await self.writer.submit("message", (1, "RESPONSE", None, None, 200, "{}", b"later", "[]", 1180.0))
+        self.assertEqual(self.db.partitions(), [None])
+        self.assertEqual(self.writer.dropped, 1)
+
+    async def test_retention_drops_abandoned_streams(self):
+        await self.writer.submit("session_open", (1, "10.0.0.1", 1000.0, 1000.0))
+        await self.exchange(1, 1, 1000.0)
+        self.db.retention_hours = 1 / 60
+
+        # поток так и не закрыт, но молчит дольше срока хранения
+        self.assertEqual(await self.db.prune(now=1165.0), [960])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,248 @@
+import unittest
+import asyncio
+import hashlib
+import os
+import shutil
+from app.core.proxy import TcpProxy
+from app.core.engine import RuleEngine
+from app.database.db import db
+
+class RelayTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_relay"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "rules", "global"))
+        db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await db.connect()
+
+        self.received = bytearray()
+        self.upstream = await asyncio.start_server(self.echo, "127.0.0.1", 0)
+        upstream_port = self.upstream.sockets[0].getsockname()[1]
+
+        self.proxy = TcpProxy("127.0.0.1", 0, "127.0.0.1", upstream_port, upstream_pool=False)
+        self.proxy.rule_engine = RuleEngine(os.path.join(self.test_dir, "rules"))
+        self.proxy_task = asyncio.create_task(self.proxy.start())
+        while self.proxy.server is None:
+            await asyncio.sleep(0.01)
+        self.port = self.proxy.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.proxy_task.cancel()
+        self.upstream.close()
+        await db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def echo(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.received += data
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def http(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                self.received += head
+                path = head.split(b" ")[1]
+                # на HEAD - длина без тела
+                body = b"" if head.startswith(b"HEAD ") else path
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(path), body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def use_http_upstream(self):
+        self.http_upstream = await asyncio.start_server(self.http, "127.0.0.1", 0)
+        self.proxy.target_port = self.http_upstream.sockets[0].getsockname()[1]
+
+        with open(os.path.join(self.test_dir, "rules", "global", "evil.rule"), "w") as f:
+            f.write("if 'evil' in request.path: action.drop()")
+        self.proxy.rule_engine.reload_rules()
+
+    async def read_response(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        length = int(head.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+        return head.split(b" ")[1], await reader.readexactly(length)
+
+class TestRelay(RelayTestCase):
+    async def test_large_binary_passthrough(self):
+        payload = os.urandom(8 * 1024 * 1024)
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        async def send():
+            writer.write(payload)
+            await writer.drain()
+            writer.write_eof()
+
+        sender = asyncio.create_task(send())
+        echoed = await asyncio.wait_for(reader.readexactly(len(payload)), 30)
+        await sender
+        writer.close()
+
+        self.assertEqual(hashlib.sha1(echoed).digest(), hashlib.sha1(payload).digest())
+
+    async def test_drop_keeps_connection(self):
+        await self.use_http_upstream()
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        # pipelined: the dropped request gets its reply in order, the rest go upstream
+        writer.write(b"GET /ok1 HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /evil HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /ok2 HTTP/1.1\r\nHost: x\r\n\r\nGET /ok")
+        await writer.drain()
+        self.assertEqual(await self.read_response(reader), (b"200", b"/ok1"))
+        self.assertEqual(await self.read_response(reader), (b"403", b"Forbidden"))
+        self.assertEqual(await self.read_response(reader), (b"200", b"/ok2"))
+
+        # the partial request is held until it is complete and checked
+        await asyncio.sleep(0.05)
+        self.assertNotIn(b"GET /ok3", self.received)
+        writer.write(b"3 HTTP/1.1\r\nHost: x\r\n\r\n")
+        await writer.drain()
+        self.assertEqual(await self.read_response(reader), (b"200", b"/ok3"))
+        writer.close()
+
+        self.assertNotIn(b"/evil", self.received)
+        self.http_upstream.close()
+
+    async def test_garbage_after_dropped_request(self):
+        await self.use_http_upstream()
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        # the complete request is still checked, only the garbage after it passes through
+        writer.write(b"GET /evil HTTP/1.1\r\nHost: x\r\n\r\n\x00\x01 garbage \r\n\r\n")
+        await writer.drain()
+        self.assertEqual(await self.read_response(reader), (b"403", b"Forbidden"))
+        self.assertEqual(await self.read_response(reader), (b"200", b"garbage"))
+        writer.close()
+
+        self.assertNotIn(b"/evil", self.received)
+        self.http_upstream.close()
+
+    async def test_drop_reply_after_head(self):
+        await self.use_http_upstream()
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        # the HEAD response has Content-Length but no body, the drop reply follows it
+        writer.write(b"HEAD /head HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /evil HTTP/1.1\r\nHost: x\r\n\r\n")
+        await writer.drain()
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        self.assertIn(b"Content-Length: 5", head)
+        self.assertEqual(await self.read_response(reader), (b"403", b"Forbidden"))
+        writer.close()
+        self.http_upstream.close()
+
+    async def test_drop_closes_without_response(self):
+        await self.use_http_upstream()
+        self.proxy._drop_response = None
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(b"GET /evil HTTP/1.1\r\nHost: x\r\n\r\n")
+        await writer.drain()
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+        writer.close()
+        self.http_upstream.close()
+
+class TestRelayPhases(RelayTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.bodies = []
+        self.upload_upstream = await asyncio.start_server(self.upload, "127.0.0.1", 0)
+        self.proxy.target_port = self.upload_upstream.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.upload_upstream.close()
+        await super().asyncTearDown()
+
+    async def upload(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                self.received += head
+                length = int(head.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+                body = await reader.readexactly(length)
+                self.bodies.append(body)
+                digest = hashlib.sha1(body).hexdigest().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(digest), digest))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    def rule(self, name, content):
+        with open(os.path.join(self.test_dir, "rules", "global", name), "w") as f:
+            f.write(content)
+        self.proxy.rule_engine.reload_rules()
+
+    async def test_headers_phase_drop(self):
+        self.rule("upload.rule", "# @phase: headers\nif request.path == '/upload': action.drop()")
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        body = os.urandom(1024 * 1024)
+        writer.write(b"POST /upload HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body[:1000])
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.write(body[1000:] + b"POST /ok HTTP/1.1\r\nContent-Length: 2\r\n\r\nok")
+        await writer.drain()
+
+        self.assertEqual(await self.read_response(reader), (b"403", b"Forbidden"))
+        self.assertEqual(await self.read_response(reader), (b"200", hashlib.sha1(b"ok").hexdigest().encode()))
+        writer.close()
+        self.assertNotIn(b"/upload", self.received)
+        self.assertEqual(self.bodies, [b"ok"])
+
+    async def test_large_body_streamed(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        body = os.urandom(1024 * 1024)
+        writer.write(b"POST /big HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body[:256 * 1024])
+        await writer.drain()
+        # the upstream gets the request before the client has finished sending it
+        for _ in range(100):
+            if b"POST /big" in self.received:
+                break
+            await asyncio.sleep(0.01)
+        self.assertIn(b"POST /big", self.received)
+
+        writer.write(body[256 * 1024:])
+        await writer.drain()
+        self.assertEqual(await self.read_response(reader), (b"200", hashlib.sha1(body).hexdigest().encode()))
+        writer.close()
+
+    async def test_streamed_body_rejected(self):
+        self.rule("evil.rule", "# @phase: stream\nif b'EVIL' in request.window: action.drop()")
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        body = bytearray(1024 * 1024)
+        body[700 * 1024:700 * 1024 + 4] = b"EVIL"
+        writer.write(b"POST /big HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body))
+        try:
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+        # the start of the body is already upstream: reply and close. The unread
+        # rest of the upload may turn the close into a reset that eats the reply
+        try:
+            reply = await asyncio.wait_for(reader.read(), 5)
+        except ConnectionResetError:
+            reply = b""
+        writer.close()
+        if reply:
+            self.assertTrue(reply.startswith(b"HTTP/1.1 403"))
+        self.assertIn(b"POST /big", self.received)
+        self.assertEqual(self.bodies, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import asyncio
+import shutil
+import os
+from app.core.engine import RuleEngine, ActionType
+from app.core.parser import HttpRequest
+
+SLOW_RULE = "n = 0\nwhile len(request.path) < 10 ** 9:\n    n += 1\n"
+
+class TestRuleBudget(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/rules_budget"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "global"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.test_dir, "global", name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_quarantine_after_violations(self):
+        # busy loop for ~20ms, budget is 1ms
+        self.write("a_slow.rule", "n = 0\nwhile n < 200000:\n    n += 1\naction.mark('slow')")
+        self.write("b_fast.rule", "action.mark('fast')")
+
+        engine = RuleEngine(self.test_dir, rule_budget_ms=1, request_budget_ms=0, quarantine_after=2)
+        self.assertEqual(sorted(engine.evaluate(HttpRequest()).tags), ["fast", "slow"])
+        self.assertEqual(engine.quarantined(), [])
+
+        engine.evaluate(HttpRequest())
+        self.assertEqual(engine.quarantined(), [{"path": os.path.join("global", "a_slow.rule"), "violations": 2}])
+        self.assertEqual(engine.evaluate(HttpRequest()).tags, ["fast"])
+
+        # quarantine survives reloads of the same content
+        engine.reload_rules()
+        self.assertEqual(len(engine.rules), 1)
+
+        self.assertTrue(asyncio.run(engine.release(os.path.join("global", "a_slow.rule"))))
+        self.assertEqual(len(engine.rules), 2)
+        self.assertEqual(engine.status()["quarantined"], 0)
+
+    def test_changed_rule_leaves_quarantine(self):
+        path = self.write("slow.rule", "n = 0\nwhile n < 200000:\n    n += 1\n")
+        engine = RuleEngine(self.test_dir, rule_budget_ms=1, request_budget_ms=0, quarantine_after=1)
+        engine.evaluate(HttpRequest())
+        self.assertEqual(len(engine.rules), 0)
+
+        with open(path, "w") as f:
+            f.write("action.drop()")
+        engine.reload_rules()
+        self.assertEqual(engine.evaluate(HttpRequest()).type, ActionType.DROP)
+
+    def test_request_budget(self):
+        self.write("a_slow.rule", "n = 0\nwhile n < 200000:\n    n += 1\n")
+        self.write("b_drop.rule", "action.drop()")
+
+        os.makedirs(os.path.join(self.test_dir, "services", "8080"))
+        with open(os.path.join(self.test_dir, "services", "8080", "s_slow.rule"), "w") as f:
+            f.write("n = 0\nwhile n < 200000:\n    n += 1\n")
+        with open(os.path.join(self.test_dir, "services", "8080", "s_tag.rule"), "w") as f:
+            f.write("action.mark('s_tag')")
+
+        # the skipped rules might have dropped the request: fail closed by default
+        engine = RuleEngine(self.test_dir, rule_budget_ms=0, request_budget_ms=1)
+        act = engine.evaluate(HttpRequest())
+        self.assertEqual((act.type, act.tags), (ActionType.DROP, ["budget_exceeded"]))
+        self.assertEqual(engine.status()["budget_exceeded"], 1)
+
+        # both buckets skip rules, the request is counted once
+        act = engine.evaluate(HttpRequest(destination_port=8080))
+        self.assertEqual((act.type, act.tags), (ActionType.DROP, ["budget_exceeded"]))
+        self.assertEqual(engine.status()["budget_exceeded"], 2)
+
+        engine = RuleEngine(self.test_dir, rule_budget_ms=0, request_budget_ms=1, request_budget_fallback="ACCEPT")
+        act = engine.evaluate(HttpRequest())
+        self.assertEqual((act.type, act.tags), (ActionType.ACCEPT, ["budget_exceeded"]))
+
+class TestHeavyRules(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.test_dir = "tests/rules_heavy"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "global"))
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.test_dir, "global", name), "w") as f:
+            f.write(content)
+
+    async def test_heavy_rule_in_pool(self):
+        self.write("heavy.rule", "# @heavy\nif 'evil' in request.data:\n    action.drop()\n")
+        self.write("mark.rule", "action.mark('light')")
+        self.engine = RuleEngine(self.test_dir, heavy_timeout_ms=10000, heavy_workers=1)
+        self.assertTrue(self.engine.snapshot.has_heavy_rules)
+
+        act = await self.engine.evaluate_async(HttpRequest(body=b"evil"))
+        self.assertEqual(act.type, ActionType.DROP)
+        self.assertEqual(sorted(act.tags), ["heavy", "light"])
+
+        act = await self.engine.evaluate_async(HttpRequest(body=b"fine"))
+        self.assertEqual(act.type, ActionType.ACCEPT)
+
+    async def test_heavy_rule_deadline_fallback(self):
+        self.write("hang.rule", "# @heavy\n# @timeout_ms: 300\n" + SLOW_RULE)
+        self.engine = RuleEngine(self.test_dir, heavy_workers=1, heavy_fallback="DROP", quarantine_after=1)
+
+        act = await self.engine.evaluate_async(HttpRequest())
+        self.assertEqual(act.type, ActionType.DROP)
+        self.assertEqual(act.tags, ["hang"])
+        # the runaway rule is quarantined, the pool is replaced
+        self.assertEqual(len(self.engine.rules), 0)
+        self.assertIsNone(self.engine._heavy_pool)
+
+    async def test_deadline_spares_other_jobs(self):
+        self.write("hang.rule", "# @heavy\n# @timeout_ms: 300\n" + SLOW_RULE)
+        # still running when the other rule misses its deadline
+        self.write("slow_drop.rule", "# @heavy\n# @timeout_ms: 20000\nn = 0\nwhile n < 5 * 10 ** 6:\n    n += 1\naction.drop()\n")
+        self.engine = RuleEngine(self.test_dir, heavy_workers=2)
+
+        act = await self.engine.evaluate_async(HttpRequest())
+        self.assertEqual((act.type, act.tags), (ActionType.DROP, ["slow_drop"]))
+        self.assertEqual(self.engine._retired_pools, [])
+        self.assertEqual(self.engine._heavy_inflight, {})
+
+    async def test_broken_pool_fallback(self):
+        self.write("heavy.rule", "# @heavy\naction.mark('ran')\n")
+        self.engine = RuleEngine(self.test_dir, heavy_timeout_ms=10000, heavy_workers=1, heavy_fallback="DROP")
+        self.assertEqual((await self.engine.evaluate_async(HttpRequest())).tags, ["ran"])
+
+        # a worker process dies: the pool is broken for every job in it
+        pool = self.engine._heavy_pool
+        for process in list(pool._processes.values()):
+            process.kill()
+            process.join()
+        act = await self.engine.evaluate_async(HttpRequest())
+        self.assertEqual((act.type, act.tags), (ActionType.DROP, ["heavy"]))
+        self.assertIsNot(self.engine._heavy_pool, pool)
+
+        # the next request gets a fresh pool
+        self.assertEqual((await self.engine.evaluate_async(HttpRequest())).tags, ["ran"])
+
+if __name__ == "__main__":
+    unittest.main()
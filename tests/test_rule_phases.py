@@ -0,0 +1,86 @@
+import unittest
+import os
+import shutil
+from app.core.engine import RuleEngine, ActionType
+from app.core.parser import HttpStreamParser, ParserMode, HttpRequest
+
+class TestRulePhases(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/rules_phases"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "global"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.test_dir, "global", name), "w") as f:
+            f.write(content)
+
+    def parser(self, engine):
+        return HttpStreamParser(ParserMode.REQUEST, on_headers=engine.evaluate_headers,
+                                on_body_chunk=engine.evaluate_chunk)
+
+    def test_phase_index(self):
+        self.write("h.rule", "# @phase: headers\naction.mark('h')")
+        self.write("s.rule", "# @phase: stream\naction.mark('s')")
+        self.write("b.rule", "action.mark('b')")
+        # heavy rules only run on the full message
+        self.write("x.rule", "# @heavy\n# @phase: headers\naction.mark('x')")
+        engine = RuleEngine(self.test_dir)
+
+        self.assertEqual(engine.status()["phases"], {"headers": 1, "stream": 1, "body": 2})
+        self.assertEqual([r.name for r in engine.global_rules], ["b", "x"])
+        self.assertEqual([r.name for r in engine.snapshot.phases["headers"][0]], ["h"])
+
+    def test_headers_phase_drop(self):
+        self.write("h.rule", "# @phase: headers\nif request.path == '/upload': action.drop()")
+        self.write("b.rule", "action.mark('body')")
+        engine = RuleEngine(self.test_dir)
+        parser = self.parser(engine)
+
+        self.assertEqual(parser.feed(b"POST /upload HTTP/1.1\r\nContent-Length: 10\r\n\r\n12345"), [])
+        self.assertEqual(parser.current.dropped_phase, "headers")
+        msg = parser.feed(b"67890")[0]
+        # the body of a rejected request is not kept
+        self.assertEqual(msg.body, b"")
+
+        act = engine.evaluate(msg)
+        self.assertEqual(act.type, ActionType.DROP)
+        self.assertEqual(act.tags, ["h"])
+
+    def test_headers_tags_carry_over(self):
+        self.write("h.rule", "# @phase: headers\naction.mark('early')")
+        self.write("b.rule", "if request.body == b'data': action.drop()")
+        engine = RuleEngine(self.test_dir)
+
+        msg = self.parser(engine).feed(b"POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\ndata")[0]
+        self.assertEqual(msg.dropped_phase, "")
+        act = engine.evaluate(msg)
+        self.assertEqual(act.type, ActionType.DROP)
+        self.assertEqual(sorted(act.tags), ["b", "early"])
+
+    def test_stream_window(self):
+        self.write("s.rule", "# @phase: stream\nif 'EVIL' in request.window_data: action.drop()")
+        engine = RuleEngine(self.test_dir, stream_lookbehind=3)
+        req = HttpRequest()
+
+        self.assertFalse(engine.evaluate_chunk(req, b"xxxxxEV"))
+        # the match straddles the chunk boundary
+        self.assertTrue(engine.evaluate_chunk(req, b"ILxx"))
+        self.assertEqual(req.window, b"xEVILxx")
+        self.assertEqual(req.window_start, 4)
+        self.assertEqual(req.dropped_phase, "stream")
+
+    def test_no_early_rules(self):
+        self.write("b.rule", "action.mark('b')")
+        engine = RuleEngine(self.test_dir)
+        req = HttpRequest()
+        self.assertFalse(engine.evaluate_headers(req))
+        self.assertFalse(engine.evaluate_chunk(req, b"data"))
+        # no stream rules - no window copies
+        self.assertEqual(req.window, b"")
+
+if __name__ == "__main__":
+    unittest.main()
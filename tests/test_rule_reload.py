@@ -0,0 +1,75 @@
+import unittest
+import asyncio
+import shutil
+import os
+from app.core.engine import RuleEngine, ActionType
+from app.core.parser import HttpRequest
+
+class TestRuleReload(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/rules_reload"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "global"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.test_dir, "global", name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_only_changed_files_recompiled(self):
+        self.write("a.rule", "action.mark('a')")
+        self.write("b.rule", "action.mark('b')")
+        self.write("s.sig", "mark:sig path contains /x\n")
+
+        engine = RuleEngine(self.test_dir)
+        self.assertEqual(engine.generation, 1)
+        old = {r.name: r for r in engine.rules}
+        old_sigs = engine.global_signatures
+
+        self.write("b.rule", "action.mark('b2')")
+        self.assertEqual(engine.reload_rules(), 2)
+
+        new = {r.name: r for r in engine.rules}
+        self.assertIs(new["a"], old["a"])
+        self.assertIsNot(new["b"], old["b"])
+        # signature files did not change - automaton is reused
+        self.assertIs(engine.global_signatures, old_sigs)
+
+        act = engine.evaluate(HttpRequest(path="/x"))
+        self.assertEqual(sorted(act.tags), ["a", "b2", "sig"])
+
+    def test_removed_and_added_files(self):
+        path = self.write("a.rule", "action.drop()")
+        engine = RuleEngine(self.test_dir)
+        self.assertEqual(engine.evaluate(HttpRequest()).type, ActionType.DROP)
+
+        os.rename(path, path + ".disabled")
+        self.write("s.sig", "drop path contains /y\n")
+        engine.reload_rules()
+
+        self.assertEqual(len(engine.rules), 0)
+        self.assertEqual(engine.evaluate(HttpRequest()).type, ActionType.ACCEPT)
+        self.assertEqual(engine.evaluate(HttpRequest(path="/y")).type, ActionType.DROP)
+
+    def test_snapshot_kept_by_running_evaluation(self):
+        self.write("a.rule", "action.mark('old')")
+        engine = RuleEngine(self.test_dir)
+        snapshot = engine.snapshot
+
+        self.write("a.rule", "action.mark('new')")
+        generation = asyncio.run(engine.reload_rules_async())
+
+        self.assertEqual(generation, 2)
+        self.assertIsNot(engine.snapshot, snapshot)
+        self.assertEqual(snapshot.generation, 1)
+        self.assertEqual(len(snapshot.rules), 1)
+        self.assertEqual(engine.evaluate(HttpRequest()).tags, ["new"])
+        self.assertEqual(engine.status()["generation"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import shutil
+import os
+from app.core.engine import RuleEngine
+from app.core.parser import HttpRequest
+from app.core.rulestats import RuleStats
+
+class TestRuleStats(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/rules_stats"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "global"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.test_dir, "global", name), "w") as f:
+            f.write(content)
+
+    def stats(self, engine):
+        return {s["name"]: s for s in engine.rule_stats()}
+
+    def test_counters(self):
+        self.write("drop.rule", "if 'x' in request.path: action.drop()")
+        self.write("mark.rule", "action.mark('m')")
+        self.write("boom.rule", "if request.path == '/boom': 1 / 0")
+        self.write("never.rule", "if request.path == '/never': action.accept()")
+
+        engine = RuleEngine(self.test_dir)
+        for path in ["/x", "/y", "/boom"]:
+            engine.evaluate(HttpRequest(path=path))
+
+        stats = self.stats(engine)
+        self.assertEqual(stats["drop"]["evaluations"], 3)
+        self.assertEqual(stats["drop"]["matches"], {"accept": 0, "drop": 1, "mark": 0})
+        self.assertEqual(stats["mark"]["matches"]["mark"], 3)
+        self.assertEqual(stats["boom"]["exceptions"], 1)
+        self.assertEqual(stats["never"]["matches"], {"accept": 0, "drop": 0, "mark": 0})
+        self.assertGreater(stats["drop"]["total_ms"], 0)
+
+    def test_survive_reload_of_unchanged_files(self):
+        self.write("a.rule", "action.mark('a')")
+        self.write("b.rule", "action.mark('b')")
+        engine = RuleEngine(self.test_dir)
+        engine.evaluate(HttpRequest())
+        engine.evaluate(HttpRequest())
+
+        self.write("b.rule", "action.mark('b2')")
+        engine.reload_rules()
+
+        stats = self.stats(engine)
+        self.assertEqual(stats["a"]["evaluations"], 2)
+        self.assertEqual(stats["b"]["evaluations"], 0)
+
+        self.assertEqual(engine.reset_stats(os.path.join("global", "a.rule")), 1)
+        self.assertEqual(self.stats(engine)["a"]["evaluations"], 0)
+
+    def test_percentiles(self):
+        stats = RuleStats()
+        for _ in range(98):
+            stats.record(0.00001)
+        stats.record(0.01)
+        stats.record(0.01)
+
+        data = stats.to_dict()
+        self.assertLess(data["p50_ms"], 0.02)
+        self.assertLess(data["p90_ms"], 0.02)
+        self.assertGreater(data["p99_ms"], 5)
+        self.assertEqual(data["max_ms"], 10.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+import shutil
+import os
+import gzip
+import json
+import sqlite3
+from unittest import mock
+from app.database import migrations
+from app.database.db import Database
+from app.database.search import SearchIndexMissing, search_messages
+from app.database.writer import TrafficWriter
+
+class TestSearch(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_search"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+        # разделы по минуте: 960, 1020, 1080, ...
+        self.db = Database(readers=1, checkpoint_interval=0, partition_minutes=1, retention_hours=0)
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await self.db.connect()
+        self.writer = TrafficWriter(self.db, spill_path=os.path.join(self.test_dir, "spill.bin"))
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def message(self, stream_id, ts, url="/", body=b"", headers=None, status=None, tags=()):
+        await self.writer.submit("message", (stream_id, "RESPONSE" if status else "REQUEST", None if status else "GET",
+                                             url, status, json.dumps(headers or {}), body, json.dumps(list(tags)), ts))
+
+    async def fill(self):
+        await self.writer.submit("session_open", (1, "10.0.0.1", 1000.0, 1100.0))
+        await self.writer.submit("stream_open", (1, 1, "10.0.0.1", 4001, "127.0.0.1", 80, 1000.0))
+        await self.writer.submit("stream_open", (2, 1, "10.0.0.2", 4002, "127.0.0.1", 80, 1100.0))
+        await self.message(1, 1001.0, "/download?file=../../etc/passwd", tags=["lfi"])
+        await self.message(1, 1002.0, body=b"<html>hello flag world</html>", status=200)
+        await self.message(2, 1101.0, "/api/users", body=gzip.compress(b'{"flag": "FLAG_abc123"}'),
+                           headers={"Content-Encoding": "gzip"}, status=500)
+        await self.message(2, 1102.0, "/upload", body=os.urandom(2000) + b"flag")
+
+    async def ids(self, query, **filters):
+        page = await search_messages(query, database=self.db, **filters)
+        return [row["id"] for row in page["results"]]
+
+    async def test_queries(self):
+        await self.fill()
+        self.assertEqual(self.db.partitions(), [1080, 960, None])
+
+        # новые сверху, из обоих разделов; двоичное тело не индексируется
+        page = await search_messages("flag", database=self.db)
+        self.assertEqual([(row["partition"], row["id"]) for row in page["results"]], [(1080, 1), (960, 2)])
+        self.assertIsNone(page["next_cursor"])
+        self.assertEqual(page["results"][0]["url"], "/api/users")
+        self.assertEqual(page["results"][0]["client_ip"], "10.0.0.2")
+
+        self.assertEqual(await self.ids('"hello flag"'), [2])
+        self.assertEqual(await self.ids('"flag hello"'), [])
+        self.assertEqual(await self.ids("FLAG_ab*"), [1])
+        self.assertEqual(await self.ids("flag NOT hello"), [1])
+        # не синтаксис FTS5 - ищется как фраза
+        self.assertEqual(await self.ids("../../etc/passwd"), [1])
+        self.assertEqual(await self.ids("content-encoding: gzip"), [1])
+        with self.assertRaises(ValueError):
+            await search_messages("  ", database=self.db)
+
+    async def test_filters(self):
+        await self.fill()
+        self.assertEqual(await self.ids("flag", client_ip="10.0.0.1"), [2])
+        self.assertEqual(await self.ids("flag", client_port=4002), [1])
+        self.assertEqual(await self.ids("flag", status=200), [2])
+        self.assertEqual(await self.ids("passwd", tag="lfi"), [1])
+        self.assertEqual(await self.ids("passwd", tag="other"), [])
+        self.assertEqual(await self.ids("flag", since=1050.0), [1])
+        self.assertEqual(await self.ids("flag", until=1050.0), [2])
+        with self.assertRaises(ValueError):
+            await search_messages("flag", database=self.db, method="GET")
+
+    async def test_pages_across_partitions(self):
+        await self.fill()
+        for i in range(3):
+            await self.message(2, 1103.0 + i, f"/flag/{i}")
+
+        seen = []
+        cursor = None
+        while True:
+            page = await search_messages("flag", limit=2, cursor=cursor, database=self.db)
+            seen += [(row["partition"], row["id"]) for row in page["results"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, [(1080, 5), (1080, 4), (1080, 3), (1080, 1), (960, 2)])
+        with self.assertRaises(ValueError):
+            await search_messages("flag", cursor="x:y", database=self.db)
+
+    async def test_index_switched_off(self):
+        self.writer.search_index = False
+        await self.fill()
+        self.assertEqual(await self.ids("flag"), [])
+
+    async def test_database_errors_are_not_query_errors(self):
+        await self.fill()
+        conn = sqlite3.connect(self.db.partition_path(1080))
+        conn.execute("DROP TABLE messages_fts")
+        conn.commit()
+        conn.close()
+        # not retried as a phrase and not reported as a bad query
+        with self.assertRaisesRegex(SearchIndexMissing, "partition 1080"):
+            await search_messages("flag", database=self.db)
+
+class TestSearchMigration(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_search_migration"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+        self.db = Database(partition_minutes=0)
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def test_existing_messages_indexed(self):
+        await self.db.connect()
+        writer = TrafficWriter(self.db, spill_path=os.path.join(self.test_dir, "spill.bin"))
+        await writer.submit("stream_open", (1, 1, "10.0.0.1", 4001, "127.0.0.1", 80, 1000.0))
+        await writer.submit("message", (1, "REQUEST", "POST", "/login", None, "{}", b"user=admin" * 100, "[]", 1001.0))
+        await self.db.close()
+
+        # база до поиска: без индекса и без записи о миграции 6
+        conn = sqlite3.connect(self.db.db_path)
+        conn.execute("DROP TABLE messages_fts")
+        conn.execute("DELETE FROM schema_version WHERE version = 6")
+        conn.commit()
+        conn.close()
+
+        await self.db.connect()
+        page = await search_messages("admin", database=self.db)
+        self.assertEqual([row["url"] for row in page["results"]], ["/login"])
+
+        # id сообщений продолжаются после уже записанных
+        writer = TrafficWriter(self.db, spill_path=os.path.join(self.test_dir, "spill.bin"))
+        await writer.submit("message", (1, "RESPONSE", None, None, 200, "{}", b"welcome admin", "[]", 1002.0))
+        page = await search_messages("admin", database=self.db)
+        self.assertEqual([row["id"] for row in page["results"]], [2, 1])
+
+    async def test_index_disabled_then_enabled(self):
+        with mock.patch.object(migrations.config, "SEARCH_INDEX", False):
+            await self.db.connect()
+            self.assertFalse(self.db.search_index)
+            writer = TrafficWriter(self.db, spill_path=os.path.join(self.test_dir, "spill.bin"))
+            await writer.submit("stream_open", (1, 1, "10.0.0.1", 4001, "127.0.0.1", 80, 1000.0))
+            await writer.submit("message", (1, "REQUEST", "GET", "/admin", None, "{}", b"", "[]", 1001.0))
+            with self.assertRaises(SearchIndexMissing):
+                await search_messages("admin", database=self.db)
+            await self.db.close()
+
+        # включённый индекс достраивается при подключении, со старыми сообщениями
+        await self.db.connect()
+        self.assertTrue(self.db.search_index)
+        page = await search_messages("admin", database=self.db)
+        self.assertEqual([row["url"] for row in page["results"]], ["/admin"])
+
+    async def test_sqlite_without_fts5(self):
+        async def no_fts5(conn):
+            return False
+
+        with mock.patch.object(migrations, "fts5_available", no_fts5):
+            await self.db.connect()
+        self.assertFalse(self.db.search_index)
+        with self.assertRaises(SearchIndexMissing):
+            await search_messages("admin", database=self.db)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import shutil
+import os
+import json
+from app.database.db import Database
+from app.database.queries import list_sessions, session_details
+from app.database.writer import TrafficWriter
+
+class TestSessionQueries(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_queries"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+        # потоки создаются прямо в основном файле, без разделов
+        self.db = Database(partition_minutes=0)
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await self.db.connect()
+        writer = TrafficWriter(self.db, spill_path=os.path.join(self.test_dir, "spill.bin"))
+
+        # 7 сессий по 3 потока, в каждом запрос и ответ; у двух сессий одинаковое время
+        for i in range(7):
+            activity = 1000.0 + (i if i != 6 else 5)
+            session_id = await self.db.execute(
+                "INSERT INTO user_sessions (client_ip, start_time, last_activity_time, alert_level) VALUES (?, ?, ?, ?)",
+                (f"10.0.0.{i}", 900.0 + i, activity, i % 3)
+            )
+            for j in range(3):
+                stream_id = await self.db.execute(
+                    "INSERT INTO tcp_streams (user_session_id, client_ip, client_port, target_ip, target_port, start_time) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (session_id, f"10.0.0.{i}", 4000 + j, "127.0.0.1", 80, 900.0 + j)
+                )
+                tags = json.dumps([f"tag{j}", "common"]) if j else "not json"
+                # тела - через писатель, как у прокси (bodies по хешу)
+                await writer.submit("message", (stream_id, "REQUEST", "POST", "/x", None, "{}",
+                                                b"payload" * 10, tags, 901.0 + j))
+                await writer.submit("message", (stream_id, "RESPONSE", None, None, 200, "{}",
+                                                b"ok", "[]", 902.0 + j))
+
+        # считаем запросы к БД
+        self.queries = 0
+        fetch_all = self.db.fetch_all
+
+        async def counting(query, parameters=(), **kwargs):
+            self.queries += 1
+            return await fetch_all(query, parameters, **kwargs)
+        self.db.fetch_all = counting
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def test_keyset_pages(self):
+        seen = []
+        cursor = None
+        pages = 0
+        while True:
+            page = await list_sessions(limit=3, cursor=cursor, database=self.db)
+            seen.extend(s["id"] for s in page["sessions"])
+            pages += 1
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(pages, 3)
+        # страница и счётчики её сессий (без разделов - только основной файл)
+        self.assertEqual(self.queries, 6)
+        # все сессии по разу, новые сверху, при равном времени - больший id раньше
+        self.assertEqual(seen, [7, 6, 5, 4, 3, 2, 1])
+
+    async def test_summary_fields(self):
+        page = await list_sessions(limit=50, database=self.db)
+        self.assertIsNone(page["next_cursor"])
+        session = page["sessions"][0]
+        self.assertEqual(session["stream_count"], 3)
+        self.assertEqual(session["message_count"], 6)
+        self.assertEqual(sorted(session["tags"]), ["common", "tag1", "tag2"])
+        self.assertNotIn("streams", session)
+
+    async def test_details(self):
+        summary = await session_details(1, database=self.db)
+        self.assertEqual(self.queries, 2)
+        self.assertEqual([s["client_port"] for s in summary["streams"]], [4000, 4001, 4002])
+        message = summary["streams"][0]["messages"][0]
+        self.assertEqual(message["body_size"], 70)
+        self.assertNotIn("body", message)
+        self.assertEqual(summary["tags"], ["common", "tag1", "tag2"])
+
+        full = await session_details(1, bodies=True, database=self.db)
+        self.assertEqual(full["streams"][1]["messages"][0]["body"], "payload" * 10)
+        self.assertEqual(full["streams"][1]["messages"][1]["type"], "RESPONSE")
+        self.assertIsNone(await session_details(100, database=self.db))
+
+        # 42 сообщения, два разных тела
+        rows = await self.db.fetch_all("SELECT COUNT(*) FROM bodies")
+        self.assertEqual(rows[0][0], 2)
+
+    async def test_bad_cursor(self):
+        with self.assertRaises(ValueError):
+            await list_sessions(cursor="garbage", database=self.db)
@@ -0,0 +1,127 @@
+import unittest
+import shutil
+import os
+from types import SimpleNamespace
+from unittest import mock
+from app.core.session import SessionManager
+from app.database.db import Database
+from app.database.writer import TrafficWriter
+
+class TestSessionRegistry(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_registry"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+        self.db = Database()
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await self.db.connect()
+        self.writer = TrafficWriter(self.db, flush_interval=60, batch_size=1000, queue_size=1000,
+                                    overflow_policy="drop", spill_path=os.path.join(self.test_dir, "spill.bin"))
+        await self.writer.start()
+
+        # считаем запросы к БД и управляем временем
+        self.queries = 0
+        fetch_all = self.db.fetch_all
+
+        async def counting(query, parameters=(), **kwargs):
+            self.queries += 1
+            return await fetch_all(query, parameters, **kwargs)
+        self.db.fetch_all = counting
+        self.now = 1000.0
+
+        SessionManager.configure_ids(0, 1)
+        self.patches = [
+            mock.patch("app.core.session.db", self.db),
+            mock.patch("app.core.session.writer", self.writer),
+            mock.patch("app.core.session.time", SimpleNamespace(time=lambda: self.now)),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    async def asyncTearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        SessionManager.configure_ids(0, 1)
+        await self.writer.stop()
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    def session_of(self, stream_id):
+        return SessionManager.registry.streams[stream_id].id
+
+    async def persisted(self, query):
+        await self.writer.flush()
+        # сессии в основном файле, потоки - в разделе
+        return [tuple(row) for rows in await self.db.fetch_partitions(query) for row in rows]
+
+    async def test_no_queries_per_connection(self):
+        first = await SessionManager.start_stream("10.0.0.1", 1000, "127.0.0.1", 80)
+        self.now += 10
+        second = await SessionManager.start_stream("10.0.0.1", 1001, "127.0.0.1", 80)
+        other = await SessionManager.start_stream("10.0.0.2", 1000, "127.0.0.1", 80)
+        for port in range(20):
+            await SessionManager.start_stream("10.0.0.3", port, "127.0.0.1", 80)
+
+        # только начальная загрузка реестра
+        self.assertEqual(self.queries, 3)
+        self.assertEqual(self.session_of(first), self.session_of(second))
+        self.assertNotEqual(self.session_of(first), self.session_of(other))
+
+        self.queries = 0
+        streams = await self.persisted("SELECT id, user_session_id FROM tcp_streams ORDER BY id")
+        self.assertEqual(streams[:3], [(first, 1), (second, 1), (other, 2)])
+        sessions = await self.persisted("SELECT id, client_ip, last_activity_time FROM user_sessions ORDER BY id")
+        self.assertEqual(sessions, [(1, "10.0.0.1", 1010.0), (2, "10.0.0.2", 1010.0), (3, "10.0.0.3", 1010.0)])
+
+    async def test_sliding_timeout(self):
+        timeout = SessionManager.SESSION_TIMEOUT
+        first = await SessionManager.start_stream("10.0.0.1", 1000, "127.0.0.1", 80)
+        # каждое соединение продлевает сессию
+        for _ in range(3):
+            self.now += timeout - 1
+            stream = await SessionManager.start_stream("10.0.0.1", 1000, "127.0.0.1", 80)
+            self.assertEqual(self.session_of(stream), self.session_of(first))
+
+        self.now += timeout
+        stream = await SessionManager.start_stream("10.0.0.1", 1000, "127.0.0.1", 80)
+        self.assertNotEqual(self.session_of(stream), self.session_of(first))
+        # истёкшие сессии других IP не копятся
+        self.assertEqual(list(SessionManager.registry.by_ip), ["10.0.0.1"])
+
+    async def test_alert_levels(self):
+        stream = await SessionManager.start_stream("10.0.0.1", 1000, "127.0.0.1", 80)
+        with mock.patch.object(self.writer, "submit", wraps=self.writer.submit) as submit:
+            await SessionManager.update_session_alert(stream, 1)
+            await SessionManager.update_session_alert(stream, 1)
+            await SessionManager.update_session_alert(stream, 2)
+            await SessionManager.update_session_alert(stream, 1)
+            kinds = [call.args[0] for call in submit.call_args_list]
+        self.assertEqual(kinds, ["session_alert", "session_alert"])
+        self.assertEqual(await self.persisted("SELECT alert_level FROM user_sessions"), [(2,)])
+
+        # у закрытого потока сессию ищет сам UPDATE
+        other = await SessionManager.start_stream("10.0.0.2", 1000, "127.0.0.1", 80)
+        await SessionManager.close_stream(other)
+        self.assertNotIn(other, SessionManager.registry.streams)
+        await SessionManager.update_session_alert(other, 1)
+        self.assertEqual(await self.persisted("SELECT alert_level FROM user_sessions ORDER BY id"), [(2,), (1,)])
+
+    async def test_restore_after_restart(self):
+        stream = await SessionManager.start_stream("10.0.0.1", 1000, "127.0.0.1", 80)
+        await SessionManager.update_session_alert(stream, 2)
+        await SessionManager.start_stream("10.0.0.2", 1000, "127.0.0.1", 80)
+        await self.writer.flush()
+
+        # перезапуск: реестр пуст, свежие сессии берутся из БД
+        SessionManager.configure_ids(0, 1)
+        self.now += 5
+        again = await SessionManager.start_stream("10.0.0.1", 1001, "127.0.0.1", 80)
+        self.assertEqual(self.session_of(again), 1)
+        self.assertEqual(SessionManager.registry.streams[again].alert_level, 2)
+        self.assertGreater(again, stream)
+
+        self.now += SessionManager.SESSION_TIMEOUT
+        new = await SessionManager.start_stream("10.0.0.3", 1000, "127.0.0.1", 80)
+        self.assertEqual(self.session_of(new), 3)
@@ -0,0 +1,130 @@
+import unittest
+import shutil
+import os
+from app.core.engine import RuleEngine, ActionType
+from app.core.parser import HttpRequest
+from app.core.signatures import parse_signatures, SignatureSet, SignatureError, Automaton, AUTOMATON_MIN_PATTERNS
+
+class TestSignatureParsing(unittest.TestCase):
+    def test_parse(self):
+        sigs = parse_signatures(
+            "# comment\n"
+            "drop body contains union select\n"
+            "mark:trav path icontains ../\n"
+            "accept headers regex X-Checker: \\d+\n",
+            "x.sig", "x"
+        )
+        self.assertEqual(len(sigs), 3)
+        self.assertEqual(sigs[0].action, "DROP")
+        self.assertEqual(sigs[0].pattern, "union select")
+        self.assertEqual(sigs[1].tag, "trav")
+        self.assertEqual(sigs[2].line, 4)
+
+    def test_bad_lines(self):
+        with self.assertRaises(SignatureError):
+            parse_signatures("drop body contains", "x.sig", "x")
+        with self.assertRaises(SignatureError):
+            parse_signatures("kill body contains x", "x.sig", "x")
+        with self.assertRaises(SignatureError):
+            parse_signatures("drop cookie contains x", "x.sig", "x")
+        with self.assertRaises(SignatureError):
+            parse_signatures("drop body regex (", "x.sig", "x")
+
+class TestSignatureScan(unittest.TestCase):
+    def test_automaton_matches_naive(self):
+        patterns = ["he", "she", "his", "hers", "ushe", "s"]
+        automaton = Automaton({p: (i,) for i, p in enumerate(patterns)})
+        for text in ["ushers", "ahishers", "xyz", "", "sssshe"]:
+            found = set()
+            automaton.search(text, found)
+            expected = {i for i, p in enumerate(patterns) if p in text}
+            self.assertEqual(found, expected, text)
+
+    def test_large_literal_set(self):
+        lines = [f"mark:t{i} body contains token{i}x" for i in range(AUTOMATON_MIN_PATTERNS * 2)]
+        lines.append("drop body icontains UNION SELECT")
+        sigset = SignatureSet(parse_signatures("\n".join(lines), "x.sig", "x"))
+
+        req = HttpRequest(body=b"a=token3x&b=token17x&q=1 union Select 2")
+        found = sigset.scan(req)
+        self.assertEqual(sorted(s.tag for s in found if s.tag), ["t17", "t3"])
+        self.assertIn("DROP", [s.action for s in found])
+
+    def test_regex_not_shadowed(self):
+        sigset = SignatureSet(parse_signatures(
+            "mark:long body regex a.*\n"
+            "drop body regex evil\n"
+            "mark:ci path regex (?i)/ADMIN\n"
+            "mark:backref body regex (x)\\1\n",
+            "x.sig", "x"
+        ))
+        found = sigset.scan(HttpRequest(path="/admin", body=b"a lot of evil xx"))
+        self.assertEqual(sorted(s.tag or s.action for s in found), ["DROP", "backref", "ci", "long"])
+
+    def test_overlapping_matches(self):
+        sigset = SignatureSet(parse_signatures(
+            "mark:a path contains union\n"
+            "mark:b path regex union\\s+select\n"
+            "mark:c path regex select\n",
+            "x.sig", "x"
+        ))
+        found = sigset.scan(HttpRequest(path="/?q=union select 1"))
+        self.assertEqual(sorted(s.tag for s in found), ["a", "b", "c"])
+
+        # regexes starting at the same position and inside each other's match
+        sigset = SignatureSet(parse_signatures(
+            "mark:a path regex union\n"
+            "mark:b path regex union\\s+select\n"
+            "mark:c path regex ion\n"
+            "mark:d path regex ^/x\n",
+            "x.sig", "x"
+        ))
+        found = sigset.scan(HttpRequest(path="/?q=union select 1"))
+        self.assertEqual(sorted(s.tag for s in found), ["a", "b", "c"])
+
+        # DROPs from different files overlap the same way, each keeps its auto-tag
+        sigs = parse_signatures("drop body regex union\\s+select\n", "sqli.sig", "sqli")
+        sigs += parse_signatures("drop body regex select\\s+\\d\n", "select.sig", "select", first_id=len(sigs))
+        found = SignatureSet(sigs).scan(HttpRequest(body=b"1 union select 2"))
+        self.assertEqual(sorted(s.name for s in found), ["select", "sqli"])
+
+        lines = [f"mark:t{i} body contains token{i}x" for i in range(AUTOMATON_MIN_PATTERNS)]
+        lines += ["mark:long body contains union select", "mark:short body contains select"]
+        found = SignatureSet(parse_signatures("\n".join(lines), "x.sig", "x")).scan(HttpRequest(body=b"union select"))
+        self.assertEqual(sorted(s.tag for s in found), ["long", "short"])
+
+class TestSignatureEngine(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/rules_sig"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(os.path.join(self.test_dir, "global"))
+        os.makedirs(os.path.join(self.test_dir, "services", "8080"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_sig_with_rules(self):
+        with open(os.path.join(self.test_dir, "global", "sqli.sig"), "w") as f:
+            f.write("drop body icontains union select\nmark:scanner headers contains sqlmap\n")
+        with open(os.path.join(self.test_dir, "services", "8080", "allow.sig"), "w") as f:
+            f.write("accept path contains /checker\n")
+        with open(os.path.join(self.test_dir, "global", "mark.rule"), "w") as f:
+            f.write("if request.method == 'POST': action.mark('post')")
+
+        engine = RuleEngine(self.test_dir)
+
+        act = engine.evaluate(HttpRequest(method="POST", body=b"1 UNION SELECT 2", raw_headers="User-Agent: sqlmap"))
+        self.assertEqual(act.type, ActionType.DROP)
+        self.assertEqual(sorted(act.tags), ["post", "scanner", "sqli"])
+
+        # service-level accept beats the global signature drop
+        act = engine.evaluate(HttpRequest(path="/checker", body=b"union select", destination_port=8080))
+        self.assertEqual(act.type, ActionType.ACCEPT)
+
+        act = engine.evaluate(HttpRequest(method="GET", body=b"hello"))
+        self.assertEqual(act.type, ActionType.ACCEPT)
+        self.assertEqual(act.tags, [])
+
+if __name__ == "__main__":
+    unittest.main()
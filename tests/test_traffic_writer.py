@@ -0,0 +1,122 @@
+import unittest
+import shutil
+import os
+from app.database.db import Database
+from app.database.writer import TrafficWriter
+
+class TestTrafficWriter(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_writer"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+        self.db = Database()
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await self.db.connect()
+        self.session_id = await self.db.execute(
+            "INSERT INTO user_sessions (client_ip, start_time, last_activity_time) VALUES (?, ?, ?)",
+            ('10.0.0.1', 1000.0, 1000.0)
+        )
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def fetch(self, query, parameters=()):
+        # потоки и сообщения лежат в разделе по времени открытия потока
+        return [row for rows in await self.db.fetch_partitions(query, parameters) for row in rows]
+
+    def make_writer(self, **kwargs):
+        params = dict(flush_interval=60, batch_size=100, queue_size=100,
+                      overflow_policy="drop", spill_path=os.path.join(self.test_dir, "spill.bin"))
+        params.update(kwargs)
+        return TrafficWriter(self.db, **params)
+
+    async def submit_exchange(self, w, stream_id):
+        await w.submit("stream_open", (stream_id, self.session_id, '10.0.0.1', 4000 + stream_id, '127.0.0.1', 80, 1001.0))
+        await w.submit("message", (stream_id, 'REQUEST', 'GET', '/', None, '{}', b'', '[]', 1002.0))
+        await w.submit("alert", (2, stream_id))
+        await w.submit("stream_close", (1003.0, stream_id))
+
+    async def test_flush_on_stop(self):
+        w = self.make_writer()
+        await w.start()
+        await self.submit_exchange(w, 1)
+
+        # до сброса в БД ничего нет
+        rows = await self.fetch("SELECT * FROM tcp_streams")
+        self.assertEqual(len(rows), 0)
+
+        await w.stop()
+
+        streams = await self.fetch("SELECT * FROM tcp_streams")
+        self.assertEqual(len(streams), 1)
+        self.assertEqual(streams[0]['is_closed'], 1)
+        self.assertEqual(streams[0]['user_session_id'], self.session_id)
+
+        msgs = await self.fetch("SELECT * FROM messages WHERE tcp_stream_id = 1")
+        self.assertEqual(len(msgs), 1)
+
+        sessions = await self.db.fetch_all("SELECT alert_level FROM user_sessions WHERE id = ?", (self.session_id,))
+        self.assertEqual(sessions[0]['alert_level'], 2)
+        self.assertEqual(w.written, 4)
+
+    async def test_direct_write_when_not_started(self):
+        w = self.make_writer()
+        await self.submit_exchange(w, 7)
+        rows = await self.fetch("SELECT * FROM messages WHERE tcp_stream_id = 7")
+        self.assertEqual(len(rows), 1)
+
+    async def test_drop_policy(self):
+        w = self.make_writer(queue_size=2, batch_size=10)
+        await w.start()
+        await self.submit_exchange(w, 1)
+        self.assertEqual(w.dropped, 2)
+        await w.stop()
+        self.assertEqual(w.written, 2)
+
+    async def test_spill_policy_keeps_everything(self):
+        w = self.make_writer(queue_size=2, batch_size=10, overflow_policy="spill")
+        await w.start()
+        await self.submit_exchange(w, 1)
+        await self.submit_exchange(w, 2)
+        self.assertEqual(w.spilled, 6)
+        await w.stop()
+
+        self.assertEqual(w.written, 8)
+        streams = await self.fetch("SELECT * FROM tcp_streams WHERE is_closed = 1")
+        self.assertEqual(len(streams), 2)
+        self.assertFalse(os.path.exists(w.spill_path))
+
+    async def test_bad_row_does_not_drop_batch(self):
+        w = self.make_writer()
+        await self.submit_exchange(w, 1)
+        await w.start()
+        # stream 1 is already there: only its duplicate open is lost
+        await w.submit("stream_open", (1, self.session_id, '10.0.0.1', 5000, '127.0.0.1', 80, 1001.0))
+        await w.submit("stream_open", (2, self.session_id, '10.0.0.1', 5001, '127.0.0.1', 80, 1001.0))
+        await w.submit("message", (2, 'REQUEST', 'GET', '/next', None, '{}', b'x', '[]', 1002.0))
+        await w.stop()
+
+        self.assertEqual(w.dropped, 1)
+        streams = await self.fetch("SELECT id, client_port FROM tcp_streams ORDER BY id")
+        self.assertEqual([tuple(row) for row in streams], [(1, 4001), (2, 5001)])
+        msgs = await self.fetch("SELECT id, url FROM messages ORDER BY id")
+        self.assertEqual([tuple(row) for row in msgs], [(1, '/'), (2, '/next')])
+
+    async def test_spill_replayed_before_ids_are_seeded(self):
+        w = self.make_writer()
+        w._spill(("session_open", (50, '10.0.0.9', 1000.0, 1000.0)))
+        w._spill(("stream_open", (60, 50, '10.0.0.9', 4000, '127.0.0.1', 80, 1001.0)))
+
+        # a new run: the leftovers are written before start() returns
+        w = self.make_writer()
+        await w.start()
+        self.assertEqual(w.replayed_ids, {"session_open": 50, "stream_open": 60})
+        self.assertEqual([row['id'] for row in await self.fetch("SELECT id FROM tcp_streams")], [60])
+        await w.stop()
+        self.assertFalse(os.path.exists(w.spill_path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+import asyncio
+import shutil
+import os
+from app.core.proxy import TcpProxy
+from app.core.upstream import UpstreamPool
+from app.core.engine import RuleEngine
+from app.database.db import db
+
+class KeepAliveServer:
+    """HTTP/1.1 сервис: отвечает на каждый запрос и держит соединение."""
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        # закрыть keep-alive соединение, получив на нём второй запрос
+        self.drop_reused = False
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        served = 0
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                if served and self.drop_reused:
+                    break
+                served += 1
+                self.requests += 1
+                body = b"ok %d" % self.requests
+                close = b"connection: close" in head.lower()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s\r\n%s" % (
+                    len(body), b"Connection: close\r\n" if close else b"", body))
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+class TestUpstreamPool(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_pool"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+        db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await db.connect()
+
+        self.upstream = KeepAliveServer()
+        await self.upstream.start()
+
+        rules_dir = os.path.join(self.test_dir, "rules")
+        os.makedirs(os.path.join(rules_dir, "global"))
+        with open(os.path.join(rules_dir, "global", "evil.rule"), "w") as f:
+            f.write("if 'evil' in request.path: action.drop()")
+
+        self.proxy = TcpProxy("127.0.0.1", 0, "127.0.0.1", self.upstream.port, upstream_pool=True)
+        self.proxy.rule_engine = RuleEngine(rules_dir)
+        self.proxy_task = asyncio.create_task(self.proxy.start())
+        while self.proxy.server is None:
+            await asyncio.sleep(0.01)
+        self.proxy_port = self.proxy.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.proxy_task.cancel()
+        await self.proxy.upstream_pool.close()
+        self.upstream.server.close()
+        await db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def request(self, raw):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.proxy_port)
+        writer.write(raw)
+        await writer.drain()
+        data = await reader.readuntil(b"\r\n\r\n")
+        length = int(data.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+        data += await reader.readexactly(length)
+        writer.close()
+        await writer.wait_closed()
+        return data
+
+    async def wait_idle(self, count):
+        for _ in range(100):
+            if self.proxy.upstream_pool.stats()["idle"] == count:
+                return
+            await asyncio.sleep(0.01)
+
+    async def test_reuse_across_clients(self):
+        for i in range(5):
+            data = await self.request(b"GET /%d HTTP/1.1\r\nHost: x\r\n\r\n" % i)
+            self.assertIn(b"200 OK", data)
+            await self.wait_idle(1)
+
+        stats = self.proxy.upstream_pool.stats()
+        self.assertEqual(self.upstream.connections, 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 4)
+
+    async def test_connection_close_not_pooled(self):
+        await self.request(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+        await self.request(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+        self.assertEqual(self.upstream.connections, 2)
+
+    async def test_stale_connection_retried(self):
+        await self.request(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+        await self.wait_idle(1)
+
+        # the service closes the kept-alive connection as the next request arrives
+        self.upstream.drop_reused = True
+        data = await self.request(b"GET /again HTTP/1.1\r\nHost: x\r\n\r\n")
+        self.assertIn(b"200 OK", data)
+        self.assertEqual(self.proxy.upstream_pool.stats()["stale"], 1)
+        self.assertEqual(self.upstream.connections, 2)
+
+    async def test_drop_and_pipelining(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.proxy_port)
+        writer.write(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /evil HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /b HTTP/1.1\r\nHost: x\r\n\r\n")
+        await writer.drain()
+
+        statuses = []
+        for _ in range(3):
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            length = int(head.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+            await reader.readexactly(length)
+            statuses.append(head.split(b" ")[1])
+        writer.close()
+        await writer.wait_closed()
+
+        self.assertEqual(statuses, [b"200", b"403", b"200"])
+        self.assertEqual(self.upstream.requests, 2)
+        self.assertEqual(self.upstream.connections, 1)
+
+    async def test_idle_eviction(self):
+        pool = UpstreamPool("127.0.0.1", self.upstream.port, max_size=1, idle_timeout=0.05)
+        a = await pool.acquire()
+        b = await pool.acquire()
+        pool.release(a)
+        pool.release(b) # pool is full
+        self.assertEqual(pool.stats()["idle"], 1)
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(pool.evict_idle(), 1)
+        self.assertEqual(pool.stats()["idle"], 0)
+        await pool.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import asyncio
+import unittest
+import shutil
+import os
+import queue
+import socket
+from app.core.iplist import IpAccessList
+from app.core.session import IdSequence
+from app.core.workers import Supervisor
+from app.database.db import Database
+from app.database.writer import TrafficWriter
+
+class TestIdSequence(unittest.TestCase):
+    def allocate(self, index, count, max_id):
+        ids = IdSequence()
+        ids.configure(index, count)
+        ids.start(max_id)
+        return [ids.next() for _ in range(3)]
+
+    def test_workers_do_not_collide(self):
+        ids = [self.allocate(index, 3, 10) for index in range(3)]
+        self.assertEqual(ids[0], [12, 15, 18])
+        self.assertEqual(ids[1], [13, 16, 19])
+        self.assertEqual(ids[2], [11, 14, 17])
+
+    def test_single_process_is_sequential(self):
+        self.assertEqual(self.allocate(0, 1, None), [1, 2, 3])
+
+class TestWriterChannel(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_dir = "tests/data_workers"
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+
+        self.db = Database()
+        self.db.db_path = os.path.join(self.test_dir, "db.sqlite")
+        await self.db.connect()
+
+    async def fetch(self, query, parameters=()):
+        return [row for rows in await self.db.fetch_partitions(query, parameters) for row in rows]
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    async def test_batches_go_through_channel(self):
+        channel = queue.Queue()
+        worker = TrafficWriter(self.db, flush_interval=60, batch_size=100, queue_size=100,
+                               overflow_policy="drop", spill_path=os.path.join(self.test_dir, "spill.bin"))
+        worker.channel = channel
+        await worker.start()
+        await worker.submit("stream_open", (7, None, '10.0.0.1', 4000, '127.0.0.1', 80, 1001.0))
+        await worker.submit("message", (7, 'REQUEST', 'GET', '/', None, '{}', b'', '[]', 1002.0))
+        await worker.stop()
+
+        # воркер сам в БД не пишет
+        self.assertEqual(await self.fetch("SELECT * FROM tcp_streams"), [])
+        self.assertEqual(channel.qsize(), 1)
+
+        channel.put(None)
+        await TrafficWriter(self.db).consume(channel)
+        streams = await self.fetch("SELECT id FROM tcp_streams")
+        self.assertEqual([row['id'] for row in streams], [7])
+        msgs = await self.fetch("SELECT * FROM messages WHERE tcp_stream_id = 7")
+        self.assertEqual(len(msgs), 1)
+
+    def full_channel_writer(self, policy):
+        channel = queue.Queue(maxsize=1)
+        channel.put([])
+        worker = TrafficWriter(self.db, flush_interval=60, overflow_policy=policy,
+                               spill_path=os.path.join(self.test_dir, "spill.bin"))
+        worker.channel = channel
+        return channel, worker
+
+    async def test_full_channel_drops(self):
+        channel, worker = self.full_channel_writer("drop")
+        await worker._write([("alert", (1, 1))])
+        self.assertEqual(worker.dropped, 1)
+
+    async def test_full_channel_spills(self):
+        channel, worker = self.full_channel_writer("spill")
+        await worker.start()
+        await worker.submit("alert", (1, 1))
+        await worker.flush()
+        self.assertEqual((worker.spilled, worker.dropped), (1, 0))
+
+        # the writer process caught up: the spill goes out on the next flush
+        channel.get_nowait()
+        await worker.flush()
+        self.assertEqual(channel.get_nowait(), [("alert", (1, 1))])
+        await worker.stop()
+
+    async def test_full_channel_blocks(self):
+        channel, worker = self.full_channel_writer("block")
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, channel.get_nowait)
+        await worker._write([("alert", (1, 1))])
+        self.assertEqual((worker.written, worker.dropped), (1, 0))
+        self.assertEqual(channel.get_nowait(), [("alert", (1, 1))])
+
+class TestReusePort(unittest.IsolatedAsyncioTestCase):
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT is not available")
+    async def test_two_listeners_share_port(self):
+        async def handler(reader, writer):
+            writer.close()
+
+        # так слушают воркеры TcpProxy(reuse_port=True)
+        first = await asyncio.start_server(handler, "127.0.0.1", 0, reuse_port=True)
+        port = first.sockets[0].getsockname()[1]
+        second = await asyncio.start_server(handler, "127.0.0.1", port, reuse_port=True)
+        for server in (first, second):
+            server.close()
+            await server.wait_closed()
+
+class FakeProcess:
+    def __init__(self, alive=True, exitcode=None):
+        self.alive = alive
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return self.alive
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = Supervisor(2)
+        self.spawned = []
+        self.supervisor._spawn_worker = lambda index: self.spawned.append(index)
+        self.supervisor._spawn_panel = lambda: self.spawned.append("panel")
+        self.supervisor._writer = FakeProcess()
+        self.supervisor._panel = FakeProcess()
+        self.supervisor._procs = {0: FakeProcess(), 1: FakeProcess()}
+
+    def test_restarts_workers_and_panel(self):
+        self.supervisor._procs[1].alive = False
+        self.supervisor._panel.alive = False
+        self.assertTrue(self.supervisor._check_children())
+        self.assertEqual(self.spawned, [1, "panel"])
+
+    def test_writer_exit_stops(self):
+        self.supervisor._writer = FakeProcess(alive=False, exitcode=-9)
+        self.assertFalse(self.supervisor._check_children())
+        self.assertEqual(self.spawned, [])
+
+        # while stopping, exits are expected
+        self.supervisor._stopping = True
+        self.assertTrue(self.supervisor._check_children())
+
+class TestIpListReload(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/data_workers_ip"
+        os.makedirs(self.test_dir, exist_ok=True)
+        self.path = os.path.join(self.test_dir, "ip_lists.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_reload_picks_up_other_process(self):
+        worker = IpAccessList(self.path)
+        panel = IpAccessList(self.path)
+        panel.add("block", ["1.2.3.4"])
+        self.assertFalse(worker.is_blocked("1.2.3.4"))
+
+        worker.reload()
+        self.assertTrue(worker.is_blocked("1.2.3.4"))
+
+        panel.remove("block", ["1.2.3.4"])
+        worker.reload()
+        self.assertFalse(worker.is_blocked("1.2.3.4"))